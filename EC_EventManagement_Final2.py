@@ -1,11 +1,123 @@
-import time
 from abc import ABC, abstractmethod
-import csv
-import re
+import argparse
+import atexit
+from datetime import datetime, timedelta
+
+import bulk
+import metrics
+from changelog import Changelog, serve as serve_changes
+from contact_index import MIN_PHONE_DIGITS, is_valid_email, is_valid_phone
+from records import parse_date, parse_time
+from recurrence import Recurrence, rule_of
+from reporting import HEADCOUNT_FIELDS, MONTH_FIELDS, TYPE_FIELDS, Reports
+from server import make_server
+from service import Duplicate, EventService, InvalidInput, NotFound
+from shards import ShardedAttendeeStore, reshard, shard_count
+from storage import SqliteDatabase, migrate_csv_to_sqlite
+from store import EventStore, AttendeeStore, delete_attendees, delete_events, promote, register_attendees
 
 # Global variables
 event_filename = 'events.csv'
 attendee_filename = 'attendees.csv'
+waitlist_filename = 'waitlist.csv'  # people waiting for a place at a full event, same columns as attendees.csv
+changelog_filename = 'changes.log'  # every change to the events, attendees and waitlist, see changelog.py
+
+# With journal_mode on, edits and deletes are appended to a log next to each CSV file and compacted in the background
+journal_mode = False
+# When set, events and attendees are stored in this SQLite database instead of the CSV files
+database_filename = None
+
+# In-memory stores, each file is loaded once on first use and then every menu operation is served from memory. Other
+# sessions may change the files meanwhile, so the stores are refreshed (reloaded only if a file changed) on every use.
+event_store = None
+attendee_store = None
+waitlist_store = None
+database = None
+changelog = None
+reports = None  # counters kept up to date by both stores, created on the first report
+
+
+def get_database():
+    global database
+    if database is None:
+        database = SqliteDatabase(database_filename)
+    return database
+
+
+def get_event_store():
+    global event_store
+    if event_store is None:
+        if database_filename:
+            event_store = EventStore(table=get_database().table('events'), changelog=get_changelog().table('events'))
+        else:
+            event_store = EventStore(event_filename, journaled=journal_mode, changelog=get_changelog().table('events'))
+    else:
+        event_store.refresh()
+    return event_store
+
+
+def get_attendee_store():
+    global attendee_store
+    if attendee_store is None:
+        if database_filename:
+            attendee_store = AttendeeStore(table=get_database().table('attendees'),
+                                           changelog=get_changelog().table('attendees'))
+        elif shard_count(attendee_filename):  # split by the shard command
+            attendee_store = ShardedAttendeeStore(attendee_filename, journaled=journal_mode,
+                                                  changelog=get_changelog().table('attendees'))
+        else:
+            attendee_store = AttendeeStore(attendee_filename, journaled=journal_mode,
+                                           changelog=get_changelog().table('attendees'))
+    else:
+        attendee_store.refresh()
+    return attendee_store
+
+
+def get_waitlist_store():
+    global waitlist_store
+    if waitlist_store is None:
+        if database_filename:
+            waitlist_store = AttendeeStore(table=get_database().table('waitlist'),
+                                           changelog=get_changelog().table('waitlist'))
+        elif shard_count(waitlist_filename):
+            waitlist_store = ShardedAttendeeStore(waitlist_filename, journaled=journal_mode,
+                                                  changelog=get_changelog().table('waitlist'))
+        else:
+            waitlist_store = AttendeeStore(waitlist_filename, journaled=journal_mode,
+                                           changelog=get_changelog().table('waitlist'))
+    else:
+        waitlist_store.refresh()
+    return waitlist_store
+
+
+def get_changelog():
+    global changelog
+    if changelog is None:
+        changelog = Changelog(changelog_filename)
+    return changelog
+
+
+def get_reports():
+    global reports
+    if reports is None:
+        reports = Reports(get_event_store(), get_attendee_store())
+    else:  # refreshes both stores, a reload recounts
+        get_event_store()
+        get_attendee_store()
+    return reports
+
+
+def close_stores():  # waits for a running compaction to finish
+    if event_store is not None:
+        event_store.close()
+    if attendee_store is not None:
+        attendee_store.close()
+    if waitlist_store is not None:
+        waitlist_store.close()
+    if database is not None:
+        database.close()
+    if changelog is not None:
+        changelog.close()
 
 
 # Trying custom error handling
@@ -77,182 +189,238 @@ class Event(ABC):
         self.__event_location = event_location
 
     # re-usable methods that are common within different subclasses
-    def get_latest_id(self, filename):  # finding the latest id number, so a new unique id number can be created when
-        # adding a new event.
-        try:
-            with open(filename, 'r', newline='') as csvfile:
-                event_reader = csv.reader(csvfile)
-                rows = list(event_reader)
-                if rows:  # Check if there are any rows in the file
-                    last_row = rows[-1]  # Read the last row to get the last event ID
-                    return int(last_row[0])
-                else:
-                    return 0  # No events in the file yet, start with ID 1
-        except FileNotFoundError:
-            # If the file doesn't exist yet, start with ID 1
-            return 0
-
     def get_valid_date_input(self):
         while True:
             event_date = input("Enter event date (DD/MM/YYYY): ")
-            date_pattern = r'^\d{2}/\d{2}/\d{4}$'  # expression pattern for the correct format (DD/MM/YYYY)
-            if re.match(date_pattern, event_date):
+            if parse_date(event_date):  # the format must be DD/MM/YYYY and the day must exist (no 31/09)
                 return event_date
             else:
-                print("Invalid date format. Please use DD/MM/YYYY format.")
+                print("Invalid date. Please use DD/MM/YYYY format.")
 
     def get_valid_time_input(self):
         while True:
             try:
                 event_time = input("Enter event time (HH:MM): ")
-                time_pattern = r'^\d{2}:\d{2}$'  # expression pattern for the correct format (HH:MM)
-                if re.match(time_pattern, event_time):
+                if parse_time(event_time):  # the format must be HH:MM and a real time of day
                     return event_time
                 else:
                     raise MyCustomException("Invalid time format. Please use HH:MM format.")
             except MyCustomException as e:
                 print(e)
 
-    def list_all_events(self):
-        try:
-            with open(event_filename, 'r') as file:
-                self.events = csv.reader(file, delimiter=",", quotechar='/')
-                line_count = 0
-                print('\nHeader: ID, type, name, Date, Time, Location, owner\n')
-                for row in file:
-                    print(row)
-                    line_count += 1
-                print(f'Total events: {line_count}')
-                print('_______________')
-        except FileNotFoundError:
-            print("File not found.")
+    def get_valid_capacity_input(self):
+        while True:
+            capacity = input("Enter the most attendees allowed (leave empty for no limit): ").strip()
+            if not capacity or (capacity.isdigit() and int(capacity) > 0):
+                return capacity
+            print("Invalid capacity. Please enter a whole number of at least 1, or nothing.")
 
+    def get_valid_recurrence_input(self, event_date):
+        # '' for a one-off event, otherwise the repeat rule as JSON, see recurrence.py
+        while True:
+            freq = input("Repeat daily, weekly, monthly or yearly? (leave empty for a one-off event): ").strip().lower()
+            if not freq:
+                return ''
+            interval = input("Repeat every how many days/weeks/months/years? (default 1): ").strip() or '1'
+            end = input("Enter the number of times, or the last date (DD/MM/YYYY): ").strip()
+            if not interval.isdigit():
+                print("Invalid interval. Please enter a whole number of at least 1.")
+                continue
+            count, until = (end, None) if end.isdigit() else (None, end)
+            try:
+                return bulk.validate_recurrence(Recurrence(freq, interval, count, until).to_text(), event_date)
+            except (ValueError, bulk.RejectedRow) as e:
+                print(f"{e}. Please try again.")
+
+    @metrics.timed('menu.list_all_events')
+    def list_all_events(self, page_size=20):
+        # Events are read from the store a page at a time, so a huge file doesn't flood the terminal
+        store = get_event_store()
+        print('\nHeader: ID, type, name, Date, Time, Location, owner, capacity, recurrence\n')
+        cursor = None
+        while True:
+            events, cursor = store.page(limit=page_size, cursor=cursor)
+            for event in events:
+                print(','.join(event.to_row()))
+            if cursor is None:
+                break
+            if input('Press Enter for the next page, or q to go back to the menu: ').strip().lower() == 'q':
+                break
+        print(f'Total events: {len(store)}')
+        print('_______________')
+
+    @metrics.timed('menu.list_upcoming_events')
+    def list_upcoming_events(self):
+        store = get_event_store()
+        count = input('How many upcoming events do you want to see? (default 10): ').strip()
+        upcoming = store.upcoming(int(count) if count.isdigit() else 10)
+        print()
+        for event in upcoming:
+            print(f'{event.event_date} {event.event_time or "--:--"}  ID {event.event_id}: {event.event_name} '
+                  f'({event.event_type}, {event.event_location})')
+        if not upcoming:
+            print('No upcoming events.')
+        malformed = list(store.dates.malformed) + list(store.series.malformed)
+        if malformed:
+            print(f'{len(malformed)} event(s) have an invalid date, time or repeat and are not listed here. '
+                  f'IDs: {", ".join(str(event_id) for event_id in malformed)}')
+        print('_______________')
+
+    @metrics.timed('menu.search_events')
+    def search_events(self):
+        text = input('Search events by name, location or host (typos are fine): ').strip()
+        results = get_event_store().search(text, limit=20)
+        print()
+        for event, score in results:
+            print(f'ID {event.event_id}: {event.event_name} ({event.event_type}, {event.event_date}, '
+                  f'{event.event_location}, {event.owner})')
+        if not results:
+            print('No events found.')
+        print('_______________')
+
+    @metrics.timed('menu.show_statistics')
+    def show_statistics(self):
+        report = get_reports()
+        events, attendees, orphaned = report.totals()
+        print(f'\n{events} events, {attendees} attendees\n')
+        print('Per event type:')
+        for event_type, type_events, type_attendees in report.by_type():
+            print(f'  {event_type:<12}{type_events:>8} events{type_attendees:>9} attendees')
+        print('Per month:')
+        for month, event_type, month_events, month_attendees in report.by_month():
+            print(f'  {month:<9}{event_type:<12}{month_events:>8} events{month_attendees:>9} attendees')
+        print('Events with the most attendees:')
+        for event_id, event_type, event_name, event_date, headcount in report.headcounts(top=5):
+            print(f'  ID {event_id}: {event_name} ({event_type}, {event_date}) - {headcount} attendees')
+        if orphaned:
+            print(f'{orphaned} attendee(s) belong to events that do not exist, see the check command.')
+        print('_______________')
+
+    @metrics.timed('menu.display_individual_event')
     def display_individual_event(self):
         chose_event_to_view = input('Enter the ID of the event you want to see: ')
         try:
-            with open(event_filename, 'r') as file:
-                self.events = csv.reader(file, delimiter=",", quotechar='/')
-                print()
-                for row in self.events:
-                    if chose_event_to_view == row[0]:
-                        if row[1] == 'wedding':
-                            print(
-                                f'ID: {row[0]} \nType: {row[1]} \nName: {row[2]} \nDate: {row[3]} \nTime: {row[4]} \nLocation: {row[5]} \nBride and Groom: {row[6]}')
-                        elif row[1] == 'birthday':
-                            print(
-                                f'ID: {row[0]} \nType: {row[1]} \nName: {row[2]} \nDate: {row[3]} \nTime: {row[4]} \nLocation: {row[5]} \ncelebrant: {row[6]}')
-                        elif row[1] == 'business':
-                            print(
-                                f'ID: {row[0]} \nType: {row[1]} \nName: {row[2]} \nDate: {row[3]} \nTime: {row[4]} \nLocation: {row[5]} \nhost: {row[6]}')
-                        break
-                else:
-                    print('Event not found. Chose option 2 to view existing events.')
-                print('_______________')
-        except FileNotFoundError:
-            print("File not found.")
-
+            row = get_event_store().get(int(chose_event_to_view))
+        except ValueError:
+            row = None
+        print()
+        if row:
+            if row[1] == 'wedding':
+                print(
+                    f'ID: {row[0]} \nType: {row[1]} \nName: {row[2]} \nDate: {row[3]} \nTime: {row[4]} \nLocation: {row[5]} \nBride and Groom: {row[6]}')
+            elif row[1] == 'birthday':
+                print(
+                    f'ID: {row[0]} \nType: {row[1]} \nName: {row[2]} \nDate: {row[3]} \nTime: {row[4]} \nLocation: {row[5]} \ncelebrant: {row[6]}')
+            elif row[1] == 'business':
+                print(
+                    f'ID: {row[0]} \nType: {row[1]} \nName: {row[2]} \nDate: {row[3]} \nTime: {row[4]} \nLocation: {row[5]} \nhost: {row[6]}')
+            attendee_count = len(get_attendee_store().by_event.get(row.event_id, ()))
+            print(f'Attendees: {attendee_count}' + (f' of {row.capacity}' if row.capacity else ' (no limit)'))
+            if row.recurrence:
+                try:
+                    print(f'Repeats: {rule_of(row).describe()}')
+                except ValueError as e:
+                    print(f'Repeats: invalid rule ({e})')
+            waiting_count = len(get_waitlist_store().by_event.get(row.event_id, ()))
+            if waiting_count:
+                print(f'Waitlist: {waiting_count}')
+        else:
+            print('Event not found. Chose option 2 to view existing events.')
+        print('_______________')
+
+    @metrics.timed('menu.edit_event')
     def edit_event(self):
         self.event_id = int(input("Enter the event ID you want to edit: "))
 
-        try:
-            with open(event_filename, 'r', newline='') as csvfile:
-                self.events_data = list(csv.reader(csvfile))
-                found_event = None
-
-                # Find the event with the provided ID
-                for i, event in enumerate(self.events_data):
-                    if int(event[0]) == self.event_id:
-                        found_event = event
-                        break
-
-                if found_event:
-                    print(f"Event ID: {found_event[0]}")
-                    print(f"Event Type: {found_event[1]}")
-                    print(f"Event Name: {found_event[2]}")
-                    print(f"Event Date: {found_event[3]}")
-                    print(f"Event time: {found_event[4]}")
-                    print(f"Event location: {found_event[5]}")
-                    if found_event[1] == 'wedding':
-                        print(f"Bride & groom: {found_event[6]}")
-                    if found_event[1] == 'birthday':
-                        print(f"celebrant: {found_event[6]}")
-                    if found_event[1] == 'business':
-                        print(f"host: {found_event[6]}")
-
-                    attribute_to_edit = input("Enter the attribute to edit (Name/Date/Time/Location): ").lower()
-
-                    # Determine the index of the attribute to edit
-                    if attribute_to_edit == "name":
-                        new_value = input(str("Enter event name/description: "))
-                        attr_index = 2
-                    elif attribute_to_edit == "date":
-                        new_value = Event.get_valid_date_input(self)
-                        attr_index = 3
-                    elif attribute_to_edit == "time":
-                        new_value = Event.get_valid_time_input(self)
-                        attr_index = 4
-                    elif attribute_to_edit == "location":
-                        attr_index = 5
-                    else:
-                        print("Invalid input. You can only amend Name/Date/Time/Location.")
+        # Find the event with the provided ID
+        found_event = get_event_store().get(self.event_id)
+
+        if found_event:
+            print(f"Event ID: {found_event[0]}")
+            print(f"Event Type: {found_event[1]}")
+            print(f"Event Name: {found_event[2]}")
+            print(f"Event Date: {found_event[3]}")
+            print(f"Event time: {found_event[4]}")
+            print(f"Event location: {found_event[5]}")
+            if found_event[1] == 'wedding':
+                print(f"Bride & groom: {found_event[6]}")
+            if found_event[1] == 'birthday':
+                print(f"celebrant: {found_event[6]}")
+            if found_event[1] == 'business':
+                print(f"host: {found_event[6]}")
+            print(f"Capacity: {found_event.capacity or 'no limit'}")
+            print(f"Repeats: {found_event.recurrence or 'no'}")
+
+            attribute_to_edit = input("Enter the attribute to edit (Name/Date/Time/Location/Capacity/Repeat): ").lower()
+
+            # Determine the index of the attribute to edit
+            if attribute_to_edit == "name":
+                new_value = input(str("Enter event name/description: "))
+                attr_index = 2
+            elif attribute_to_edit == "date":
+                new_value = Event.get_valid_date_input(self)
+                attr_index = 3
+                if found_event.recurrence:  # a repeat with a last date can't end before the new first date
+                    try:
+                        bulk.validate_recurrence(found_event.recurrence, new_value)
+                    except bulk.RejectedRow as e:
+                        print(f"{e}. Change the repeat first.")
                         return
+            elif attribute_to_edit == "time":
+                new_value = Event.get_valid_time_input(self)
+                attr_index = 4
+            elif attribute_to_edit == "location":
+                new_value = input("Enter event location: ").lower().replace(',', '')
+                attr_index = 5
+            elif attribute_to_edit == "capacity":
+                new_value = Event.get_valid_capacity_input(self)
+                attr_index = 7
+            elif attribute_to_edit == "repeat":
+                new_value = Event.get_valid_recurrence_input(self, found_event.event_date)
+                attr_index = 8
+            else:
+                print("Invalid input. You can only amend Name/Date/Time/Location/Capacity/Repeat.")
+                return
 
-                    # Update the selected attribute
-                    found_event[attr_index] = new_value
-
-                    # Write the updated data back to the CSV file
-                    with open(event_filename, 'w', newline='') as csvfile:
-                        event_writer = csv.writer(csvfile)
-                        for event in self.events_data:
-                            event_writer.writerow(event)
+            # Update the selected attribute, the store writes the change back to the CSV file
+            get_event_store().update(self.event_id, attr_index, new_value)
 
-                    print("Event updated successfully!")
-                else:
-                    print("Event not found with the given ID. Chose option 2 to view all events.")
-        except FileNotFoundError:
-            print("File not found.")
+            print("Event updated successfully!")
+            if attr_index == 7:  # a higher capacity lets the first people on the waitlist in
+                for attendee in promote(get_event_store(), get_attendee_store(), get_waitlist_store(),
+                                        [self.event_id]):
+                    print(f'{attendee.name} {attendee.surname} got a place from the waitlist.')
+        else:
+            print("Event not found with the given ID. Chose option 2 to view all events.")
 
+    @metrics.timed('menu.delete_event')
     def delete_event(self):
         event_id = int(input("Enter the event ID you want to delete: "))
-        try:
-            with open(event_filename, 'r', newline='') as csvfile:
-                events_data = list(csv.reader(csvfile))
-
-                found_event = None
-
-                # Find the event with the provided ID
-                for i, event in enumerate(events_data):
-                    if int(event[0]) == event_id:
-                        found_event = event
-                        break
 
-                if found_event:
-                    print(f"Event ID: {found_event[0]}")
-                    print(f"Event Type: {found_event[1]}")
-                    print(f"Event Name: {found_event[2]}")
-                    print(f"Event Date: {found_event[3]}")
-
-                    confirmation = input("Do you want to proceed with the deletion? (Yes/No): ").strip().lower()
-
-                    if confirmation == "yes":
-                        # Remove the event from the list
-                        events_data.pop(i)
-
-                        # Write the updated data back to the CSV file ('w' mode as we need to overwrite everything)
-                        with open(event_filename, 'w', newline='') as csv_file:
-                            event_writer = csv.writer(csv_file)
-                            for event in events_data:
-                                event_writer.writerow(event)
-
-                        print("Event deleted successfully!")
-                    elif confirmation == "no":
-                        print("Deletion canceled.")
-                    else:
-                        print("Invalid input. Deletion canceled.")
-                else:
-                    print("Event not found with the given ID.")
-        except FileNotFoundError:
-            print("File not found.")
+        # Find the event with the provided ID
+        found_event = get_event_store().get(event_id)
+
+        if found_event:
+            print(f"Event ID: {found_event[0]}")
+            print(f"Event Type: {found_event[1]}")
+            print(f"Event Name: {found_event[2]}")
+            print(f"Event Date: {found_event[3]}")
+            attendee_count = len(get_attendee_store().by_event.get(event_id, ()))
+            waiting_count = len(get_waitlist_store().by_event.get(event_id, ()))
+            if attendee_count or waiting_count:
+                print(f"Its {attendee_count} attendee(s) and {waiting_count} on the waitlist will be deleted too.")
+
+            confirmation = input("Do you want to proceed with the deletion? (Yes/No): ").strip().lower()
+
+            if confirmation == "yes":
+                delete_events(get_event_store(), get_attendee_store(), [event_id], get_waitlist_store())
+                print("Event deleted successfully!")
+            elif confirmation == "no":
+                print("Deletion canceled.")
+            else:
+                print("Invalid input. Deletion canceled.")
+        else:
+            print("Event not found with the given ID.")
 
     # abstract methods
     @abstractmethod
@@ -261,12 +429,16 @@ class Event(ABC):
 
 
 class Wedding(Event):
-    def __init__(self, event_id, event_name, event_date, event_time, event_location, bride_and_groom):
+    def __init__(self, event_id, event_name, event_date, event_time, event_location, bride_and_groom, capacity=None,
+                 recurrence=''):
         super().__init__(event_id, 'Wedding', event_name, event_date, event_time, event_location)
         self.bride_and_groom = bride_and_groom
+        self.capacity = capacity  # most attendees, None for no limit
+        self.recurrence = recurrence  # the repeat rule as JSON, '' for a one-off event
 
+    @metrics.timed('menu.add_event')
     def add_event(self):
-        self.event_id = Event.get_latest_id(self, event_filename) + 1  # Generate a unique event ID
+        self.event_id = get_event_store().ids.next_id()  # Generate a unique event ID
         self.event_date = Event.get_valid_date_input(self)
         self.event_time = Event.get_valid_time_input(self)
         self.event_location = input("Enter event location: ").lower()
@@ -274,64 +446,72 @@ class Wedding(Event):
         self.bride_and_groom = input(str('Enter the names of the bride and the groom: '))
         self.bride_and_groom = self.bride_and_groom.replace(',', '')
         self.event_name = f'wedding of {self.bride_and_groom}'
+        self.capacity = Event.get_valid_capacity_input(self)
+        self.recurrence = Event.get_valid_recurrence_input(self, self.event_date)
 
         try:
-            with open(event_filename, 'a', newline='') as csvfile:  # Save the event to the CSV file
-                event_writer = csv.writer(csvfile)
-                event_writer.writerow(
-                    [self.event_id, self.event_type, self.event_name, self.event_date, self.event_time,
-                     self.event_location, self.bride_and_groom])
-                print("Event added successfully!")
+            get_event_store().add(  # Save the event to the store, which appends it to the CSV file
+                [self.event_id, self.event_type, self.event_name, self.event_date, self.event_time,
+                 self.event_location, self.bride_and_groom, self.capacity, self.recurrence])
+            print("Event added successfully!")
         except Exception as e:
             print(f"An error occurred while saving the event: {str(e)}")
 
 
 class Birthday(Event):
-    def __init__(self, event_id, event_name, event_date, event_time, event_location, celebrant):
+    def __init__(self, event_id, event_name, event_date, event_time, event_location, celebrant, capacity=None,
+                 recurrence=''):
         super().__init__(event_id, 'Birthday', event_name, event_date, event_time, event_location)
         self.celebrant = celebrant
+        self.capacity = capacity  # most attendees, None for no limit
+        self.recurrence = recurrence  # the repeat rule as JSON, '' for a one-off event
 
+    @metrics.timed('menu.add_event')
     def add_event(self):
-        self.event_id = Event.get_latest_id(self, event_filename) + 1  # Generate a unique event ID
+        self.event_id = get_event_store().ids.next_id()  # Generate a unique event ID
         self.event_date = Event.get_valid_date_input(self)
         self.event_time = Event.get_valid_time_input(self)
         self.event_location = input("Enter event location: ").lower()
         self.event_location = self.event_location.replace(',', '')
         self.celebrant = input(str('Enter the name of the celebrant: '))
         self.event_name = f'birthday of {self.celebrant}'
+        self.capacity = Event.get_valid_capacity_input(self)
+        self.recurrence = Event.get_valid_recurrence_input(self, self.event_date)
 
         try:
-            with open(event_filename, 'a', newline='') as csvfile:  # Save the event to the CSV file
-                event_writer = csv.writer(csvfile)
-                event_writer.writerow(
-                    [self.event_id, self.event_type, self.event_name, self.event_date, self.event_time,
-                     self.event_location, self.celebrant])
-                print("Event added successfully!")
+            get_event_store().add(  # Save the event to the store, which appends it to the CSV file
+                [self.event_id, self.event_type, self.event_name, self.event_date, self.event_time,
+                 self.event_location, self.celebrant, self.capacity, self.recurrence])
+            print("Event added successfully!")
         except Exception as e:
             print(f"An error occurred while saving the event: {str(e)}")
 
 
 class Business(Event):
-    def __init__(self, event_id, event_name, event_date, event_time, event_location, business_host):
+    def __init__(self, event_id, event_name, event_date, event_time, event_location, business_host, capacity=None,
+                 recurrence=''):
         super().__init__(event_id, 'Business', event_name, event_date, event_time, event_location)
         self.business_host = business_host
+        self.capacity = capacity  # most attendees, None for no limit
+        self.recurrence = recurrence  # the repeat rule as JSON, '' for a one-off event
 
+    @metrics.timed('menu.add_event')
     def add_event(self):
-        self.event_id = Event.get_latest_id(self, event_filename) + 1  # Generate a unique event ID
+        self.event_id = get_event_store().ids.next_id()  # Generate a unique event ID
         self.event_name = input(str("Enter event name/title: "))
         self.event_date = Event.get_valid_date_input(self)
         self.event_time = Event.get_valid_time_input(self)
         self.event_location = input("Enter event location: ").lower()
         self.event_location = self.event_location.replace(',', '')
         self.business_host = input(str('Enter the name of the business host: '))
+        self.capacity = Event.get_valid_capacity_input(self)
+        self.recurrence = Event.get_valid_recurrence_input(self, self.event_date)
 
         try:
-            with open(event_filename, 'a', newline='') as csvfile:  # Save the event to the CSV file
-                event_writer = csv.writer(csvfile)
-                event_writer.writerow(
-                    [self.event_id, self.event_type, self.event_name, self.event_date, self.event_time,
-                     self.event_location, self.business_host])
-                print("Event added successfully!")
+            get_event_store().add(  # Save the event to the store, which appends it to the CSV file
+                [self.event_id, self.event_type, self.event_name, self.event_date, self.event_time,
+                 self.event_location, self.business_host, self.capacity, self.recurrence])
+            print("Event added successfully!")
         except Exception as e:
             print(f"An error occurred while saving the event: {str(e)}")
 
@@ -345,105 +525,126 @@ class Attendee:  # IS-relationship (every attendee IS going to an event)
         self.phone = phone
         self.event_id_input = event_id_input
 
+    @metrics.timed('menu.add_attendee')
     def add_attendee(self):
-        self.attendee_id = Event.get_latest_id(self, attendee_filename) + 1  # Generate a unique event ID
+        self.attendee_id = get_attendee_store().ids.next_id()  # Generate a unique attendee ID
         self.name = input("Enter the attendee's first name: ")
         self.surname = input("Enter the attendee's surname: ")
         self.email = input("Enter the attendee's email: ")
+        while not is_valid_email(self.email):
+            self.email = input('Invalid email. Please enter an address like name@example.com: ')
         self.phone = input("Enter the attendee's phone: ")
+        while not is_valid_phone(self.phone):
+            self.phone = input(f'Invalid phone. Please enter at least {MIN_PHONE_DIGITS} digits: ')
         self.event_id_input = input("Enter the event ID they are attending: ")
-        event_id_list = []
-        # open the file and create a list with the event IDs.
-        with open(event_filename, 'r', newline='') as csvfile:
-            events_data = list(csv.reader(csvfile))
-            for row in events_data:
-                event_id_list.append(row[0])
         # validate the event id before adding the new attendee.
         while True:
-            if self.event_id_input in event_id_list:
-                # Create the attendee object
-                new_attendee = Attendee(self.attendee_id, self.name, self.surname, self.email, self.phone,
-                                        self.event_id_input)
-                # Add the attendee to the CSV file
-                with open('attendees.csv', 'a', newline='') as csvfile:
-                    attendee_writer = csv.writer(csvfile)
-                    attendee_writer.writerow(
-                        [new_attendee.attendee_id, new_attendee.name, new_attendee.surname, new_attendee.email,
-                         new_attendee.phone, new_attendee.event_id_input])
-                break
-            else:
-                print('Event not found. Enter an existing event id')
-                self.event_id_input = input("Enter the event ID they are attending: ")
+            with get_event_store().reading():  # the event can't be deleted by another session until it's added
+                if self.event_id_input.isdigit() and int(self.event_id_input) in get_event_store():
+                    # Create the attendee object
+                    new_attendee = Attendee(self.attendee_id, self.name, self.surname, self.email, self.phone,
+                                            self.event_id_input)
+                    # Add the attendee to the store, which appends it to the CSV file, or to the waitlist when the
+                    # event is full. The same person (same email or phone) can only be registered once per event.
+                    row = [new_attendee.attendee_id, new_attendee.name, new_attendee.surname, new_attendee.email,
+                           new_attendee.phone, new_attendee.event_id_input]
+                    admitted, waitlisted = register_attendees(get_event_store(), get_attendee_store(),
+                                                              get_waitlist_store(), [row])
+                    if waitlisted:
+                        position = len(get_waitlist_store().by_event[int(self.event_id_input)])
+                        print(f'The event is full, so they are number {position} on its waitlist. They will get '
+                              f'a place as soon as one is free.')
+                        return
+                    if not admitted:
+                        duplicate = get_attendee_store().find_duplicate(row) or get_waitlist_store().find_duplicate(row)
+                        print(f'This person is already registered for event {self.event_id_input} '
+                              f'as attendee {duplicate[0]} ({duplicate[1]} {duplicate[2]}).')
+                        return
+                    break
+            print('Event not found. Enter an existing event id')
+            self.event_id_input = input("Enter the event ID they are attending: ")
 
         print("Attendee added to the event successfully!")
 
+    @metrics.timed('menu.find_registrations')
+    def find_registrations(self):
+        contact = input("Enter the attendee's email or phone: ").strip()
+        if '@' in contact:
+            registrations = get_attendee_store().registrations(email=contact)
+        else:
+            registrations = get_attendee_store().registrations(phone=contact)
+        if not registrations:
+            print('No attendees found with that email or phone.')
+            return
+        for attendee in registrations:
+            event = get_event_store().get(attendee.event_id)
+            print(f'Person ID {attendee.attendee_id}: {attendee.name} {attendee.surname} ({attendee.email}, '
+                  f'{attendee.phone}) -> event {attendee.event_id}: {event.event_name if event else "not found"}')
+        print('______________________')
+
+    @metrics.timed('menu.list_attendees_to_an_event')
     def list_attendees_to_an_event(self):
         event_id = int(input("Enter the event ID to list attendees: "))
 
-        try:
-            with open('attendees.csv', 'r', newline='') as csvfile:
-                attendees_data = list(csv.reader(csvfile))
-                # Create a list with all the attendees going to that event
-                event_attendees = [attendee for attendee in attendees_data if int(attendee[5]) == event_id]
-                # if the ID is found, print the attendees.
-                if event_attendees:
-                    print(f"Attendees of Event ID {event_id}:\n")
-                    for attendee in event_attendees:
-                        print(f"Person ID: {attendee[0]}")
-                        print(f"Name: {attendee[1]}")
-                        print(f"Surname: {attendee[2]}")
-                        print(f"Email: {attendee[3]}")
-                        print(f"Phone: {attendee[4]}")
-                        print("______________________")
-                else:
-                    print("No attendees found with the given event ID.")
-        except FileNotFoundError:
-            print("File not found.")
-
+        # The store keeps an index from event ID to its attendees
+        event_attendees = get_attendee_store().for_event(event_id)
+        waiting = get_waitlist_store().for_event(event_id)
+        # if the ID is found, print the attendees.
+        if event_attendees:
+            event = get_event_store().get(event_id)
+            capacity = f' of {event.capacity} places' if event and event.capacity else ''
+            print(f"Attendees of Event ID {event_id} ({len(event_attendees)}{capacity}):\n")
+            for attendee in event_attendees:
+                print(f"Person ID: {attendee[0]}")
+                print(f"Name: {attendee[1]}")
+                print(f"Surname: {attendee[2]}")
+                print(f"Email: {attendee[3]}")
+                print(f"Phone: {attendee[4]}")
+                print("______________________")
+        else:
+            print("No attendees found with the given event ID.")
+        if waiting:
+            print("Waitlist, in order:")
+            for position, attendee in enumerate(waiting, start=1):
+                print(f"{position}. Person ID {attendee[0]}: {attendee[1]} {attendee[2]} "
+                      f"({attendee[3]}, {attendee[4]})")
+
+    @metrics.timed('menu.delete_attendee_from_event')
     def delete_attendee_from_event(self):
         attendee_id = int(input("Enter the personal ID of the attendee you want to delete: "))
         event_id = int(input("Enter the event ID from which you want to delete the attendee: "))
 
-        try:
-            with open('attendees.csv', 'r', newline='') as csvfile:
-                attendees_data = list(csv.reader(csvfile))
-
-                found_attendee = None
-
-                # Find the attendee with the provided personal ID and event ID
-                for i, attendee in enumerate(attendees_data):
-                    if int(attendee[0]) == attendee_id and int(attendee[5]) == event_id:
-                        found_attendee = attendee
-                        break
-
-                if found_attendee:
-                    print(f"Personal ID: {found_attendee[0]}")
-                    print(f"Name: {found_attendee[1]}")
-                    print(f"Surname: {found_attendee[2]}")
-                    print(f"Email: {found_attendee[3]}")
-                    print(f"Phone: {found_attendee[4]}")
-                    print("______________________")
-
-                    confirmation = input("Do you want to proceed with the deletion? (Yes/No): ").strip().lower()
-
-                    if confirmation == "yes":
-                        # Remove the attendee from the list
-                        attendees_data.pop(i)
-
-                        # Write the updated data back to the CSV file ('w' mode as we need to overwrite everything)
-                        with open('attendees.csv', 'w', newline='') as csvfile:
-                            attendee_writer = csv.writer(csvfile)
-                            attendee_writer.writerows(attendees_data)
-
-                        print("Attendee deleted from the event successfully!")
-                    elif confirmation == "no":
-                        print("Deletion canceled.")
-                    else:
-                        print("Invalid input. Deletion canceled.")
-                else:
-                    print("Attendee not found with the given IDs.")
-        except FileNotFoundError:
-            print("File not found.")
+        # Find the attendee with the provided personal ID and event ID, registered or on the waitlist. Only the
+        # event's shard is looked at when the attendees are sharded.
+        found_attendee = (get_attendee_store().route(event_id).get(attendee_id)
+                          or get_waitlist_store().route(event_id).get(attendee_id))
+        if found_attendee and int(found_attendee[5]) != event_id:
+            found_attendee = None
+
+        if found_attendee:
+            print(f"Personal ID: {found_attendee[0]}")
+            print(f"Name: {found_attendee[1]}")
+            print(f"Surname: {found_attendee[2]}")
+            print(f"Email: {found_attendee[3]}")
+            print(f"Phone: {found_attendee[4]}")
+            print("______________________")
+
+            confirmation = input("Do you want to proceed with the deletion? (Yes/No): ").strip().lower()
+
+            if confirmation == "yes":
+                # the first person on the waitlist, if any, gets the place
+                deleted, promoted = delete_attendees(get_event_store(), get_attendee_store(), get_waitlist_store(),
+                                                     [(event_id, attendee_id)])
+                print("Attendee deleted from the event successfully!")
+                for attendee in promoted:
+                    print(f'{attendee.name} {attendee.surname} (ID {attendee.attendee_id}) got the place from the '
+                          f'waitlist.')
+            elif confirmation == "no":
+                print("Deletion canceled.")
+            else:
+                print("Invalid input. Deletion canceled.")
+        else:
+            print("Attendee not found with the given IDs.")
 
 
 class Menu:
@@ -459,6 +660,10 @@ class Menu:
             print("6. Add an attendee to an event")
             print("7. List attendees of an event")
             print("8. Delete an attendee from an event")
+            print("9. List upcoming events")
+            print("10. Search events")
+            print("11. Find the events of an attendee by email or phone")
+            print("12. Show event and attendee statistics")
             print("0. Exit")
 
             choice = input("Enter your choice: ")
@@ -468,15 +673,12 @@ class Menu:
                 while True:
                     self.event_type = input("Enter event type (choose from wedding, birthday, business): ").lower()
                     if self.event_type == 'wedding':
-                        Event.get_latest_id(self, event_filename)
                         Wedding.add_event(self)
                         break
                     elif self.event_type == 'birthday':
-                        Event.get_latest_id(self, event_filename)
                         Birthday.add_event(self)
                         break
                     elif self.event_type == 'business':
-                        Event.get_latest_id(self, event_filename)
                         Business.add_event(self)
                         break
                     else:
@@ -485,7 +687,6 @@ class Menu:
             elif choice == "2":
                 print('\nYou chose option 2: List all events')
                 Event.list_all_events(self)
-                time.sleep(3)
 
             elif choice == "3":
                 print('\nYou chose option 3: List an individual event')
@@ -511,7 +712,24 @@ class Menu:
                 print('You chose option 8: Delete an attendee from an event')
                 Attendee.delete_attendee_from_event(self)
 
+            elif choice == "9":
+                print('You chose option 9: List upcoming events')
+                Event.list_upcoming_events(self)
+
+            elif choice == "10":
+                print('You chose option 10: Search events')
+                Event.search_events(self)
+
+            elif choice == "11":
+                print('You chose option 11: Find the events of an attendee')
+                Attendee.find_registrations(self)
+
+            elif choice == "12":
+                print('You chose option 12: Show event and attendee statistics')
+                Event.show_statistics(self)
+
             elif choice == "0":
+                close_stores()
                 print("Exiting the program. Goodbye!")
                 break
 
@@ -519,8 +737,415 @@ class Menu:
                 print("Invalid choice. Please try again.")
 
 
+# Non-interactive commands, see the subcommands at the bottom of the file
+def run_import(args):
+    if args.kind == 'events':
+        report = bulk.import_events(args.filename, get_event_store(), args.chunk_size, args.rejects)
+    else:
+        report = bulk.import_attendees(args.filename, get_attendee_store(), get_event_store(), get_waitlist_store(),
+                                       args.chunk_size, args.rejects)
+    close_stores()
+    print(report)
+
+
+def run_dates(args):
+    store = get_event_store()
+    date_from = parse_date(args.date_from) if args.date_from else None
+    date_to = parse_date(args.date_to) if args.date_to else None
+    if (args.date_from and not date_from) or (args.date_to and not date_to):
+        print("Invalid date. Please use DD/MM/YYYY format.")
+        return
+    if args.week:
+        date_from = date_from or datetime.now().date()
+        date_to = date_from + timedelta(days=6)
+    if args.per_day:
+        for day, count in store.counts_by_day(date_from, date_to).items():
+            print(f'{day.strftime("%d/%m/%Y")}: {count}')
+    else:
+        events = store.events_between(date_from, date_to) if date_from or date_to else store.upcoming(args.upcoming)
+        for event in events:
+            print(','.join(event.to_row()))
+    for event_id, (date_text, time_text) in store.dates.malformed.items():
+        print(f'Malformed date/time for event {event_id}: {date_text!r} {time_text!r}')
+    for event_id, reason in store.series.malformed.items():
+        print(f'Malformed recurring event {event_id}: {reason}')
+
+
+def run_search(args):
+    for event, score in get_event_store().search(' '.join(args.text), args.limit):
+        print(f'{score:.1f}  ' + ','.join(event.to_row()))
+
+
+def run_migrate(args):
+    if shard_count(attendee_filename) or shard_count(waitlist_filename):
+        print('The attendees are sharded, merge them back into one file first with: shard 1')
+        return
+    events, attendees, skipped = migrate_csv_to_sqlite(event_filename, attendee_filename, args.database,
+                                                       waitlist_filename)
+    print(f'Copied {events} events and {attendees} attendees to {args.database}')
+    if skipped:
+        print(f'Skipped {len(skipped)} attendee(s) of events that do not exist: '
+              f'{", ".join(str(attendee_id) for attendee_id in skipped)}')
+
+
+def run_delete_events(args):
+    event_rows, attendee_rows = delete_events(get_event_store(), get_attendee_store(), args.event_ids,
+                                              get_waitlist_store())
+    close_stores()
+    print(f'Deleted {len(event_rows)} event(s) and {len(attendee_rows)} attendee(s)')
+
+
+def run_check(args):
+    # Integrity check: lines of the files that couldn't be read, attendees whose event doesn't exist, and people
+    # registered more than once for the same event. Sharded attendees are checked one process per shard.
+    attendee_bad_lines, dangling, duplicates = get_attendee_store().check(get_event_store())
+    bad_lines = [(event_filename, line_number, reason) for line_number, reason in get_event_store().table.bad_lines]
+    bad_lines += attendee_bad_lines
+    for filename, line_number, reason in bad_lines:
+        print(f'{filename} line {line_number} was skipped: {reason}')
+    for event_id, attendee_ids in dangling.items():
+        print(f'Event {event_id} does not exist but has attendee(s): {", ".join(map(str, attendee_ids))}')
+    for attendee, original_id in duplicates:
+        print(f'Attendee {attendee.attendee_id} duplicates attendee {original_id} for event {attendee.event_id} '
+              f'({attendee.email}, {attendee.phone})')
+    if not dangling and not duplicates:
+        if not bad_lines:
+            print('No unreadable lines, dangling references or duplicate registrations found.')
+    elif args.fix:
+        orphans = [(event_id, attendee_id) for event_id, attendee_ids in dangling.items()
+                   for attendee_id in attendee_ids]
+        deleted, promoted = delete_attendees(get_event_store(), get_attendee_store(), get_waitlist_store(),
+                                             orphans + [(attendee.event_id, attendee.attendee_id)
+                                                        for attendee, _ in duplicates])
+        close_stores()
+        print(f'Deleted {len(orphans)} orphaned attendee(s) and {len(duplicates)} duplicate registration(s).')
+        if promoted:
+            print(f'{len(promoted)} people on waitlists got the freed places.')
+
+
+def run_lookup(args):
+    if '@' in args.contact:
+        registrations = get_attendee_store().registrations(email=args.contact)
+    else:
+        registrations = get_attendee_store().registrations(phone=args.contact)
+    for attendee in registrations:
+        event = get_event_store().get(attendee.event_id)
+        print(','.join(attendee.to_row()) + f' -> {event.event_name if event else "event not found"}')
+    if not registrations:
+        print('No attendees found with that email or phone.')
+
+
+def run_with_service(operation):
+    # Runs one EventService operation, the same checks as the menu without the prompts, and prints its error if any
+    service = EventService(get_event_store(), get_attendee_store(), get_waitlist_store())
+    try:
+        return operation(service)
+    except (NotFound, InvalidInput, Duplicate) as e:
+        print(e)
+    finally:
+        service.close()
+        close_stores()
+
+
+def run_show_event(args):
+    event = run_with_service(lambda service: service.get_event(args.event_id))
+    if event:
+        print(','.join(event.to_row()))
+
+
+def run_edit_event(args):
+    changes = {field: value for field, value in (('event_name', args.name), ('event_date', args.date),
+                                                 ('event_time', args.time), ('event_location', args.location),
+                                                 ('capacity', args.capacity))
+               if value is not None}
+    if args.repeat == 'none':
+        changes['recurrence'] = ''
+    elif args.repeat:
+        changes['recurrence'] = {'freq': args.repeat, 'interval': args.every, 'count': args.count, 'until': args.until}
+    if not changes:
+        print('Nothing to change, use --name, --date, --time, --location, --capacity or --repeat.')
+        return
+    event = run_with_service(lambda service: service.edit_event(args.event_id, changes))
+    if event:
+        print('Event updated: ' + ','.join(event.to_row()))
+
+
+def run_occurrences(args):
+    date_from = parse_date(args.date_from) if args.date_from else None
+    date_to = parse_date(args.date_to) if args.date_to else None
+    if (args.date_from and not date_from) or (args.date_to and not date_to):
+        print("Invalid date. Please use DD/MM/YYYY format.")
+        return
+    occurrences = run_with_service(lambda service: service.list_occurrences(args.event_id, date_from, date_to,
+                                                                            args.limit))
+    for original_date, event in occurrences or ():
+        moved = f' (moved from {original_date})' if original_date != event.event_date else ''
+        print(f'{event.event_date} {event.event_time}  {event.event_name}, {event.event_location}{moved}')
+
+
+def run_edit_occurrence(args):
+    if args.command == 'cancel-occurrence':
+        event = run_with_service(lambda service: service.cancel_occurrence(args.event_id, args.date))
+    else:
+        changes = {field: value for field, value in (('event_name', args.name), ('event_date', args.new_date),
+                                                     ('event_time', args.time), ('event_location', args.location))
+                   if value is not None}
+        if not changes:
+            print('Nothing to change, use --name, --new-date, --time or --location.')
+            return
+        event = run_with_service(lambda service: service.edit_occurrence(args.event_id, args.date, changes))
+    if event:
+        print(f'Event updated, repeats {rule_of(event).describe()}')
+
+
+def run_add_attendee(args):
+    values = {'name': args.name, 'surname': args.surname, 'email': args.email, 'phone': args.phone}
+    result = run_with_service(lambda service: service.add_attendee(args.event_id, values))
+    if result:
+        attendee, position = result
+        if position is None:
+            print('Attendee added: ' + ','.join(attendee.to_row()))
+        else:
+            print(f'The event is full, added to its waitlist as number {position}: ' + ','.join(attendee.to_row()))
+
+
+def run_list_attendees(args):
+    attendees = run_with_service(lambda service: (service.list_attendees(args.event_id),
+                                                  service.list_waitlist(args.event_id)))
+    if attendees:
+        registered, waiting = attendees
+        for attendee in registered:
+            print(','.join(attendee.to_row()))
+        for position, attendee in enumerate(waiting, start=1):
+            print(f'waitlist {position}: ' + ','.join(attendee.to_row()))
+
+
+def run_delete_attendee(args):
+    result = run_with_service(lambda service: service.delete_attendee(args.event_id, args.attendee_id))
+    if result:
+        attendee, promoted = result
+        print('Attendee deleted: ' + ','.join(attendee.to_row()))
+        for row in promoted:
+            print('Promoted from the waitlist: ' + ','.join(row.to_row()))
+
+
+def run_report(args):
+    report = get_reports()
+    if args.kind == 'events':
+        rows, fields = report.headcounts(args.type, args.top), HEADCOUNT_FIELDS
+    elif args.kind == 'types':
+        rows, fields = report.by_type(), TYPE_FIELDS
+    else:
+        rows, fields = report.by_month(args.type), MONTH_FIELDS
+    if args.output:
+        count = bulk.export_rows(rows, fields, args.output)
+        print(f'Wrote {count} rows to {args.output}')
+    else:
+        print(','.join(fields))
+        for row in rows:
+            print(','.join(map(str, row)))
+
+
+def run_serve(args):
+    service = EventService(get_event_store(), get_attendee_store(), get_waitlist_store())
+    server = make_server(service, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f'Serving the JSON API on http://{host}:{port} (Ctrl+C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()
+    close_stores()
+
+
+def run_shard(args):
+    # Split the attendees and the waitlist into args.count shards by event ID, or merge them back with 1
+    if args.count < 1:
+        print('The number of shards must be at least 1.')
+        return
+    for filename in (attendee_filename, waitlist_filename):
+        rows = reshard(filename, args.count)
+        print(f'{filename}: {rows} rows in {args.count} shard(s)' if args.count > 1 else f'{filename}: {rows} rows')
+
+
+def run_export(args):
+    if args.kind == 'events':
+        count = bulk.export_events(get_event_store(), args.filename)
+    else:
+        count = bulk.export_attendees(get_attendee_store(), args.filename)
+    print(f'Exported {count} {args.kind} to {args.filename}')
+
+
+def run_changes(args):
+    # Print the changes after --after as JSON lines, or stream them over a local socket with --serve
+    if args.serve:
+        server = serve_changes(get_changelog(), args.host, args.port)
+        host, port = server.server_address[:2]
+        print(f'Streaming the changelog on {host}:{port}, send the last sequence number seen (Ctrl+C to stop)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        return
+    try:
+        for line in get_changelog().lines(args.after, follow=args.follow):
+            print(line.decode().rstrip('\n'), flush=args.follow)
+    except KeyboardInterrupt:
+        pass
+
+
+def report_metrics(args):
+    # Runs on exit with --profile or --metrics
+    if args.metrics:
+        metrics.write(args.metrics)
+    if args.profile:
+        print('\nProfile (menu operations include the time spent waiting for input):')
+        print(metrics.summary())
+
+
 # calling the Menu to start the program:
 if __name__ == "__main__":  # checks if the script is being run directly as the main program or if it's being
     # imported as a module into another script
-    menu = Menu()  # instantiation of the Menu class
-    menu.display_menu()
+    parser = argparse.ArgumentParser(description='Event Management System')
+    parser.add_argument('--journal', action='store_true',
+                        help='append edits and deletes to a log instead of rewriting the CSV files')
+    parser.add_argument('--sqlite', metavar='DATABASE', help='use this SQLite database instead of the CSV files')
+    parser.add_argument('--profile', action='store_true', help='time every operation and print a summary on exit')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='time every operation and write the metrics to FILE on exit (Prometheus text, or JSON '
+                             'for a .json file)')
+    subparsers = parser.add_subparsers(dest='command')
+    import_parser = subparsers.add_parser('import', help='bulk load events or attendees from a CSV or JSONL file')
+    import_parser.add_argument('kind', choices=['events', 'attendees'])
+    import_parser.add_argument('filename', help='CSV file with a header row, or .jsonl with one object per line')
+    import_parser.add_argument('--chunk-size', type=int, default=10000, help='rows validated and written per batch')
+    import_parser.add_argument('--rejects', help='where to write rejected rows (default: <filename>.rejects.csv)')
+    dates_parser = subparsers.add_parser('dates', help='upcoming events, events in a date range or per-day counts')
+    dates_parser.add_argument('--from', dest='date_from', help='first day (DD/MM/YYYY)')
+    dates_parser.add_argument('--to', dest='date_to', help='last day (DD/MM/YYYY)')
+    dates_parser.add_argument('--week', action='store_true', help='the 7 days starting at --from (default: today)')
+    dates_parser.add_argument('--upcoming', type=int, default=10, help='how many upcoming events to show')
+    dates_parser.add_argument('--per-day', action='store_true', help='number of events per day instead of a list')
+    search_parser = subparsers.add_parser('search', help='find events by name, location or host, best matches first')
+    search_parser.add_argument('text', nargs='+')
+    search_parser.add_argument('--limit', type=int, default=20)
+    migrate_parser = subparsers.add_parser('migrate', help='copy events.csv and attendees.csv into a SQLite database')
+    migrate_parser.add_argument('database', help='SQLite file to create or fill, e.g. events.db')
+    delete_parser = subparsers.add_parser('delete-events', help='delete events and all of their attendees')
+    delete_parser.add_argument('event_ids', type=int, nargs='+', metavar='EVENT_ID')
+    show_parser = subparsers.add_parser('show-event', help='print one event')
+    show_parser.add_argument('event_id', type=int)
+    edit_parser = subparsers.add_parser('edit-event',
+                                        help='change the name, date, time, location, capacity or repeat of an event')
+    edit_parser.add_argument('event_id', type=int)
+    edit_parser.add_argument('--name')
+    edit_parser.add_argument('--date', help='DD/MM/YYYY')
+    edit_parser.add_argument('--time', help='HH:MM')
+    edit_parser.add_argument('--location')
+    edit_parser.add_argument('--capacity', help='most attendees allowed, an empty string for no limit')
+    edit_parser.add_argument('--repeat', choices=['daily', 'weekly', 'monthly', 'yearly', 'none'],
+                             help='make it a recurring event, or a one-off again with none')
+    edit_parser.add_argument('--every', type=int, default=1, help='repeat every N days/weeks/months/years')
+    edit_parser.add_argument('--count', type=int, help='number of occurrences')
+    edit_parser.add_argument('--until', help='last date of the repeat (DD/MM/YYYY)')
+    occurrences_parser = subparsers.add_parser('occurrences', help='the dates of a recurring event')
+    occurrences_parser.add_argument('event_id', type=int)
+    occurrences_parser.add_argument('--from', dest='date_from', help='first day (DD/MM/YYYY)')
+    occurrences_parser.add_argument('--to', dest='date_to', help='last day (DD/MM/YYYY)')
+    occurrences_parser.add_argument('--limit', type=int, default=100)
+    cancel_occurrence_parser = subparsers.add_parser('cancel-occurrence', help='cancel one date of a recurring event')
+    cancel_occurrence_parser.add_argument('event_id', type=int)
+    cancel_occurrence_parser.add_argument('date', help='its original date (DD/MM/YYYY)')
+    edit_occurrence_parser = subparsers.add_parser('edit-occurrence', help='change one date of a recurring event')
+    edit_occurrence_parser.add_argument('event_id', type=int)
+    edit_occurrence_parser.add_argument('date', help='its original date (DD/MM/YYYY)')
+    edit_occurrence_parser.add_argument('--name')
+    edit_occurrence_parser.add_argument('--new-date', help='move it to this date (DD/MM/YYYY)')
+    edit_occurrence_parser.add_argument('--time', help='HH:MM')
+    edit_occurrence_parser.add_argument('--location')
+    add_attendee_parser = subparsers.add_parser('add-attendee', help='register an attendee for an event')
+    add_attendee_parser.add_argument('event_id', type=int)
+    add_attendee_parser.add_argument('name')
+    add_attendee_parser.add_argument('surname')
+    add_attendee_parser.add_argument('email')
+    add_attendee_parser.add_argument('phone')
+    attendees_parser = subparsers.add_parser('attendees', help='list the attendees of an event')
+    attendees_parser.add_argument('event_id', type=int)
+    delete_attendee_parser = subparsers.add_parser('delete-attendee', help='remove an attendee from an event')
+    delete_attendee_parser.add_argument('event_id', type=int)
+    delete_attendee_parser.add_argument('attendee_id', type=int)
+    check_parser = subparsers.add_parser('check', help='find attendees of events that do not exist')
+    check_parser.add_argument('--fix', action='store_true',
+                              help='delete the orphaned attendees and the duplicate registrations')
+    lookup_parser = subparsers.add_parser('lookup', help='the events a person is registered for, by email or phone')
+    lookup_parser.add_argument('contact', help='email address or phone number')
+    report_parser = subparsers.add_parser('report', help='attendees per event, events and attendees per type or month')
+    report_parser.add_argument('kind', choices=['events', 'types', 'months'])
+    report_parser.add_argument('--type', help='only events of this type (events and months)')
+    report_parser.add_argument('--top', type=int, help='only the N events with the most attendees (events)')
+    report_parser.add_argument('--output', help='write the report to a CSV or JSONL file instead of printing it')
+    serve_parser = subparsers.add_parser('serve', help='serve the events and attendees as an HTTP JSON API')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    changes_parser = subparsers.add_parser('changes', help='the changelog of every add, edit and delete, as JSON lines')
+    changes_parser.add_argument('--after', type=int, default=0, help='only changes after this sequence number')
+    changes_parser.add_argument('--follow', action='store_true', help='keep printing new changes as they are made')
+    changes_parser.add_argument('--serve', action='store_true', help='stream the changes over a local socket instead')
+    changes_parser.add_argument('--host', default='127.0.0.1')
+    changes_parser.add_argument('--port', type=int, default=8001)
+    shard_parser = subparsers.add_parser('shard', help='split the attendees and the waitlist into files by event ID, '
+                                                       'for very large attendee sets (run it with no other sessions)')
+    shard_parser.add_argument('count', type=int, help='number of shards, e.g. the number of cores; 1 merges them back')
+    export_parser = subparsers.add_parser('export', help='write all events or attendees to a CSV or JSONL file')
+    export_parser.add_argument('kind', choices=['events', 'attendees'])
+    export_parser.add_argument('filename')
+    args = parser.parse_args()
+    journal_mode = args.journal
+    database_filename = args.sqlite
+    if args.profile or args.metrics:
+        metrics.enable()
+        atexit.register(report_metrics, args)
+    if args.command == 'import':
+        run_import(args)
+    elif args.command == 'export':
+        run_export(args)
+    elif args.command == 'shard':
+        run_shard(args)
+    elif args.command == 'changes':
+        run_changes(args)
+    elif args.command == 'dates':
+        run_dates(args)
+    elif args.command == 'search':
+        run_search(args)
+    elif args.command == 'migrate':
+        run_migrate(args)
+    elif args.command == 'delete-events':
+        run_delete_events(args)
+    elif args.command == 'show-event':
+        run_show_event(args)
+    elif args.command == 'edit-event':
+        run_edit_event(args)
+    elif args.command == 'occurrences':
+        run_occurrences(args)
+    elif args.command in ('cancel-occurrence', 'edit-occurrence'):
+        run_edit_occurrence(args)
+    elif args.command == 'add-attendee':
+        run_add_attendee(args)
+    elif args.command == 'attendees':
+        run_list_attendees(args)
+    elif args.command == 'delete-attendee':
+        run_delete_attendee(args)
+    elif args.command == 'check':
+        run_check(args)
+    elif args.command == 'lookup':
+        run_lookup(args)
+    elif args.command == 'report':
+        run_report(args)
+    elif args.command == 'serve':
+        run_serve(args)
+    else:
+        menu = Menu()  # instantiation of the Menu class
+        menu.display_menu()
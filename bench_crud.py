@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from generate_data import write_dataset
+from service import EventService
+from storage import SqliteDatabase, migrate_csv_to_sqlite
+from store import AttendeeStore, EventStore
+
+# CRUD benchmark: generates a synthetic dataset of each size (see generate_data.py), opens it the way the program does
+# and times the non-interactive versions of the menu operations through EventService, one call at a time. Reports
+# the latency percentiles and throughput of each operation and saves them as JSON; --baseline compares a run with an
+# earlier one.
+# Edits and deletes of the plain CSV files rewrite the whole file, so on a large dataset each operation stops after
+# --budget seconds and reports however many calls it made.
+
+OPERATIONS = ['display_individual_event', 'list_attendees_to_an_event', 'add_attendee', 'edit_event',
+              'delete_attendee_from_event', 'delete_event']
+
+
+def open_service(directory, backend):
+    if backend == 'sqlite':
+        database_filename = os.path.join(directory, 'events.db')
+        migrate_csv_to_sqlite(os.path.join(directory, 'events.csv'), os.path.join(directory, 'attendees.csv'),
+                              database_filename)
+        database = SqliteDatabase(database_filename)
+        stores = (EventStore(table=database.table('events')), AttendeeStore(table=database.table('attendees')),
+                  AttendeeStore(table=database.table('waitlist')))
+    else:
+        journaled = backend == 'journal'
+        database = None
+        stores = (EventStore(os.path.join(directory, 'events.csv'), journaled),
+                  AttendeeStore(os.path.join(directory, 'attendees.csv'), journaled),
+                  AttendeeStore(os.path.join(directory, 'waitlist.csv'), journaled))
+    return EventService(*stores), stores, database
+
+
+def take(ids):
+    # a random ID out of the list, swapped with the last one first so taking it is O(1) on a large list
+    position = random.randrange(len(ids))
+    ids[position], ids[-1] = ids[-1], ids[position]
+    return ids.pop()
+
+
+def make_calls(service, operation, event_ids, attendee_ids):
+    # An endless supply of calls for one operation, each a function without arguments. IDs are picked at random,
+    # the deletes take theirs out of the lists so every call deletes something.
+    number = 0
+    while True:
+        number += 1
+        event_id = take(event_ids) if operation == 'delete_event' else random.choice(event_ids)
+        if operation == 'display_individual_event':
+            yield lambda: service.get_event(event_id)
+        elif operation == 'list_attendees_to_an_event':
+            yield lambda: service.list_attendees(event_id)
+        elif operation == 'add_attendee':
+            values = {'name': 'Bench', 'surname': f'Mark{number}', 'email': f'bench{number}@example.com',
+                      'phone': f'09{number:09d}'}
+            yield lambda: service.add_attendee(event_id, values)
+        elif operation == 'edit_event':
+            yield lambda: service.edit_event(event_id, {'event_name': f'renamed {number}'})
+        elif operation == 'delete_attendee_from_event':
+            attendee = service.attendees.get(take(attendee_ids))
+            yield lambda: service.delete_attendee(attendee.event_id, attendee.attendee_id)
+        else:
+            yield lambda: service.delete_event(event_id)
+
+
+def percentile(latencies, fraction):
+    # nearest rank, latencies sorted
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def time_operation(calls, count, budget):
+    latencies = []
+    started = time.perf_counter()
+    for call in calls:
+        if len(latencies) >= count or time.perf_counter() - started > budget:
+            break
+        before = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - before)
+    total = time.perf_counter() - started
+    if not latencies:  # no call finished within the budget, or there was nothing to call
+        return {'calls': 0, 'p50_ms': 0.0, 'p90_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0, 'mean_ms': 0.0,
+                'ops_per_second': 0.0}
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'ops_per_second': len(latencies) / total,
+    }
+
+
+def run_size(event_count, args):
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        events, attendees = write_dataset(directory, event_count, args.fanout, args.seed)
+        generated = time.perf_counter() - started
+        started = time.perf_counter()
+        service, stores, database = open_service(directory, args.backend)
+        loaded = time.perf_counter() - started
+        print(f'{events} events, {attendees} attendees: generated in {generated:.1f}s, loaded in {loaded:.1f}s')
+        result = {'events': events, 'attendees': attendees, 'load_seconds': loaded, 'operations': {}}
+        random.seed(args.seed)
+        event_ids = list(service.events.rows)
+        attendee_ids = list(service.attendees.rows)
+        for operation in OPERATIONS:
+            stats = time_operation(make_calls(service, operation, event_ids, attendee_ids), args.operations,
+                                   args.budget)
+            result['operations'][operation] = stats
+            print(f'  {operation:<28}{stats["calls"]:>6} calls  p50 {stats["p50_ms"]:>9.3f} ms  '
+                  f'p90 {stats["p90_ms"]:>9.3f} ms  p99 {stats["p99_ms"]:>9.3f} ms  '
+                  f'{stats["ops_per_second"]:>10,.0f} ops/s')
+        service.close()
+        for store in stores:
+            store.close()
+        if database is not None:
+            database.close()
+    return result
+
+
+def compare(results, baseline_filename):
+    with open(baseline_filename) as file:
+        baseline = json.load(file)['results']
+    print(f'Compared with {baseline_filename} (p50 latency, >1.00x is slower now):')
+    for size, result in results.items():
+        for operation, stats in result['operations'].items():
+            before = baseline.get(size, {}).get('operations', {}).get(operation)
+            if before and before['p50_ms'] and stats['calls']:
+                print(f'  {size:>8} {operation:<28}{stats["p50_ms"] / before["p50_ms"]:>8.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and throughput of the CRUD operations at several sizes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000], help='numbers of events')
+    parser.add_argument('--fanout', type=float, default=3.0, help='average number of attendees per event')
+    parser.add_argument('--backend', choices=['csv', 'journal', 'sqlite'], default='csv')
+    parser.add_argument('--operations', type=int, default=1000, help='calls per operation')
+    parser.add_argument('--budget', type=float, default=20.0, help='at most this many seconds per operation')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_crud.json')
+    parser.add_argument('--baseline', help='an earlier --output file to compare with')
+    args = parser.parse_args()
+
+    results = {str(size): run_size(size, args) for size in args.sizes}
+    with open(args.output, 'w') as file:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0],
+                   'platform': platform.platform(), 'backend': args.backend, 'fanout': args.fanout,
+                   'seed': args.seed, 'results': results}, file, indent=2)
+    print(f'Results saved to {args.output}')
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import csv
+import gc
+import io
+import random
+import tracemalloc
+
+from EC_EventManagement_Final2 import Attendee, Birthday, Business, Wedding
+from records import AttendeeRecord, EventRecord
+
+# Memory benchmark: bytes per record for the ways an event or attendee row has been held in memory.
+#   csv rows       - the lists of strings csv.reader returns, what the stores kept before the record types
+#   Event objects  - Wedding/Birthday/Business and Attendee instances (property-based, with a __dict__ each)
+#   records        - the __slots__ EventRecord/AttendeeRecord the stores use now
+# Every variant parses the same CSV text, so the strings it keeps are counted as well.
+
+EVENT_CLASSES = {'wedding': Wedding, 'birthday': Birthday, 'business': Business}
+
+
+def make_csv(kind, count, seed=1):
+    random.seed(seed)
+    locations = [f'venue {number}' for number in range(1000)]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record_id in range(1, count + 1):
+        if kind == 'events':
+            event_type = random.choice(list(EVENT_CLASSES))
+            writer.writerow([record_id, event_type, f'{event_type} of person {record_id}',
+                             f'{random.randint(1, 28):02d}/{random.randint(1, 12):02d}/{random.randint(2023, 2026)}',
+                             f'{random.randint(8, 22):02d}:{random.choice(["00", "15", "30", "45"])}',
+                             random.choice(locations), f'person {record_id}'])
+        else:
+            writer.writerow([record_id, f'name{record_id}', f'surname{record_id}', f'mail{record_id}@example.com',
+                             f'07{record_id:09d}', random.randint(1, count // 10 + 1)])
+    return buffer.getvalue()
+
+
+def event_object(row):
+    return EVENT_CLASSES[row[1]](row[0], row[2], row[3], row[4], row[5], row[6])
+
+
+def attendee_object(row):
+    return Attendee(*row)
+
+
+def bytes_per_record(text, make):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = [make(row) for row in csv.reader(io.StringIO(text))]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bytes per in-memory record, before and after the record types')
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+    variants = {
+        'events': [('csv rows', list), ('Event objects', event_object), ('EventRecord', EventRecord.from_row)],
+        'attendees': [('csv rows', list), ('Attendee objects', attendee_object),
+                      ('AttendeeRecord', AttendeeRecord.from_row)],
+    }
+    for kind, makers in variants.items():
+        text = make_csv(kind, args.rows)
+        print(f'{kind} ({args.rows} rows)')
+        for label, make in makers:
+            print(f'  {label:<18}{bytes_per_record(text, make):>8.0f} bytes/record')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import csv
+import gc
+import os
+import tempfile
+import time
+
+from csv_reader import read_table
+from generate_data import write_dataset
+from records import AttendeeRecord, EventRecord
+
+# Parsing benchmark: reads a synthetic events.csv and attendees.csv (see generate_data.py) the way the original script
+# did, list(csv.reader(...)) with int(row[0]) for each row's ID and the rows kept as lists of strings, and with
+# csv_reader.read_table, and checks that both read the same rows.
+
+
+def read_original(filename, record_type):
+    with open(filename, 'r', newline='') as csvfile:
+        return {int(row[0]): row for row in list(csv.reader(csvfile))}
+
+
+def timed(read, filename, record_type):
+    gc.collect()
+    started = time.perf_counter()
+    rows = read(filename, record_type)
+    return time.perf_counter() - started, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time reading the CSV files, before and after csv_reader')
+    parser.add_argument('--events', type=int, default=300000)
+    parser.add_argument('--fanout', type=float, default=3.0, help='average number of attendees per event')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        write_dataset(directory, args.events, args.fanout)
+        for name, record_type in (('events.csv', EventRecord), ('attendees.csv', AttendeeRecord)):
+            filename = os.path.join(directory, name)
+            before, old_rows = timed(read_original, filename, record_type)
+            # the original rows are strings, compared as records (not timed): the same IDs, fields and values
+            old_rows = {record_id: record_type.from_row(row) for record_id, row in old_rows.items()}
+            after, rows = timed(read_table, filename, record_type)
+            same = rows == old_rows
+            del old_rows
+            print(f'{name:<14}{len(rows):>9} rows   csv.reader {before:6.2f}s   read_table {after:6.2f}s   '
+                  f'{before / after:4.2f}x the speed{"" if same else "   DIFFERENT RESULTS"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import random
+import time
+
+from generate_data import COMPANIES, FIRST_NAMES, OCCASIONS, PLACES, SURNAMES, VENUES
+from records import EventRecord
+from search_index import SearchIndex
+
+# Search benchmark: builds the index over a synthetic catalog and times a few typical queries, exact, as-you-type
+# prefixes, typos and several words.
+
+QUERIES = ['tesla halloween party', 'tesla hallo', 'halowen', 'smith', 'wedding of mary', 'christmas london',
+           'hackaton berlin', 'elon musk', 'gar', 'stadium']
+
+
+def make_events(count, seed=1):
+    random.seed(seed)
+    events = []
+    for event_id in range(1, count + 1):
+        event_type = random.choice(['wedding', 'birthday', 'business'])
+        person = f'{random.choice(FIRST_NAMES)} {random.choice(SURNAMES)}'
+        if event_type == 'business':
+            name = f'{random.choice(COMPANIES)} {random.choice(OCCASIONS)}'
+        else:
+            name = f'{event_type} of {person}'
+        location = f'{random.choice(VENUES)} {random.randint(1, 500)} {random.choice(PLACES)}'
+        events.append(EventRecord(event_id, event_type, name, '01/01/2030', '10:00', location, person))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time building the search index and searching it')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    rows = {event.event_id: event for event in make_events(args.rows)}
+    index = SearchIndex()
+    started = time.perf_counter()
+    index.search('', rows)  # builds the index
+    print(f'{args.rows} events, index built in {time.perf_counter() - started:.2f}s')
+    for query in QUERIES:
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            results = index.search(query, rows, limit=20)
+        elapsed = (time.perf_counter() - started) / args.repeat
+        best = rows[results[0][0]].event_name if results else '-'
+        print(f'  {query!r:<26}{elapsed * 1000:>9.1f} ms   top: {best}')
+
+
+if __name__ == '__main__':
+    main()
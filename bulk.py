@@ -0,0 +1,263 @@
+import csv
+import json
+import time
+from operator import itemgetter
+
+import metrics
+from contact_index import is_valid_email, is_valid_phone
+from records import parse_date, parse_time
+from recurrence import Recurrence
+from store import register_attendees
+
+# Column order of the two CSV files
+EVENT_FIELDS = ['event_id', 'event_type', 'event_name', 'event_date', 'event_time', 'event_location', 'owner',
+                'capacity', 'recurrence']
+ATTENDEE_FIELDS = ['attendee_id', 'name', 'surname', 'email', 'phone', 'event_id']
+# Fields read from an import file, IDs are always assigned on import
+EVENT_INPUT_FIELDS = EVENT_FIELDS[1:]
+ATTENDEE_INPUT_FIELDS = ATTENDEE_FIELDS[1:]
+
+EVENT_TYPES = ('wedding', 'birthday', 'business')
+
+
+class RejectedRow(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+# ImportReport is returned by import_events/import_attendees: how many rows went in, how many were rejected and how
+# fast.
+class ImportReport:
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.accepted = 0
+        self.waitlisted = 0  # of the accepted attendees, those put on the waitlist of a full event
+        self.rejected = 0
+        self.seconds = 0.0
+        self.rejects_filename = None
+
+    @property
+    def rows_per_second(self):
+        return (self.accepted + self.rejected) / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        text = (f'Imported {self.accepted} {self.kind}'
+                + (f' ({self.waitlisted} of them on a waitlist)' if self.waitlisted else '')
+                + f', rejected {self.rejected} in {self.seconds:.2f}s ({self.rows_per_second:,.0f} rows/s)')
+        if self.rejected:
+            text += f'\nRejected rows written to {self.rejects_filename}'
+        return text
+
+
+def is_jsonl(filename):
+    return filename.endswith('.jsonl') or filename.endswith('.json')
+
+
+def read_records(filename, fields):
+    # Stream (line number, values) pairs from a CSV file with a header row, or from a JSONL file with one object per
+    # line. values holds the given fields in order (missing ones are ''), or is None if the line can't be parsed.
+    with open(filename, 'r', newline='') as file:
+        if is_jsonl(filename):
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if isinstance(record, dict):
+                    yield line_number, [field_text(record.get(field)) for field in fields]
+                else:
+                    yield line_number, None
+        else:
+            reader = csv.reader(file)
+            header = [column.strip().lower() for column in next(reader, [])]
+            positions = [header.index(field) if field in header else None for field in fields]
+            for row in reader:
+                if not row:
+                    continue
+                yield reader.line_num, [row[i].strip() if i is not None and i < len(row) else '' for i in positions]
+
+
+def field_text(value):
+    # A JSON value as the text of a column; an object (a recurrence rule) stays JSON, and only a missing value or null
+    # is empty (0 is kept, so that it's rejected as a capacity rather than read as no limit)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'))
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+def _missing(fields, values):
+    for field, value in zip(fields, values):
+        if not value:
+            raise RejectedRow(f'missing {field}')
+
+
+def validate_event(values):
+    # Turn input values into an event row without its ID, the same clean-up as Wedding/Birthday/Business.add_event
+    event_type, event_name, event_date, event_time, event_location, owner, capacity, recurrence = values
+    event_type = event_type.lower()
+    if event_type not in EVENT_TYPES:
+        raise RejectedRow(f'unknown event_type {event_type!r}')
+    if not parse_date(event_date):
+        raise RejectedRow(f'invalid event_date {event_date!r}, expected DD/MM/YYYY')
+    if not parse_time(event_time):
+        raise RejectedRow(f'invalid event_time {event_time!r}, expected HH:MM')
+    _missing(('event_location', 'owner'), (event_location, owner))
+    if capacity and not (capacity.isdigit() and int(capacity) > 0):
+        raise RejectedRow(f'invalid capacity {capacity!r}, expected a whole number of at least 1 or nothing')
+    if recurrence:
+        recurrence = validate_recurrence(recurrence, event_date)
+    owner = owner.replace(',', '')
+    if not event_name:
+        if event_type == 'business':
+            raise RejectedRow('missing event_name')
+        event_name = f'{event_type} of {owner}'
+    return [event_type, event_name, event_date, event_time, event_location.lower().replace(',', ''), owner,
+            str(int(capacity)) if capacity else '', recurrence]
+
+
+def validate_recurrence(text, event_date):
+    # The recurrence column of an event starting on event_date, in its compact form, see recurrence.py
+    try:
+        rule = Recurrence.from_text(text)
+    except ValueError as e:
+        raise RejectedRow(str(e))
+    if rule.until is not None and parse_date(rule.until) < parse_date(event_date):
+        raise RejectedRow(f'the repeat ends ({rule.until}) before the event starts ({event_date})')
+    return rule.to_text()
+
+
+def validate_attendee(values, event_store):
+    name, surname, email, phone, event_id = values
+    if not (name and surname and email and phone):
+        _missing(ATTENDEE_INPUT_FIELDS, values)
+    if not is_valid_email(email):
+        raise RejectedRow(f'invalid email {email!r}')
+    if not is_valid_phone(phone):
+        raise RejectedRow(f'invalid phone {phone!r}')
+    if not event_id.isdigit() or int(event_id) not in event_store:
+        raise RejectedRow(f'event {event_id} not found')
+    values[4] = str(int(event_id))
+    return values
+
+
+def _import(filename, fields, store, validate, kind, chunk_size, rejects_filename, register=None, waitlist=None):
+    report = ImportReport(kind)
+    report.rejects_filename = rejects_filename or filename + '.rejects.csv'
+    started = time.perf_counter()
+    rejects_file = None
+    rejects_writer = None
+    chunk = []
+    chunk_lines = []
+    # (line number, reason, values) rejected since the last flush. The duplicates of a chunk are only known once it's
+    # flushed, so they're written together, in line order.
+    rejected = []
+
+    def reject(line_number, reason, values):
+        rejected.append((line_number, reason, values))
+        report.rejected += 1
+
+    def write_rejects():
+        nonlocal rejects_file, rejects_writer
+        if not rejected:
+            return
+        if rejects_writer is None:
+            rejects_file = open(report.rejects_filename, 'w', newline='')
+            rejects_writer = csv.writer(rejects_file)
+            rejects_writer.writerow(['line', 'reason'] + fields)
+        rejected.sort(key=itemgetter(0))
+        rejects_writer.writerows([line_number, reason] + (values or []) for line_number, reason, values in rejected)
+        rejected.clear()
+
+    def flush():
+        # IDs are reserved for the whole chunk at once and the rows are written with a single batch write
+        for new_id, row in zip(store.ids.allocate(len(chunk)), chunk):
+            row.insert(0, str(new_id))
+        if register is not None:
+            # duplicates of rows already stored or earlier in the chunk are dropped in the same pass that adds
+            admitted, waitlisted = register(chunk)
+            added = {row.attendee_id for row in admitted + waitlisted}
+            for line_number, row in zip(chunk_lines, chunk):
+                if int(row[0]) not in added:
+                    duplicate = store.find_duplicate(row) or waitlist.find_duplicate(row)
+                    reject(line_number, f'already registered as attendee {duplicate[0] if duplicate else "?"}',
+                           row[1:])
+            report.accepted += len(added)
+            report.waitlisted += len(waitlisted)
+        else:
+            store.add_many(chunk)
+            report.accepted += len(chunk)
+        chunk.clear()
+        chunk_lines.clear()
+        write_rejects()
+
+    try:
+        for line_number, values in read_records(filename, fields):
+            try:
+                if values is None:
+                    raise RejectedRow('not a valid JSON object')
+                chunk.append(validate(values))
+                chunk_lines.append(line_number)
+            except RejectedRow as e:
+                reject(line_number, str(e), values)
+                if not chunk and len(rejected) >= chunk_size:
+                    write_rejects()  # no earlier line can still turn out to be a duplicate
+                continue
+            if len(chunk) >= chunk_size:
+                flush()
+        if chunk:
+            flush()
+        write_rejects()
+    finally:
+        if rejects_file is not None:
+            rejects_file.close()
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+@metrics.timed('import.events')
+def import_events(filename, event_store, chunk_size=10000, rejects_filename=None):
+    return _import(filename, EVENT_INPUT_FIELDS, event_store, validate_event, 'events', chunk_size, rejects_filename)
+
+
+@metrics.timed('import.attendees')
+def import_attendees(filename, attendee_store, event_store, waitlist, chunk_size=10000, rejects_filename=None):
+    # every attendee must point at an event that exists in event_store. Its shared lock is held for the whole import,
+    # so other sessions can't delete those events meanwhile. People already registered for the event (same email or
+    # phone, in the store, on its waitlist or earlier in the file) are rejected as duplicates, and attendees of full
+    # events go on the waitlist (see store.register_attendees).
+    with event_store.reading():
+        return _import(filename, ATTENDEE_INPUT_FIELDS, attendee_store,
+                       lambda values: validate_attendee(values, event_store), 'attendees', chunk_size,
+                       rejects_filename,
+                       lambda rows: register_attendees(event_store, attendee_store, waitlist, rows), waitlist)
+
+
+@metrics.timed('export')
+def export_rows(rows, fields, filename):
+    # Write rows to CSV (with a header) or JSONL, depending on the file extension. Returns the number of rows written.
+    count = 0
+    with open(filename, 'w', newline='') as file:
+        if is_jsonl(filename):
+            for row in rows:
+                file.write(json.dumps(dict(zip(fields, row))) + '\n')
+                count += 1
+        else:
+            writer = csv.writer(file)
+            writer.writerow(fields)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    return count
+
+
+def export_events(event_store, filename):
+    return export_rows(event_store, EVENT_FIELDS, filename)
+
+
+def export_attendees(attendee_store, filename):
+    return export_rows(attendee_store, ATTENDEE_FIELDS, filename)
@@ -0,0 +1,211 @@
+import json
+import os
+import socket
+import socketserver
+import time
+from datetime import datetime
+
+import metrics
+from file_lock import FileLock, file_stamp
+
+# Operations recorded in the changelog
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+# Changelog is an append-only log of every change made to the events, attendees and waitlist (changes.log), for
+# downstream systems (ticketing, emails) that need to know what changed without re-reading and diffing the CSV files.
+# Each change is one JSON line:
+#   {"seq": 42, "time": "2024-03-01T10:15:30.123", "table": "attendees", "op": "insert", "id": 152, "row": {...}}
+# with the full row as it is after an insert or update and as it was before a delete. Sequence numbers go up by one
+# for every change, across all tables and all sessions: they're handed out under the changelog's exclusive file lock,
+# and the stores record their changes while they still hold their own exclusive lock, so the order of the log is the
+# order the changes were made in (with --sqlite the database coordinates the writers instead of the file locks, and
+# changes that different sessions make at the same moment may be logged in either order). A change is recorded after
+# the table has saved it, so a crash in between can lose the record of a change but never records one that didn't
+# happen.
+# Consumers keep the last sequence number they processed and read on from there with read(after), from Python, or
+# over a local socket (see serve and subscribe).
+class Changelog:
+
+    def __init__(self, filename='changes.log'):
+        self.filename = filename
+        self.lock = FileLock(filename)
+        self.last_seq = 0
+        self.stamp = None  # the file as this session last wrote it, None: not written yet
+
+    def table(self, name):
+        return TableLog(self, name)
+
+    @metrics.timed('changelog.append')
+    def append(self, table, op, rows):
+        if not rows:
+            return
+        with self.lock.exclusive():
+            if file_stamp(self.filename) != self.stamp:  # another session appended since, carry on from its last one
+                self._repair()
+                self.last_seq = self.last()
+            now = datetime.now().isoformat(timespec='milliseconds')
+            lines = []
+            for row in rows:
+                self.last_seq += 1
+                lines.append(json.dumps({'seq': self.last_seq, 'time': now, 'table': table, 'op': op, 'id': row[0],
+                                         'row': row.to_dict()}) + '\n')
+            text = ''.join(lines)
+            with open(self.filename, 'a') as file:  # one write per batch, so a crash can only cut the last line
+                file.write(text)
+            metrics.count('changes_recorded', len(lines), table=table)
+            metrics.count('bytes_written', len(text), table=os.path.basename(self.filename))
+            self.stamp = file_stamp(self.filename)
+
+    def _repair(self):
+        # Cut off a last line left unfinished by a crash, readers never returned it (see lines)
+        try:
+            with open(self.filename, 'rb+') as file:
+                end = _last_complete_line(file)[1]
+                if end < file.seek(0, os.SEEK_END):
+                    file.truncate(end)
+        except FileNotFoundError:
+            pass
+
+    def read(self, after=0, follow=False, poll_interval=0.2):
+        # The changes with a sequence number above `after`, oldest first, as dicts. With follow it doesn't stop at
+        # the end of the log but waits for new changes.
+        for line in self.lines(after, follow, poll_interval):
+            yield json.loads(line)
+
+    def lines(self, after=0, follow=False, poll_interval=0.2):
+        # The same as raw JSON lines (bytes, with the newline). The first one is found by a binary search on the
+        # file, the sequence numbers are in file order, so starting near the end of a large log reads only the end.
+        while True:
+            try:
+                file = open(self.filename, 'rb')
+                break
+            except FileNotFoundError:
+                if not follow:
+                    return
+                time.sleep(poll_interval)
+        with file:
+            file.seek(_first_line_after(file, after))
+            while True:
+                position = file.tell()
+                line = file.readline()
+                if line.endswith(b'\n'):
+                    yield line
+                elif follow:  # the end of the log, or a line still being written
+                    file.seek(position)
+                    time.sleep(poll_interval)
+                else:
+                    return
+
+    def last(self):
+        # The sequence number of the latest change, 0 before the first one
+        try:
+            with open(self.filename, 'rb') as file:
+                start, end = _last_complete_line(file)
+                file.seek(start)
+                return json.loads(file.read(end - start))['seq'] if end else 0
+        except FileNotFoundError:
+            return 0
+
+    def close(self):
+        self.lock.close()
+
+
+# TableLog is what a store records its changes through (EventStore and AttendeeStore take one as changelog=): the
+# changelog and the name of the store's table, 'events', 'attendees' or 'waitlist'.
+class TableLog:
+
+    def __init__(self, changelog, name):
+        self.changelog = changelog
+        self.name = name
+
+    def record(self, op, rows):
+        self.changelog.append(self.name, op, rows)
+
+
+def _last_complete_line(file):
+    # (start, end) byte offsets of the last line that ends with a newline, (0, 0) when there's none. Reads back from
+    # the end of the file, not the whole log.
+    position = file.seek(0, os.SEEK_END)
+    tail = b''
+    while position > 0:
+        step = min(4096, position)
+        position -= step
+        file.seek(position)
+        tail = file.read(step) + tail
+        end = tail.rfind(b'\n')
+        if end < 0:
+            continue
+        start = tail.rfind(b'\n', 0, end)
+        if start >= 0 or position == 0:
+            return position + start + 1, position + end + 1
+    return 0, 0
+
+
+def _first_line_after(file, after):
+    # Byte offset of the first complete line with a sequence number above `after` (the end of the file if there's
+    # none). Binary search over byte offsets m for the first one whose next line start qualifies.
+    size = file.seek(0, os.SEEK_END)
+
+    def line_start(offset):
+        if offset == 0:
+            return 0
+        file.seek(offset - 1)
+        file.readline()
+        return file.tell()
+
+    def qualifies(offset):
+        file.seek(line_start(offset))
+        line = file.readline()
+        return not line.endswith(b'\n') or json.loads(line)['seq'] > after
+
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        if qualifies(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return line_start(low)
+
+
+# Serving the changelog over a local socket: a consumer connects, sends the last sequence number it has processed (a
+# line with the number, 0 for everything), and receives every change after it as JSON lines, followed by new changes
+# as they're made, until it disconnects.
+class _ChangeStreamHandler(socketserver.StreamRequestHandler):
+    changelog = None  # set by serve
+
+    def handle(self):
+        try:
+            after = int(self.rfile.readline().strip() or 0)
+        except ValueError:
+            self.wfile.write(b'{"error": "send the last sequence number seen, 0 for all changes"}\n')
+            return
+        try:
+            for line in self.changelog.lines(after, follow=True):
+                self.wfile.write(line)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the consumer went away
+
+
+class _ChangeStreamServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True  # consumers following the log don't keep the program from exiting
+
+
+def serve(changelog, host='127.0.0.1', port=8001):
+    # A server streaming the changelog, one thread per consumer; call serve_forever() on it
+    handler = type('ChangeStreamHandler', (_ChangeStreamHandler,), {'changelog': changelog})
+    return _ChangeStreamServer((host, port), handler)
+
+
+def subscribe(host='127.0.0.1', port=8001, after=0):
+    # The client side of serve: yields the changes after `after` as dicts, then waits for new ones
+    with socket.create_connection((host, port)) as connection:
+        connection.sendall(f'{after}\n'.encode())
+        with connection.makefile('rb') as stream:
+            for line in stream:
+                yield json.loads(line)
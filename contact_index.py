@@ -0,0 +1,123 @@
+import re
+
+EMAIL = re.compile(r'[^@\s]+@[^@\s]+\.[a-z]{2,}')
+NOT_DIGITS = re.compile(r'\D')
+PHONE = re.compile(r'[\d\s()+\-.]+')
+MIN_PHONE_DIGITS = 7
+EVENT_BITS = 32  # each entry is (attendee_id << 32) | event_id
+EVENT_MASK = (1 << EVENT_BITS) - 1
+
+
+def normalize_email(email):
+    # Emails are compared trimmed and lower-cased. The result is the key of the email index, even for the old rows that
+    # don't hold a real address. Already normalized emails are returned as they are, so the index shares the string
+    # with the row instead of keeping a copy.
+    normalized = email.strip().lower()
+    return email if normalized == email else normalized
+
+
+def normalize_phone(phone):
+    # Phones are compared by their digits only, with the 00 international prefix dropped: +44 7422 569874,
+    # 0044-7422-569874 and 447422569874 are the same number
+    digits = phone if phone.isdigit() else NOT_DIGITS.sub('', phone)
+    return digits[2:] if digits.startswith('00') else digits
+
+
+def is_valid_email(email):
+    return EMAIL.fullmatch(normalize_email(email)) is not None
+
+
+def is_valid_phone(phone):
+    return PHONE.fullmatch(phone.strip()) is not None and len(normalize_phone(phone)) >= MIN_PHONE_DIGITS
+
+
+# ContactIndex maps each normalized email and phone to the attendees registered with it, so finding every event a
+# person attends, or whether they're already registered for an event, is a dict lookup instead of a scan of the whole
+# attendees file. A person is the same if either the email or the phone matches.
+# Values are a single packed int for the usual one registration per email or phone, and a list only for the people
+# registered more than once, which keeps the index small for a large file.
+class ContactIndex:
+
+    def __init__(self):
+        self.build(())
+
+    def build(self, attendees):
+        self.by_email = {}
+        self.by_phone = {}
+        self.add_many(attendees)
+
+    def add_many(self, attendees):
+        by_email = self.by_email
+        by_phone = self.by_phone
+        for attendee in attendees:
+            entry = (attendee.attendee_id << EVENT_BITS) | attendee.event_id
+            for index, key in ((by_email, normalize_email(attendee.email)),
+                               (by_phone, normalize_phone(attendee.phone))):
+                if not key:
+                    continue  # nothing to match on
+                entries = index.get(key)
+                if entries is None:
+                    index[key] = entry
+                elif type(entries) is list:
+                    entries.append(entry)
+                else:
+                    index[key] = [entries, entry]
+
+    def remove(self, attendee):
+        entry = (attendee.attendee_id << EVENT_BITS) | attendee.event_id
+        _remove(self.by_email, normalize_email(attendee.email), entry)
+        _remove(self.by_phone, normalize_phone(attendee.phone), entry)
+
+    def registrations(self, email=None, phone=None):
+        # [(attendee_id, event_id)] registered with the email or the phone
+        entries = []
+        if email:
+            entries += _entries(self.by_email, normalize_email(email))
+        if phone:
+            entries += _entries(self.by_phone, normalize_phone(phone))
+        return [(entry >> EVENT_BITS, entry & EVENT_MASK) for entry in dict.fromkeys(entries)]
+
+    def find_duplicate(self, attendee):
+        # ID of another attendee of the same event with the same email or phone, or None
+        for index, key in ((self.by_email, normalize_email(attendee.email)),
+                           (self.by_phone, normalize_phone(attendee.phone))):
+            for entry in _entries(index, key):
+                if entry & EVENT_MASK == attendee.event_id and entry >> EVENT_BITS != attendee.attendee_id:
+                    return entry >> EVENT_BITS
+        return None
+
+    def duplicates(self):
+        # {attendee_id: ID of the first registration of the same person for the same event} over the whole index,
+        # in one pass over the emails and phones that have more than one registration
+        found = {}
+        for index in (self.by_email, self.by_phone):
+            for entries in index.values():
+                if type(entries) is not list:
+                    continue
+                first = {}
+                for entry in sorted(entries):
+                    attendee_id = entry >> EVENT_BITS
+                    original = first.setdefault(entry & EVENT_MASK, attendee_id)
+                    if original != attendee_id and attendee_id not in found:
+                        found[attendee_id] = found.get(original, original)
+        return found
+
+
+def _remove(index, key, entry):
+    entries = index.get(key)
+    if entries is None:
+        return
+    if type(entries) is list:
+        if entry in entries:
+            entries.remove(entry)
+        if len(entries) == 1:
+            index[key] = entries[0]
+    elif entries == entry:
+        del index[key]
+
+
+def _entries(index, key):
+    entries = index.get(key)
+    if entries is None:
+        return []
+    return entries if type(entries) is list else [entries]
@@ -0,0 +1,117 @@
+from bisect import bisect_left, insort
+from datetime import date, datetime, timedelta
+
+from records import parse_date, parse_time
+
+MINUTES_PER_DAY = 24 * 60
+ID_BITS = 32  # event IDs are packed into the low bits of each key
+ID_MASK = (1 << ID_BITS) - 1
+
+
+def _stamp(day, hour=0, minute=0):  # minutes since 01/01/0001
+    return day.toordinal() * MINUTES_PER_DAY + hour * 60 + minute
+
+
+# DateIndex keeps the events sorted by (date, time), so date-range queries, the next N upcoming events and per-day
+# counts are a binary search plus the k matching entries, rather than a scan of every event.
+# Each key is one int, (minutes since 01/01/0001 << 32) | event_id, which sorts by date, then time, then ID, and
+# takes far less memory than a tuple of datetime and ID.
+class DateIndex:
+
+    def __init__(self):
+        self.keys = []  # sorted
+        self.key_by_id = {}  # event_id -> its key, needed to find the entry again on remove
+        self.malformed = {}  # event_id -> (date, time) text that couldn't be parsed, these aren't indexed
+        # The same few thousand dates and times repeat across the whole file, so each text is parsed only once
+        self.day_cache = {}  # 'DD/MM/YYYY' -> day ordinal, or None if it isn't a real date
+        self.minute_cache = {'': 0}  # 'HH:MM' -> minutes since midnight, a missing time counts as midnight
+
+    def _key(self, event):
+        if event.recurrence:
+            return None  # a recurring event has no single date, see recurrence.SeriesIndex
+        event_id = event.event_id
+        date_text = event.event_date
+        time_text = event.event_time
+        try:
+            day = self.day_cache[date_text]
+        except KeyError:
+            day = parse_date(date_text)
+            day = self.day_cache[date_text] = day.toordinal() if day else None
+        try:
+            minutes = self.minute_cache[time_text]
+        except KeyError:
+            event_time = parse_time(time_text)
+            minutes = self.minute_cache[time_text] = event_time.hour * 60 + event_time.minute if event_time else None
+        if day is None or minutes is None:
+            self.malformed[event_id] = (date_text, time_text)
+            return None
+        return ((day * MINUTES_PER_DAY + minutes) << ID_BITS) | event_id
+
+    def build(self, events):
+        # Index a whole table at once, one sort is cheaper than inserting the events one by one
+        self.keys = []
+        self.key_by_id = {}
+        self.malformed = {}
+        for event in events:
+            key = self._key(event)
+            if key is not None:
+                self.key_by_id[event.event_id] = key
+                self.keys.append(key)
+        self.keys.sort()
+
+    def add_many(self, events):
+        keys = []
+        for event in events:
+            key = self._key(event)
+            if key is not None:
+                self.key_by_id[event.event_id] = key
+                keys.append(key)
+        if len(keys) < 100:
+            for key in keys:
+                insort(self.keys, key)
+        else:  # a big batch: sorting both sorted runs together beats one insert per key
+            keys.sort()
+            self.keys.extend(keys)
+            self.keys.sort()
+
+    def remove(self, event):
+        event_id = event.event_id
+        self.malformed.pop(event_id, None)
+        key = self.key_by_id.pop(event_id, None)
+        if key is not None:
+            del self.keys[bisect_left(self.keys, key)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _bounds(self, date_from, date_to):
+        lo = bisect_left(self.keys, _stamp(date_from) << ID_BITS) if date_from else 0
+        hi = bisect_left(self.keys, _stamp(date_to + timedelta(days=1)) << ID_BITS) if date_to else len(self.keys)
+        return lo, hi
+
+    def between(self, date_from=None, date_to=None):
+        # IDs of the events from date_from to date_to (both included), in date and time order
+        lo, hi = self._bounds(date_from, date_to)
+        return [key & ID_MASK for key in self.keys[lo:hi]]
+
+    def upcoming(self, count, now=None):
+        # IDs of the next `count` events starting at `now` (default: the current time)
+        now = now or datetime.now()
+        lo = bisect_left(self.keys, _stamp(now.date(), now.hour, now.minute) << ID_BITS)
+        return [key & ID_MASK for key in self.keys[lo:lo + count]]
+
+    def count_on(self, day):
+        lo, hi = self._bounds(day, day)
+        return hi - lo
+
+    def counts_by_day(self, date_from=None, date_to=None):
+        # {date: number of events} for the days in the range that have events
+        lo, hi = self._bounds(date_from, date_to)
+        counts = {}
+        index = lo
+        while index < hi:
+            day_stamp = (self.keys[index] >> ID_BITS) // MINUTES_PER_DAY
+            next_day = bisect_left(self.keys, ((day_stamp + 1) * MINUTES_PER_DAY) << ID_BITS, index, hi)
+            counts[date.fromordinal(day_stamp)] = next_day - index
+            index = next_day
+        return counts
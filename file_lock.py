@@ -0,0 +1,120 @@
+import os
+import threading
+from contextlib import contextmanager, nullcontext
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the threads of one process are coordinated
+    fcntl = None
+
+SHARED = 'shared'
+EXCLUSIVE = 'exclusive'
+
+
+# FileLock coordinates several sessions working on the same CSV file. It's an advisory flock on <filename>.lock (not
+# on the CSV itself, which is replaced by every snapshot): shared while a session reads the file, exclusive while it
+# changes it. Inside one process the lock is counted, so the threads share one flock, and a thread that holds the
+# exclusive lock can take it again, or the shared lock, without blocking on itself.
+class FileLock:
+
+    def __init__(self, filename):
+        self.lock_filename = filename + '.lock'
+        self.condition = threading.Condition()
+        self.lockfile = None
+        self.mode = None  # None, SHARED or EXCLUSIVE
+        self.holders = 0
+        self.owner = None  # the thread holding the exclusive lock
+
+    @contextmanager
+    def shared(self):
+        me = threading.get_ident()
+        with self.condition:
+            while self.mode == EXCLUSIVE and self.owner != me:
+                self.condition.wait()
+            if self.mode is None:
+                self._flock(SHARED)
+            self.holders += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def exclusive(self):
+        # Never ask for it while holding only the shared lock: that waits for this thread's own shared lock
+        me = threading.get_ident()
+        with self.condition:
+            while self.mode is not None and not (self.mode == EXCLUSIVE and self.owner == me):
+                self.condition.wait()
+            if self.mode is None:
+                self._flock(EXCLUSIVE)
+                self.owner = me
+            self.holders += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _flock(self, mode):
+        # Called with no holders in this process, so blocking here only waits for the other sessions
+        if fcntl is not None:
+            if self.lockfile is None:
+                self.lockfile = open(self.lock_filename, 'a')
+            fcntl.flock(self.lockfile, fcntl.LOCK_SH if mode == SHARED else fcntl.LOCK_EX)
+        self.mode = mode
+
+    def _release(self):
+        with self.condition:
+            self.holders -= 1
+            if self.holders:
+                return
+            if fcntl is not None:
+                fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+            self.mode = None
+            self.owner = None
+            self.condition.notify_all()
+
+    def close(self):
+        if self.lockfile is not None:
+            self.lockfile.close()
+            self.lockfile = None
+
+
+# NullLock is the lock of backends that coordinate their writers themselves, such as SQLite
+class NullLock:
+
+    def shared(self):
+        return nullcontext()
+
+    def exclusive(self):
+        return nullcontext()
+
+    def close(self):
+        pass
+
+
+def file_stamp(filename):
+    # Changes whenever the file is appended to (size), rewritten (mtime) or replaced by a snapshot (inode)
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+# FileStamps remembers the files as this session last read or wrote them, to tell when another session changed them
+# and the in-memory rows have to be reloaded.
+class FileStamps:
+
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.stamps = None  # nothing read yet
+
+    def current(self):
+        return [file_stamp(filename) for filename in self.filenames]
+
+    def changed(self):
+        return self.current() != self.stamps
+
+    def update(self):
+        self.stamps = self.current()
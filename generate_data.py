@@ -0,0 +1,94 @@
+import argparse
+import csv
+import math
+import os
+import random
+
+# Synthetic data: events.csv and attendees.csv in the same format as the real files, from a seed, so the benchmarks
+# run on the same data every time. Event types are spread over wedding, birthday and business, and the number of
+# attendees per event follows a long-tailed (log-normal) distribution around a per-type average: most events have a
+# handful of attendees, a few have hundreds.
+
+FIRST_NAMES = ['james', 'mary', 'robert', 'patricia', 'john', 'jennifer', 'michael', 'linda', 'david', 'elizabeth',
+               'william', 'barbara', 'richard', 'susan', 'joseph', 'jessica', 'thomas', 'sarah', 'elon', 'gary']
+SURNAMES = ['smith', 'johnson', 'williams', 'brown', 'jones', 'garcia', 'miller', 'davis', 'rodriguez', 'martinez',
+            'hernandez', 'lopez', 'gonzalez', 'wilson', 'anderson', 'thomas', 'taylor', 'moore', 'jackson', 'musk']
+COMPANIES = ['tesla', 'google', 'acme', 'globex', 'initech', 'umbrella', 'hooli', 'stark', 'wayne', 'wonka']
+OCCASIONS = ['halloween party', 'christmas party', 'product launch', 'board meeting', 'summer picnic', 'hackathon',
+             'conference', 'awards night', 'team offsite', 'charity gala']
+PLACES = ['london', 'paris', 'rome', 'madrid', 'berlin', 'tulum', 'holbox', 'new york', 'palo alto', 'dublin']
+VENUES = ['hotel', 'hall', 'garden', 'house', 'hq', 'basilica', 'stadium', 'beach', 'club', 'center']
+
+# Share of each event type, and its average number of attendees relative to the overall average
+EVENT_TYPES = {'wedding': (0.3, 1.6), 'birthday': (0.4, 0.6), 'business': (0.3, 1.0)}
+FANOUT_SPREAD = 1.0  # sigma of the log-normal, higher means a longer tail of very large events
+
+
+def make_event(event_id, event_type):
+    person = f'{random.choice(FIRST_NAMES)} {random.choice(SURNAMES)}'
+    if event_type == 'business':
+        name = f'{random.choice(COMPANIES)} {random.choice(OCCASIONS)}'
+    elif event_type == 'wedding':
+        person += f' & {random.choice(FIRST_NAMES)} {random.choice(SURNAMES)}'
+        name = f'wedding of {person}'
+    else:
+        name = f'birthday of {person}'
+    return [event_id, event_type, name,
+            f'{random.randint(1, 28):02d}/{random.randint(1, 12):02d}/{random.randint(2024, 2027)}',
+            f'{random.randint(8, 22):02d}:{random.choice(["00", "15", "30", "45"])}',
+            f'{random.choice(VENUES)} {random.randint(1, 500)} {random.choice(PLACES)}', person]
+
+
+def make_attendee(attendee_id, event_id):
+    name = random.choice(FIRST_NAMES).title()
+    surname = random.choice(SURNAMES).title()
+    return [attendee_id, name, surname, f'{name.lower()}.{surname.lower()}{attendee_id}@example.com',
+            f'07{attendee_id:09d}', event_id]
+
+
+def generate(event_count, fanout=3.0, seed=1):
+    # Yields ('event', row) and ('attendee', row) pairs: each event followed by its attendees. fanout is the average
+    # number of attendees per event.
+    random.seed(seed)
+    types = list(EVENT_TYPES)
+    shares = [share for share, _ in EVENT_TYPES.values()]
+    attendee_id = 0
+    for event_id in range(1, event_count + 1):
+        event_type = random.choices(types, shares)[0]
+        yield 'event', make_event(event_id, event_type)
+        mean = fanout * EVENT_TYPES[event_type][1]
+        if mean <= 0:
+            continue
+        # the log-normal's mean is exp(mu + sigma^2 / 2), pick mu so it averages `mean`
+        count = int(random.lognormvariate(math.log(mean) - FANOUT_SPREAD ** 2 / 2, FANOUT_SPREAD) + 0.5)
+        for _ in range(count):
+            attendee_id += 1
+            yield 'attendee', make_attendee(attendee_id, event_id)
+
+
+def write_dataset(directory, event_count, fanout=3.0, seed=1):
+    # Writes events.csv and attendees.csv into directory, returns (number of events, number of attendees)
+    os.makedirs(directory, exist_ok=True)
+    counts = {'event': 0, 'attendee': 0}
+    with open(os.path.join(directory, 'events.csv'), 'w', newline='') as events_file, \
+            open(os.path.join(directory, 'attendees.csv'), 'w', newline='') as attendees_file:
+        writers = {'event': csv.writer(events_file), 'attendee': csv.writer(attendees_file)}
+        for kind, row in generate(event_count, fanout, seed):
+            writers[kind].writerow(row)
+            counts[kind] += 1
+    return counts['event'], counts['attendee']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic events.csv and attendees.csv')
+    parser.add_argument('directory', help='where to write the two files')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--fanout', type=float, default=3.0, help='average number of attendees per event')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    events, attendees = write_dataset(args.directory, args.events, args.fanout, args.seed)
+    print(f'Wrote {events} events and {attendees} attendees to {args.directory}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+
+from file_lock import NullLock
+
+
+def read_last_id(filename, chunk_size=4096):
+    # Read the ID of the last row by seeking back from the end of the file, instead of reading every row
+    try:
+        with open(filename, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            position = file.tell()
+            tail = b''
+            while position > 0:
+                step = min(chunk_size, position)
+                position -= step
+                file.seek(position)
+                tail = file.read(step) + tail
+                lines = tail.strip().split(b'\n')
+                if len(lines) > 1 or position == 0:  # the last line is complete
+                    last_line = lines[-1].strip()
+                    if not last_line:
+                        return 0
+                    try:
+                        return int(last_line.split(b',', 1)[0])
+                    except ValueError:
+                        return 0
+            return 0
+    except FileNotFoundError:
+        return 0
+
+
+# IdAllocator hands out new IDs for a CSV file. The highest ID ever given out (the high-water mark) is saved in
+# <filename>.id, so IDs keep growing even when the last rows are deleted or the file isn't sorted by ID.
+# The mark is read and moved on under the file's exclusive lock, so two sessions are never handed the same ID.
+class IdAllocator:
+
+    def __init__(self, filename, known_max=0, lock=None):
+        self.filename = filename
+        self.hwm_filename = filename + '.id'
+        self.lock = lock or NullLock()
+        self.high_water = max(self._read_high_water(), read_last_id(filename), known_max)
+
+    def _read_high_water(self):
+        try:
+            with open(self.hwm_filename, 'r') as file:
+                return int(file.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _save_high_water(self):
+        temp_filename = self.hwm_filename + '.tmp'
+        with open(temp_filename, 'w') as file:
+            file.write(str(self.high_water))
+        os.replace(temp_filename, self.hwm_filename)
+
+    def next_id(self):
+        return self.allocate(1)[0]
+
+    def allocate(self, count):
+        # Reserve a block of `count` IDs with a single write, bulk imports take one block per chunk of rows
+        with self.lock.exclusive():
+            self.high_water = max(self.high_water, self._read_high_water())  # another session may have moved it on
+            first_id = self.high_water + 1
+            self.high_water += count
+            self._save_high_water()
+        return range(first_id, first_id + count)
+
+    def observe(self, used_id):
+        # Keep the mark ahead of IDs that were assigned somewhere else (e.g. rows loaded from a log)
+        if used_id > self.high_water:
+            with self.lock.exclusive():
+                self.high_water = max(used_id, self._read_high_water())
+                self._save_high_water()
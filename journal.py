@@ -0,0 +1,197 @@
+import csv
+import io
+import os
+import threading
+
+import metrics
+from file_lock import NullLock, file_stamp
+
+# Record types written to the log
+PUT = 'P'
+DELETE = 'D'
+
+
+@metrics.timed('file.rewrite')
+def write_snapshot(filename, rows):
+    # Write the rows to a temporary file first and rename it over the real one. The rename is atomic, so a crash
+    # leaves either the old file or the new one, never a half-written CSV.
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w', newline='') as csvfile:
+        csv.writer(csvfile).writerows(rows)
+        csvfile.flush()
+        with metrics.timer('file.fsync'):
+            os.fsync(csvfile.fileno())
+        if metrics.enabled:
+            table = os.path.basename(filename)
+            metrics.count('rewrites', table=table)
+            metrics.count('rows_written', len(rows), table=table)
+            metrics.count('bytes_written', csvfile.tell(), table=table)
+    os.replace(temp_filename, filename)
+
+
+def read_records(log_filename):
+    try:
+        with open(log_filename, 'r', newline='') as logfile:
+            content = logfile.read()
+    except FileNotFoundError:
+        return []
+    if not content.endswith('\n'):  # the last record was cut short by a crash, ignore it
+        content = content[:content.rfind('\n') + 1]
+    return [record for record in csv.reader(io.StringIO(content)) if record]
+
+
+# Journal is an append-only write-ahead log kept next to a CSV file (events.csv.log, attendees.csv.log). Edits and
+# deletes are appended as one record each instead of rewriting the whole file, and the state is rebuilt by replaying
+# the log over the CSV snapshot. Once the log reaches `threshold` records it is compacted in the background.
+# With several sessions on the same file, every change is made under the file's exclusive lock (file_lock.FileLock),
+# and the background compaction takes it too before it writes the snapshot.
+class Journal:
+
+    def __init__(self, filename, threshold=1000, lock=None, stamps=None):
+        self.filename = filename
+        self.log_filename = filename + '.log'
+        self.old_log_filename = filename + '.log.old'  # the log being folded into the snapshot by a compaction
+        self.threshold = threshold
+        self.record_count = 0
+        self.lock = threading.Lock()
+        self.compaction = None
+        self.logfile = None
+        self.file_lock = lock or NullLock()
+        self.stamps = stamps  # the FileStamps of the table, kept current when the snapshot was written from fresh rows
+
+    @metrics.timed('journal.replay')
+    def replay(self, rows, make_record=list):
+        # rows is the dict (ID -> row) loaded from the snapshot, it's updated in place. Replaying is idempotent, so a
+        # log left behind by an interrupted compaction can safely be replayed again; the next compaction folds it in.
+        # (It isn't folded in here: replay runs under the shared lock, and the old log may belong to a compaction
+        # another session is still running.)
+        self.record_count = 0
+        for log_filename in (self.old_log_filename, self.log_filename):
+            records = read_records(log_filename)
+            for record in records:
+                if record[0] == PUT:
+                    rows[int(record[1])] = make_record(record[1:])
+                elif record[0] == DELETE:
+                    rows.pop(int(record[1]), None)
+            self.record_count += len(records)
+        metrics.count('journal_records_read', self.record_count, table=os.path.basename(self.filename))
+        return rows
+
+    def _recover(self, rows):
+        # Both logs are already part of rows, so write the full state out and drop them. The logs are removed only
+        # after the snapshot is in place, replaying them again after a crash in between is harmless.
+        write_snapshot(self.filename, list(rows.values()))
+        for log_filename in (self.old_log_filename, self.log_filename):
+            if os.path.exists(log_filename):
+                os.remove(log_filename)
+        self.record_count = 0
+
+    @metrics.timed('journal.append')
+    def _append(self, records):
+        with self.lock:
+            if self.logfile is not None and self._log_moved():
+                self.logfile.close()  # another session compacted the log, carry on in the new one
+                self.logfile = None
+            if self.logfile is None:
+                self.logfile = open(self.log_filename, 'a', newline='')
+            # one write per batch, so a crash can only cut the last record
+            text = _format_records(records)
+            self.logfile.write(text)
+            metrics.count('journal_records', len(records), table=os.path.basename(self.filename))
+            metrics.count('bytes_written', len(text), table=os.path.basename(self.log_filename))
+            self.logfile.flush()
+            self.record_count += len(records)
+
+    def _log_moved(self):
+        try:
+            return os.stat(self.log_filename).st_ino != os.fstat(self.logfile.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def put(self, row):
+        self._append([[PUT] + list(row)])
+
+    def put_many(self, rows):
+        self._append([[PUT] + list(row) for row in rows])
+
+    def delete(self, record_id):
+        self._append([[DELETE, record_id]])
+
+    def delete_many(self, record_ids):
+        self._append([[DELETE, record_id] for record_id in record_ids])
+
+    def maybe_compact(self, rows):
+        # Compacting rewrites every row, so wait until the log is also a sizeable part of the data, that keeps the
+        # cost of compaction proportional to the number of logged changes
+        if self.record_count >= max(self.threshold, len(rows) // 2):
+            self.compact(rows)
+
+    def compact(self, rows, wait=False):
+        # Called under the exclusive file lock with rows up to date, so not with wait=True: the snapshot needs the lock
+        with self.lock:
+            if self.compaction is not None and self.compaction.is_alive():
+                return  # a compaction is already running, the next mutation will try again
+            if self.logfile is not None:
+                self.logfile.close()
+                self.logfile = None
+            if os.path.exists(self.old_log_filename):  # an earlier compaction failed or hasn't finished yet
+                self._recover(rows)
+                return
+            # New records go to a fresh log while the old one is folded into the snapshot
+            if os.path.exists(self.log_filename):
+                os.replace(self.log_filename, self.old_log_filename)
+            self.record_count = 0
+            snapshot = list(rows.values())  # rows are replaced on update, never changed in place
+            self.compaction = threading.Thread(target=self._write_snapshot, args=(snapshot, self._snapshot_stamps()))
+            self.compaction.start()
+        if wait:
+            self.compaction.join()
+
+    @metrics.timed('journal.compact')
+    def _write_snapshot(self, snapshot, renamed):
+        with self.file_lock.exclusive():
+            if not os.path.exists(self.old_log_filename):
+                return  # another session already folded the old log in, with everything logged since
+            if self._snapshot_stamps() != renamed:
+                # Another session rewrote the file or compacted again since the rename, so the old log isn't the one
+                # the snapshot was taken with any more: fold whatever old log is there into the file instead
+                snapshot = self._read_snapshot()
+            fresh = self.stamps is not None and not self.stamps.changed()
+            write_snapshot(self.filename, snapshot)
+            os.remove(self.old_log_filename)
+            if fresh:  # otherwise another session changed the files meanwhile, and the rows get reloaded
+                self.stamps.update()
+
+    def _snapshot_stamps(self):
+        return file_stamp(self.filename), file_stamp(self.old_log_filename)
+
+    def _read_snapshot(self):
+        # The CSV file with the old log replayed over it, rows kept as the text read from the files
+        rows = {}
+        try:
+            with open(self.filename, 'r', newline='') as csvfile:
+                for row in csv.reader(csvfile):
+                    if row:
+                        rows[row[0]] = row
+        except FileNotFoundError:
+            pass
+        for record in read_records(self.old_log_filename):
+            if record[0] == PUT:
+                rows[record[1]] = record[1:]
+            elif record[0] == DELETE:
+                rows.pop(record[1], None)
+        return list(rows.values())
+
+    def close(self):
+        if self.compaction is not None:
+            self.compaction.join()
+        with self.lock:
+            if self.logfile is not None:
+                self.logfile.close()
+                self.logfile = None
+
+
+def _format_records(records):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(records)
+    return buffer.getvalue()
@@ -0,0 +1,173 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+# Instrumentation: how long each storage, store, service and menu operation takes (a latency histogram per operation)
+# and counters of the work behind it (rows and bytes read and written, full file rewrites, journal records).
+# It's off unless enable() is called (the --profile and --metrics options). While it's off, a timed operation costs
+# one check of `enabled` and count() returns straight away, so the operations themselves run at the same speed; the
+# counters are only updated once per operation, never once per row.
+# The results can be written as a Prometheus text file or a JSON dump (write), or printed as a summary (summary).
+
+# Upper bounds of the histogram buckets in seconds, the last bucket (+Inf) takes everything slower
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = 'ems'  # of the Prometheus metric names
+
+enabled = False
+_lock = threading.Lock()  # the server's threads update the same histograms and counters
+_timers = {}  # operation name -> Histogram
+_counters = {}  # (name, (('table', 'events.csv'),)) -> value
+
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # observations per bucket, not cumulative
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, fraction):
+        # The upper bound of the bucket holding that fraction of the observations (the maximum for the last one)
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def observe(name, seconds):
+    with _lock:
+        histogram = _timers.get(name)
+        if histogram is None:
+            histogram = _timers[name] = Histogram()
+        histogram.observe(seconds)
+
+
+def count(name, amount=1, **labels):
+    if not enabled:
+        return
+    key = name, tuple(sorted(labels.items()))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def timed(name):
+    # Decorator timing every call of a function or method as the operation `name`
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timer(name):
+    # The same for a block of code
+    if not enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+
+def to_dict():
+    with _lock:
+        return {
+            'operations': {name: {'count': histogram.count, 'seconds': histogram.total, 'max_seconds': histogram.max,
+                                  'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'],
+                                                      histogram.buckets))}
+                           for name, histogram in sorted(_timers.items())},
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(_counters.items())],
+        }
+
+
+def to_prometheus():
+    # The text exposition format: one histogram with an operation label, and a counter per counted quantity
+    lines = [f'# HELP {PREFIX}_operation_duration_seconds Time taken by each operation.',
+             f'# TYPE {PREFIX}_operation_duration_seconds histogram']
+    with _lock:
+        for name, histogram in sorted(_timers.items()):
+            cumulative = 0
+            for bound, count_in_bucket in zip([str(bound) for bound in BUCKETS] + ['+Inf'], histogram.buckets):
+                cumulative += count_in_bucket
+                lines.append(f'{PREFIX}_operation_duration_seconds_bucket{{operation="{name}",le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{PREFIX}_operation_duration_seconds_sum{{operation="{name}"}} {histogram.total!r}')
+            lines.append(f'{PREFIX}_operation_duration_seconds_count{{operation="{name}"}} {histogram.count}')
+        names = sorted({name for name, _ in _counters})
+        for name in names:
+            lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+            for (counter_name, labels), value in sorted(_counters.items()):
+                if counter_name == name:
+                    label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+                    lines.append(f'{PREFIX}_{name}_total{{{label_text}}} {value}' if label_text
+                                 else f'{PREFIX}_{name}_total {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write(filename):
+    # A .json file gets the JSON dump, anything else (e.g. metrics.prom) the Prometheus text format
+    with open(filename, 'w') as file:
+        if filename.endswith('.json'):
+            json.dump(to_dict(), file, indent=2)
+        else:
+            file.write(to_prometheus())
+
+
+def summary():
+    # A profile of the run: the operations by total time, then the counters
+    with _lock:
+        timers = sorted(_timers.items(), key=lambda item: item[1].total, reverse=True)
+        counters = sorted(_counters.items())
+    lines = [f'{"operation":<34}{"calls":>8}{"total s":>10}{"mean ms":>10}{"p50 ms":>10}{"p99 ms":>10}'
+             f'{"max ms":>10}']
+    for name, histogram in timers:
+        lines.append(f'{name:<34}{histogram.count:>8}{histogram.total:>10.3f}'
+                     f'{histogram.total / histogram.count * 1000:>10.3f}{histogram.quantile(0.5) * 1000:>10.3f}'
+                     f'{histogram.quantile(0.99) * 1000:>10.3f}{histogram.max * 1000:>10.3f}')
+    if counters:
+        lines.append('')
+        for (name, labels), value in counters:
+            label_text = ', '.join(f'{value}' for _, value in labels)
+            lines.append(f'{name + (f" ({label_text})" if label_text else ""):<44}{value:>14,}')
+    return '\n'.join(lines)
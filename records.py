@@ -0,0 +1,142 @@
+from datetime import date, time
+from operator import attrgetter
+from sys import intern
+
+
+def parse_date(text):
+    # DD/MM/YYYY -> date, or None when the text isn't a real date (e.g. 31/09/202 or 31/09/2023).
+    # Splitting by hand is several times faster than strptime, which matters when indexing a large file.
+    try:
+        day, month, year = text.split('/')
+        if len(day) != 2 or len(month) != 2 or len(year) != 4 or not (day + month + year).isdigit():
+            return None
+        return date(int(year), int(month), int(day))
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_time(text):
+    # HH:MM -> time, or None when the text isn't a real time of day
+    try:
+        hours, minutes = text.split(':')
+        if len(hours) != 2 or len(minutes) != 2 or not (hours + minutes).isdigit():
+            return None
+        return time(int(hours), int(minutes))
+    except (AttributeError, ValueError):
+        return None
+
+
+# Records are what the stores hold in memory, one per CSV row. They use __slots__ instead of a per-instance __dict__,
+# keep IDs as ints, and intern the strings that repeat across many rows (type, date, time, location), so a large file
+# costs far less memory than lists of strings or Event objects. They still behave like the CSV row they came from:
+# record[i], len(record) and iteration give the columns in file order, so they can be written with csv.writer and
+# passed to sqlite3 as parameters.
+class Record:
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._columns = attrgetter(*cls.__slots__)  # reads all the columns into a tuple in one C call
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __getitem__(self, index):
+        return getattr(self, self.__slots__[index])
+
+    def __iter__(self):
+        return iter(self._columns(self))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._columns(self) == other._columns(other)
+
+    __hash__ = None
+
+    def to_row(self):
+        return ['' if value is None else str(value) for value in self]
+
+    def to_dict(self):
+        return dict(zip(self.__slots__, self._columns(self)))
+
+    def with_value(self, index, value):
+        # A copy with one column changed. Records are never changed in place, a background compaction may be
+        # writing them out at the same time.
+        values = list(self._columns(self))
+        values[index] = value
+        return type(self)(*values)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({", ".join(self.to_row())})'
+
+
+_dates = {}  # 'DD/MM/YYYY' -> date or None
+_times = {}  # 'HH:MM' -> time or None
+
+
+class EventRecord(Record):
+    __slots__ = ('event_id', 'event_type', 'event_name', 'event_date', 'event_time', 'event_location', 'owner',
+                 'capacity', 'recurrence')
+
+    def __init__(self, event_id, event_type, event_name, event_date, event_time, event_location, owner,
+                 capacity=None, recurrence=''):
+        self.event_id = int(event_id)
+        self.event_type = intern(event_type)
+        self.event_name = event_name
+        self.event_date = intern(event_date)
+        self.event_time = intern(event_time)
+        self.event_location = intern(event_location)
+        self.owner = owner
+        self.capacity = int(capacity) if capacity else None  # most attendees allowed, None (empty) for no limit
+        self.recurrence = recurrence or ''  # the rule of a recurring event as JSON, '' for a one-off, see recurrence.py
+
+    @classmethod
+    def from_row(cls, row):
+        if isinstance(row, cls):
+            return row
+        if len(row) >= 9:
+            return cls(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8])
+        if len(row) == 8:  # rows written before events could recur
+            return cls(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+        if len(row) == 7:  # rows written before events had a capacity
+            return cls(row[0], row[1], row[2], row[3], row[4], row[5], row[6])
+        # the oldest rows have no time column and sometimes no owner: ID, type, name, date, location[, owner]
+        row = list(row) + [''] * (6 - len(row))
+        return cls(row[0], row[1], row[2], row[3], '', row[4], row[5])
+
+    # The parsed date and time, or None when the text isn't valid. Each distinct text is parsed once and the result
+    # shared by every event with it, the same few thousand dates and times repeat across the whole file.
+    @property
+    def date(self):
+        try:
+            return _dates[self.event_date]
+        except KeyError:
+            day = _dates[self.event_date] = parse_date(self.event_date)
+            return day
+
+    @property
+    def time(self):
+        try:
+            return _times[self.event_time]
+        except KeyError:
+            event_time = _times[self.event_time] = parse_time(self.event_time)
+            return event_time
+
+
+class AttendeeRecord(Record):
+    __slots__ = ('attendee_id', 'name', 'surname', 'email', 'phone', 'event_id')
+
+    def __init__(self, attendee_id, name, surname, email, phone, event_id):
+        self.attendee_id = int(attendee_id)
+        self.name = name
+        self.surname = surname
+        self.email = email
+        self.phone = phone
+        self.event_id = int(event_id)
+
+    @classmethod
+    def from_row(cls, row):
+        if isinstance(row, cls):
+            return row
+        if len(row) < 6:
+            raise ValueError('an attendee row needs 6 columns')
+        return cls(*row[:6])
@@ -0,0 +1,271 @@
+import json
+from calendar import monthrange
+from datetime import date, timedelta
+from heapq import merge
+
+from records import parse_date, parse_time
+
+FREQUENCIES = ('daily', 'weekly', 'monthly', 'yearly')
+# The event columns an occurrence can override, with their column in events.csv
+OVERRIDE_FIELDS = {'event_name': 2, 'event_date': 3, 'event_time': 4, 'event_location': 5}
+MAX_OCCURRENCES = 100000  # a longer count is almost certainly a typo, and the span of a series is computed from it
+MAX_CACHED_RULES = 100000
+
+
+# Recurrence is the rule of a recurring event: every `interval` days, weeks, months or years from the event's date,
+# until a last date and/or for a number of occurrences, with the occurrences that were cancelled and the ones that
+# were changed (moved to another date or time, renamed, held somewhere else). The whole series is one row of
+# events.csv: the event's own date is the first occurrence and its recurrence column holds the rule as JSON, e.g.
+#   {"freq":"weekly","interval":1,"count":520,"cancelled":["24/12/2025"],
+#    "overrides":{"31/12/2025":{"event_time":"09:00"}}}
+# so a ten-year weekly meeting costs one row, and its occurrences are only worked out, lazily, for the dates a query
+# asks about. Occurrences are identified by their original date, which is what cancelled and overrides are keyed by.
+# A monthly rule on the 31st skips the months without one, a yearly rule on 29/02 the years that aren't leap years.
+class Recurrence:
+    __slots__ = ('freq', 'interval', 'count', 'until', 'cancelled', 'overrides')
+
+    def __init__(self, freq, interval=1, count=None, until=None, cancelled=(), overrides=None):
+        if freq not in FREQUENCIES:
+            raise ValueError(f'the repeat must be one of {", ".join(FREQUENCIES)}')
+        self.freq = freq
+        # only a missing value gets the default: an interval or a count of 0 is rejected below
+        self.interval = 1 if interval is None or interval == '' else int(interval)
+        self.count = None if count is None or count == '' else int(count)
+        self.until = until or None  # 'DD/MM/YYYY', included
+        self.cancelled = set(cancelled)  # original dates, 'DD/MM/YYYY'
+        self.overrides = dict(overrides or {})  # original date -> {field: value}
+        if self.interval < 1:
+            raise ValueError('the interval must be at least 1')
+        if self.count is None and self.until is None:
+            raise ValueError('a recurring event needs an end date or a number of occurrences')
+        if self.count is not None and not 0 < self.count <= MAX_OCCURRENCES:
+            raise ValueError(f'the number of occurrences must be from 1 to {MAX_OCCURRENCES}')
+        if self.until is not None and not parse_date(self.until):
+            raise ValueError(f'invalid end date {self.until!r}, expected DD/MM/YYYY')
+        for changes in self.overrides.values():
+            for field, value in changes.items():
+                if field not in OVERRIDE_FIELDS:
+                    raise ValueError(f'an occurrence can only change {", ".join(OVERRIDE_FIELDS)}')
+                if field == 'event_date' and not parse_date(value) or field == 'event_time' and not parse_time(value):
+                    raise ValueError(f'invalid {field} {value!r}')
+
+    @classmethod
+    def from_text(cls, text):
+        # The JSON of the recurrence column, parsed once per distinct text (the column of every copy of a row is the
+        # same string). Raises ValueError when it isn't a valid rule.
+        try:
+            return _rules[text]
+        except KeyError:
+            pass
+        try:
+            values = json.loads(text)
+        except ValueError:
+            raise ValueError(f'invalid recurrence {text!r}, expected JSON')
+        try:
+            rule = cls(values.get('freq'), values.get('interval'), values.get('count'), values.get('until'),
+                       values.get('cancelled', ()), values.get('overrides'))
+        except (AttributeError, TypeError):  # not an object, or values of the wrong type
+            raise ValueError(f'invalid recurrence {text!r}')
+        if len(_rules) >= MAX_CACHED_RULES:
+            _rules.clear()  # edits leave the old texts behind
+        _rules[text] = rule
+        return rule
+
+    def to_text(self):
+        values = {'freq': self.freq, 'interval': self.interval}
+        if self.count is not None:
+            values['count'] = self.count
+        if self.until is not None:
+            values['until'] = self.until
+        if self.cancelled:
+            values['cancelled'] = sorted(self.cancelled, key=parse_date)
+        if self.overrides:
+            values['overrides'] = {day: self.overrides[day] for day in sorted(self.overrides, key=parse_date)}
+        return json.dumps(values, separators=(',', ':'))
+
+    def describe(self):
+        unit = {'daily': 'day', 'weekly': 'week', 'monthly': 'month', 'yearly': 'year'}[self.freq]
+        text = self.freq if self.interval == 1 else f'every {self.interval} {unit}s'
+        if self.count is not None:
+            text += f', {self.count} times'
+        if self.until is not None:
+            text += f', until {self.until}'
+        if self.cancelled:
+            text += f', {len(self.cancelled)} cancelled'
+        if self.overrides:
+            text += f', {len(self.overrides)} changed'
+        return text
+
+    def dates(self, start, date_from=None):
+        # The original dates of the occurrences from date_from on, in order, cancelled ones included. Daily and
+        # weekly rules jump straight to date_from, monthly and yearly ones step through at most a few per year.
+        until = parse_date(self.until) if self.until else date.max
+        if self.freq in ('daily', 'weekly'):
+            step = self.interval * (7 if self.freq == 'weekly' else 1)
+            number = 0
+            if date_from is not None and date_from > start:
+                number = -((start - date_from).days // step)  # the first one on or after date_from, rounded up
+            while self.count is None or number < self.count:
+                try:
+                    day = start + timedelta(days=number * step)
+                except OverflowError:  # past 31/12/9999
+                    return
+                if day > until:
+                    return
+                yield day
+                number += 1
+        else:
+            months = self.interval * (12 if self.freq == 'yearly' else 1)
+            number = 0  # occurrences so far, months that don't have the day don't count
+            candidate = 0
+            while self.count is None or number < self.count:
+                year, month = divmod(start.month - 1 + candidate * months, 12)
+                year += start.year
+                candidate += 1
+                if year > until.year or year > date.max.year:
+                    return
+                if start.day > monthrange(year, month + 1)[1]:
+                    continue
+                day = date(year, month + 1, start.day)
+                if day > until:
+                    return
+                number += 1
+                if date_from is None or day >= date_from:
+                    yield day
+
+    def is_occurrence(self, start, day):
+        return next(self.dates(start, day), None) == day
+
+    def overrides_from(self, start):
+        # The overrides of dates that are occurrences of the series starting on `start`. Ones left over from before
+        # the event's date or rule was edited stay in the column, but don't apply (they'd list phantom occurrences).
+        kept = {}
+        for day_text, changes in self.overrides.items():
+            day = parse_date(day_text)
+            if day and self.is_occurrence(start, day):
+                kept[day_text] = changes
+        return kept
+
+    def span(self, start):
+        # (first, last) date any occurrence falls on, moved ones included; the last of a long daily or weekly series
+        # is computed, the others are counted out
+        if self.count is not None and self.freq in ('daily', 'weekly'):
+            try:
+                last = start + timedelta(days=(self.count - 1) * self.interval * (7 if self.freq == 'weekly' else 1))
+            except OverflowError:
+                last = date.max
+            if self.until is not None:
+                last = min(last, parse_date(self.until))
+        elif self.count is None:
+            last = parse_date(self.until)
+        else:
+            last = start
+            for last in self.dates(start):
+                pass
+        first = start
+        for changes in self.overrides_from(start).values():
+            moved = parse_date(changes.get('event_date', ''))
+            if moved:
+                first = min(first, moved)
+                last = max(last, moved)
+        return first, last
+
+    def with_cancelled(self, day_text):
+        rule = self._copy()
+        rule.cancelled.add(day_text)
+        rule.overrides.pop(day_text, None)
+        return rule
+
+    def with_override(self, day_text, changes):
+        # changes replace the earlier ones of that occurrence; a value equal to the series' own is left out by the
+        # caller, so an empty override restores the occurrence
+        rule = self._copy()
+        rule.cancelled.discard(day_text)
+        merged = {**rule.overrides.get(day_text, {}), **changes}
+        if merged:
+            rule.overrides[day_text] = merged
+        else:
+            rule.overrides.pop(day_text, None)
+        return Recurrence(rule.freq, rule.interval, rule.count, rule.until, rule.cancelled, rule.overrides)
+
+    def _copy(self):
+        return Recurrence(self.freq, self.interval, self.count, self.until, self.cancelled,
+                          {day: dict(changes) for day, changes in self.overrides.items()})
+
+
+_rules = {}  # recurrence text -> Recurrence
+
+
+def rule_of(event):
+    # The Recurrence of an event row, or None for a one-off event
+    return Recurrence.from_text(event.recurrence) if event.recurrence else None
+
+
+def _sort_key(event):
+    return event.date, event.event_time, event.event_id
+
+
+def occurrences(event, date_from=None, date_to=None):
+    # Lazily yield (original date text, EventRecord) for the occurrences of a recurring event that fall from date_from
+    # to date_to (inclusive, either may be None), in date and time order. Each record is the event's row with the
+    # occurrence's date and any changes made to that occurrence; cancelled occurrences are left out.
+    rule = rule_of(event)
+    start = event.date
+    if rule is None or start is None:
+        return
+    moved = []  # the changed occurrences in the range, they may have moved in from outside it
+    for day_text, changes in rule.overrides_from(start).items():
+        row = event.with_value(3, day_text)
+        for field, value in changes.items():
+            row = row.with_value(OVERRIDE_FIELDS[field], value)
+        if (date_from is None or row.date >= date_from) and (date_to is None or row.date <= date_to):
+            moved.append((day_text, row))
+    moved.sort(key=lambda occurrence: _sort_key(occurrence[1]))
+
+    def regular():
+        for day in rule.dates(start, date_from):
+            if date_to is not None and day > date_to:
+                return
+            day_text = day.strftime('%d/%m/%Y')
+            if day_text not in rule.cancelled and day_text not in rule.overrides:
+                yield day_text, event.with_value(3, day_text)
+
+    yield from merge(regular(), moved, key=lambda occurrence: _sort_key(occurrence[1]))
+
+
+# SeriesIndex keeps the first and last date of every recurring event, so a date-range query only expands the series
+# that overlap it. It's one of EventStore.indexes; DateIndex leaves recurring events out, they don't have one date.
+class SeriesIndex:
+
+    def __init__(self):
+        self.spans = {}  # event_id -> (first date, last date)
+        self.malformed = {}  # event_id -> why the series can't be expanded (invalid date or rule), like DateIndex's
+
+    def build(self, events):
+        self.spans = {}
+        self.malformed = {}
+        self.add_many(events)
+
+    def add_many(self, events):
+        for event in events:
+            if not event.recurrence:
+                continue
+            if event.date is None:
+                self.malformed[event.event_id] = f'invalid date {event.event_date!r}'
+                continue
+            try:
+                self.spans[event.event_id] = rule_of(event).span(event.date)
+            except ValueError as e:
+                self.malformed[event.event_id] = str(e)
+
+    def remove(self, event):
+        self.spans.pop(event.event_id, None)
+        self.malformed.pop(event.event_id, None)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def overlapping(self, date_from=None, date_to=None):
+        # IDs of the recurring events with occurrences that may fall in the range, in ID order
+        return sorted(event_id for event_id, (first, last) in self.spans.items()
+                      if (date_to is None or first <= date_to) and (date_from is None or last >= date_from))
@@ -0,0 +1,149 @@
+from heapq import nlargest
+
+import metrics
+from records import parse_date
+
+# Columns of the three reports, also the header of their CSV export
+HEADCOUNT_FIELDS = ['event_id', 'event_type', 'event_name', 'event_date', 'attendees']
+TYPE_FIELDS = ['event_type', 'events', 'attendees']
+MONTH_FIELDS = ['month', 'event_type', 'events', 'attendees']
+UNKNOWN_MONTH = 'unknown'  # events whose date can't be parsed
+
+
+class _Hooks:
+    # The index protocol of the stores (build, add_many, remove), forwarded to Reports. build_part is what a sharded
+    # store calls when one of its shards is (re)loaded, see shards.py
+    def __init__(self, build, add, remove, build_part=None):
+        self.build = build
+        self.add = add
+        self.remove = remove
+        self.build_part = build_part
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+
+# Reports keeps the counters behind the aggregated reports: the number of events and of attendees for each (month,
+# event type), so the per-type and per-month reports only add up a few hundred counters instead of reading every
+# event and attendee. It's registered as an index on both stores and updated on every add, edit and delete; only a
+# reload of either file recomputes it, in one pass over the events and the number of attendees of each event
+# (AttendeeStore.headcounts, which a sharded store counts in parallel, one process per shard). A reload of one shard
+# of the attendees only recounts that shard's events.
+# Per-event headcounts are kept from those counts too, so none of the reports reads the files again or scans the
+# attendees once per event.
+class Reports:
+
+    def __init__(self, event_store, attendee_store):
+        self.event_store = event_store
+        self.attendee_store = attendee_store
+        self.month_cache = {}  # 'DD/MM/YYYY' -> 'YYYY-MM', the same dates repeat across the whole file
+        self.build()
+        event_store.indexes.append(_Hooks(self.build, self._add_event, self._remove_event))
+        attendee_store.indexes.append(_Hooks(self.build, self._add_attendee, self._remove_attendee,
+                                             self._build_attendees))
+
+    @metrics.timed('reports.build')
+    def build(self, rows=None):
+        # Called on every (re)load of either store: count everything again from both stores. The headcounts come
+        # first: a sharded store may load shards to count them, which updates the counters that are replaced here.
+        headcount = self.attendee_store.headcounts()
+        self.events = {}  # (month, event_type) -> number of events
+        self.attendees = {}  # (month, event_type) -> number of attendees of those events
+        self.orphaned = 0  # attendees of events that don't exist, see AttendeeStore.dangling
+        self.headcount = headcount  # event_id -> number of attendees
+        events = self.events
+        attendees = self.attendees
+        for event in self.event_store:
+            key = self._key(event)
+            events[key] = events.get(key, 0) + 1
+            count = headcount.get(event.event_id)
+            if count:
+                attendees[key] = attendees.get(key, 0) + count
+        self.orphaned = sum(headcount.values()) - sum(attendees.values())
+
+    def _key(self, event):
+        month = self.month_cache.get(event.event_date)
+        if month is None:
+            day = parse_date(event.event_date)
+            month = self.month_cache[event.event_date] = f'{day.year:04d}-{day.month:02d}' if day else UNKNOWN_MONTH
+        return month, event.event_type.lower()
+
+    def _add_event(self, event):
+        # the event's attendees, if any were already there, stop being orphaned and count for its month and type
+        key = self._key(event)
+        self.events[key] = self.events.get(key, 0) + 1
+        headcount = self.headcount.get(event.event_id)
+        if headcount:
+            self.attendees[key] = self.attendees.get(key, 0) + headcount
+            self.orphaned -= headcount
+
+    def _remove_event(self, event):
+        key = self._key(event)
+        self.events[key] -= 1
+        headcount = self.headcount.get(event.event_id)
+        if headcount:
+            self.attendees[key] -= headcount
+            self.orphaned += headcount
+
+    def _add_attendee(self, attendee):
+        self._count_attendees(attendee.event_id, 1)
+
+    def _remove_attendee(self, attendee):
+        self._count_attendees(attendee.event_id, -1)
+
+    def _build_attendees(self, in_part, rows):
+        # One shard of the attendees was (re)loaded: replace the counts of its events (in_part(event_id) is true for
+        # them) with the ones of its rows, instead of counting every shard again
+        old = [(event_id, count) for event_id, count in self.headcount.items() if in_part(event_id)]
+        for event_id, count in old:
+            self._count_attendees(event_id, -count)
+        new = {}
+        for row in rows:
+            new[row.event_id] = new.get(row.event_id, 0) + 1
+        for event_id, count in new.items():
+            self._count_attendees(event_id, count)
+
+    def _count_attendees(self, event_id, change):
+        count = self.headcount.get(event_id, 0) + change
+        if count:
+            self.headcount[event_id] = count
+        else:
+            del self.headcount[event_id]
+        event = self.event_store.get(event_id)
+        if event is None:
+            self.orphaned += change
+        else:
+            key = self._key(event)
+            self.attendees[key] = self.attendees.get(key, 0) + change
+
+    def by_month(self, event_type=None):
+        # [[month, event_type, events, attendees]] in month order, months without events are left out
+        event_type = event_type.lower() if event_type else None
+        return [[month, key_type, count, self.attendees.get((month, key_type), 0)]
+                for (month, key_type), count in sorted(self.events.items())
+                if count and (event_type is None or key_type == event_type)]
+
+    def by_type(self):
+        # [[event_type, events, attendees]] in event type order
+        totals = {}
+        for month, event_type, events, attendees in self.by_month():
+            total = totals.setdefault(event_type, [event_type, 0, 0])
+            total[1] += events
+            total[2] += attendees
+        return [totals[event_type] for event_type in sorted(totals)]
+
+    def headcounts(self, event_type=None, top=None):
+        # [event_id, event_type, event_name, event_date, attendees] rows in event ID order, yielded lazily so a large
+        # report can be written out as it's read. With top, a list of the `top` events with the most attendees.
+        event_type = event_type.lower() if event_type else None
+        headcount = self.headcount
+        rows = ([event.event_id, event.event_type, event.event_name, event.event_date,
+                 headcount.get(event.event_id, 0)]
+                for event in self.event_store.iter_events(event_type=event_type))
+        if top is not None:
+            return nlargest(top, rows, key=lambda row: row[4])
+        return rows
+
+    def totals(self):
+        return sum(self.events.values()), sum(self.attendees.values()), self.orphaned
@@ -0,0 +1,227 @@
+import re
+from array import array
+from bisect import bisect_left, insort
+
+TOKEN = re.compile(r'[a-z0-9]+')
+STOP_WORDS = frozenset(['a', 'an', 'and', 'at', 'for', 'in', 'of', 'on', 'the', 'to'])  # in half of all event names
+
+# The searched columns, and how much a match in each one counts. The owner is the bride and groom, the celebrant or the
+# business host, depending on the type of event. Each column has its own postings, under the word with a column prefix.
+FIELDS = ('event_name', 'owner', 'event_location')
+FIELD_WEIGHTS = (3.0, 2.0, 1.0)
+FIELD_PREFIXES = ('n:', 'o:', 'l:')
+
+# How much a query term counts when it matches a word exactly, as the start of a word, or with one typo
+EXACT = 1.0
+PREFIX = 0.6
+TYPO = 0.4
+MIN_PREFIX = 2  # shorter terms only match whole words
+MIN_TYPO = 4  # shorter terms are too ambiguous to correct
+MAX_PREFIX_WORDS = 500  # a short prefix of a huge vocabulary only expands to this many words
+
+
+def tokenize(text):
+    return [word for word in TOKEN.findall(text.lower()) if word not in STOP_WORDS]
+
+
+def _deletes(word):
+    # the word with one letter left out, in every position
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def _one_edit(a, b):
+    # True if b is a with one letter inserted, left out, changed, or two neighbouring letters swapped
+    if abs(len(a) - len(b)) > 1 or a == b:
+        return False
+    start = 0
+    while start < min(len(a), len(b)) and a[start] == b[start]:
+        start += 1
+    if len(a) == len(b):
+        return (a[start + 1:] == b[start + 1:]
+                or (a[start + 1:start + 2] == b[start:start + 1] and a[start:start + 1] == b[start + 1:start + 2]
+                    and a[start + 2:] == b[start + 2:]))
+    if len(a) > len(b):
+        return a[start + 1:] == b[start:]
+    return a[start:] == b[start + 1:]
+
+
+# SearchIndex is an inverted index over the event name, owner and location: every word points at the IDs of the events
+# that have it in each column, so a search only reads the postings of the words it matches instead of every event.
+# Query terms match whole words, the start of a word (as you type) and, from MIN_TYPO letters, words one typo away,
+# which are found through the words' one-letter deletions (the symmetric delete method) rather than by comparing the
+# term with the whole vocabulary. Results are ranked by how well and in which column each term matched; the postings are
+# combined with set operations, so the per-event work in Python is limited to the events that match.
+# The index is built on the first search (or by ensure_built), so loading the files costs nothing extra when nobody
+# searches, and after that it's kept up to date by the store like the other indexes. Searching never changes it, so
+# once it's built any number of searches can run at the same time. Removing an event only records its postings as
+# removed, searches skip them, and a word's list is only rewritten once half of it is removed, so deleting many events
+# that share a common word (wedding, london) costs a few passes over that word's list instead of one per event.
+class SearchIndex:
+
+    def __init__(self):
+        self.build(())
+
+    def build(self, events):
+        # Called on every (re)load: drop everything, the next search builds the index again from the store
+        self.built = False
+        self.postings = {}  # column prefix + word -> array of event IDs
+        self.removed = {}  # column prefix + word -> event IDs removed since the list was last rewritten
+        self.vocabulary = set()
+        self.words = []  # the vocabulary, sorted, for prefix matches
+        self.typo_keys = {}  # one-letter deletion of a word (or the word itself) -> the words it came from
+
+    def _build(self, events):
+        postings = {}
+        keys_cache = {}  # the same locations and owners repeat across many events, tokenize each text once
+        for event in events:
+            event_id = event.event_id
+            for field, column in enumerate(FIELDS):
+                text = getattr(event, column)
+                keys = keys_cache.get((field, text))
+                if keys is None:
+                    keys = keys_cache[field, text] = self._keys(field, text)
+                for key in keys:
+                    key_postings = postings.get(key)
+                    if key_postings is None:
+                        key_postings = postings[key] = array('q')
+                    key_postings.append(event_id)
+        self.postings = postings
+        self.vocabulary = {key[2:] for key in postings}
+        self.words = sorted(self.vocabulary)
+        for word in self.words:
+            self._add_typo_keys(word)
+        self.built = True
+
+    def ensure_built(self, events):
+        # Build the index now if it isn't yet, e.g. on the one thread allowed to change it, before concurrent searches
+        if not self.built:
+            self._build(events)
+
+    @staticmethod
+    def _keys(field, text):
+        # the postings keys of a column's text, each word once
+        return [FIELD_PREFIXES[field] + word for word in dict.fromkeys(tokenize(text))]
+
+    def _keys_of(self, event):
+        for field, column in enumerate(FIELDS):
+            yield from self._keys(field, getattr(event, column))
+
+    def _add_typo_keys(self, word):
+        if len(word) >= MIN_TYPO - 1 and word.isalpha():
+            for key in _deletes(word) | {word}:
+                self.typo_keys.setdefault(key, []).append(word)
+
+    def add_many(self, events):
+        if not self.built:
+            return
+        new_words = []
+        for event in events:
+            event_id = event.event_id
+            for key in self._keys_of(event):
+                removed = self.removed.get(key)
+                if removed and event_id in removed:
+                    removed.discard(event_id)  # an edit that kept the word, the old posting is still in the list
+                    continue
+                key_postings = self.postings.get(key)
+                if key_postings is None:
+                    key_postings = self.postings[key] = array('q')
+                    word = key[2:]
+                    if word not in self.vocabulary:
+                        self.vocabulary.add(word)
+                        new_words.append(word)
+                        self._add_typo_keys(word)
+                key_postings.append(event_id)
+        if len(new_words) < 100:
+            for word in new_words:
+                insort(self.words, word)
+        else:  # a big batch: sorting both sorted runs together beats one insert per word
+            self.words.extend(new_words)
+            self.words.sort()
+
+    def remove(self, event):
+        if not self.built:
+            return
+        event_id = event.event_id
+        for key in self._keys_of(event):
+            removed = self.removed.setdefault(key, set())
+            removed.add(event_id)
+            postings = self.postings.get(key, ())
+            if len(removed) * 2 >= len(postings):  # rewritten at most once per half of the list removed
+                self.postings[key] = array('q', [posting for posting in postings if posting not in removed])
+                del self.removed[key]
+
+    def _key_postings(self, key):
+        postings = self.postings.get(key, ())
+        removed = self.removed.get(key)
+        if removed:
+            return [event_id for event_id in postings if event_id not in removed]
+        return postings
+
+    def _expand(self, term):
+        # {word: weight} for the words a query term matches
+        matches = {}
+        if term in self.vocabulary:
+            matches[term] = EXACT
+        if len(term) >= MIN_PREFIX:
+            position = bisect_left(self.words, term)
+            end = min(position + MAX_PREFIX_WORDS, len(self.words))
+            while position < end and self.words[position].startswith(term):
+                matches.setdefault(self.words[position], PREFIX)
+                position += 1
+        if len(term) >= MIN_TYPO and term.isalpha():
+            for key in _deletes(term) | {term}:
+                for word in self.typo_keys.get(key, ()):
+                    if word not in matches and _one_edit(term, word):
+                        matches[word] = TYPO
+        return matches
+
+    def _levels(self, matches):
+        # [(score, postings)] of a term, best score first: one entry per matched word and column
+        levels = []
+        for word, weight in matches.items():
+            for field, prefix in enumerate(FIELD_PREFIXES):
+                postings = self._key_postings(prefix + word)
+                if postings:
+                    levels.append((weight * FIELD_WEIGHTS[field], postings))
+        levels.sort(key=lambda level: -level[0])
+        return levels
+
+    def search(self, text, rows, limit=20):
+        # Ranked [(event_id, score)] of the events matching every word of text, best first. rows is the store's
+        # event_id -> EventRecord dict, used to build the index the first time and to check a few candidates directly.
+        if not self.built:
+            self._build(rows.values())
+        terms = [self._levels(self._expand(term)) for term in dict.fromkeys(tokenize(text))]
+        if not terms or not all(terms):
+            return []
+        # the rarest term first, the others then only have to be checked against its events
+        terms.sort(key=lambda levels: sum(len(postings) for _, postings in levels))
+        # Events are kept in buckets by score, {score: set of IDs}, so combining terms is a few set operations per
+        # bucket rather than work per event. An event counts with its best column and match for each term.
+        buckets = {}
+        seen = set()
+        for score, postings in terms[0]:
+            new = set(postings)
+            new.difference_update(seen)
+            seen.update(new)
+            buckets.setdefault(score, set()).update(new)
+        for levels in terms[1:]:
+            remaining = set().union(*buckets.values())
+            combined = {}
+            for score, postings in levels:
+                if not remaining:
+                    break
+                hits = remaining.intersection(postings)  # one pass over the postings for all the buckets
+                remaining.difference_update(hits)
+                for bucket_score, event_ids in buckets.items():
+                    combined.setdefault(bucket_score + score, set()).update(event_ids & hits)
+            buckets = {score: event_ids for score, event_ids in combined.items() if event_ids}
+            if not buckets:
+                return []
+        results = []
+        for score in sorted(buckets, reverse=True):  # ties go to the lowest event ID
+            for event_id in sorted(buckets[score])[:limit - len(results)]:
+                results.append((event_id, score))
+            if len(results) >= limit:
+                break
+        return results
@@ -0,0 +1,194 @@
+import json
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from records import parse_date
+from reporting import HEADCOUNT_FIELDS, MONTH_FIELDS, TYPE_FIELDS
+from service import Duplicate, InvalidInput, NotFound
+
+# Routes: (method, path pattern) -> name of the handler method. Path parameters are event and attendee IDs.
+ROUTES = [
+    ('GET', r'/events', 'list_events'),
+    ('POST', r'/events', 'add_event'),
+    ('GET', r'/events/search', 'search_events'),
+    ('GET', r'/events/(\d+)', 'get_event'),
+    ('PATCH', r'/events/(\d+)', 'edit_event'),
+    ('DELETE', r'/events/(\d+)', 'delete_event'),
+    ('GET', r'/events/(\d+)/occurrences', 'list_occurrences'),
+    ('PATCH', r'/events/(\d+)/occurrences', 'edit_occurrence'),
+    ('GET', r'/events/(\d+)/attendees', 'list_attendees'),
+    ('POST', r'/events/(\d+)/attendees', 'add_attendee'),
+    ('GET', r'/events/(\d+)/waitlist', 'list_waitlist'),
+    ('DELETE', r'/events/(\d+)/attendees/(\d+)', 'delete_attendee'),
+    ('GET', r'/attendees', 'find_registrations'),
+    ('GET', r'/reports/events', 'report_headcounts'),
+    ('GET', r'/reports/types', 'report_by_type'),
+    ('GET', r'/reports/months', 'report_by_month'),
+]
+ROUTES = [(method, re.compile(pattern + '$'), name) for method, pattern, name in ROUTES]
+
+
+# RequestHandler maps the JSON endpoints onto an EventService. Each connection gets its own thread, and with
+# HTTP/1.1 the connection is kept alive between requests (every response carries a Content-Length).
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service = None  # set by make_server
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')  # no PUT routes, answered with a JSON 405 instead of the default HTML 501
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        pass  # keep the terminal quiet, errors are returned to the client
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        allowed = False
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(url.path)
+            if not match:
+                continue
+            allowed = True
+            if route_method != method:
+                continue
+            try:
+                status, body = getattr(self, name)(*(int(value) for value in match.groups()))
+            except NotFound as e:
+                status, body = 404, {'error': str(e)}
+            except Duplicate as e:
+                status, body = 409, {'error': str(e)}
+            except (InvalidInput, ValueError) as e:
+                status, body = 400, {'error': str(e)}
+            self._send(status, body)
+            return
+        self._send(405 if allowed else 404, {'error': 'method not allowed' if allowed else 'not found'})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            raise InvalidInput('the request body must be JSON')
+        if not isinstance(body, dict):
+            raise InvalidInput('the request body must be a JSON object')
+        return body
+
+    def _date_param(self, name):
+        if name not in self.query:
+            return None
+        day = parse_date(self.query[name])
+        if day is None:
+            raise InvalidInput(f'{name} must be a date in DD/MM/YYYY format')
+        return day
+
+    # GET /events?type=&location=&from=DD/MM/YYYY&to=DD/MM/YYYY&limit=&offset=&cursor=
+    def list_events(self):
+        cursor = self.query.get('cursor')
+        events, next_cursor = self.service.list_events(
+            limit=min(int(self.query.get('limit', 20)), 1000), offset=int(self.query.get('offset', 0)),
+            cursor=int(cursor) if cursor else None, event_type=self.query.get('type'),
+            location=self.query.get('location'), date_from=self._date_param('from'), date_to=self._date_param('to'))
+        return 200, {'events': [event.to_dict() for event in events], 'next_cursor': next_cursor}
+
+    # GET /events/search?q=tesla+halloween&limit=
+    def search_events(self):
+        results = self.service.search_events(self.query.get('q', ''), min(int(self.query.get('limit', 20)), 1000))
+        return 200, {'events': [dict(event.to_dict(), score=round(score, 2)) for event, score in results]}
+
+    def add_event(self):
+        return 201, self.service.add_event(self._body()).to_dict()
+
+    def get_event(self, event_id):
+        return 200, self.service.get_event(event_id).to_dict()
+
+    def edit_event(self, event_id):
+        return 200, self.service.edit_event(event_id, self._body()).to_dict()
+
+    def delete_event(self, event_id):
+        event, attendee_count = self.service.delete_event(event_id)
+        return 200, {'deleted': event.to_dict(), 'deleted_attendees': attendee_count}
+
+    # GET /events/<id>/occurrences?from=DD/MM/YYYY&to=DD/MM/YYYY&limit=
+    def list_occurrences(self, event_id):
+        occurrences = self.service.list_occurrences(event_id, self._date_param('from'), self._date_param('to'),
+                                                    min(int(self.query.get('limit', 100)), 1000))
+        return 200, {'occurrences': [dict(event.to_dict(), original_date=original_date)
+                                     for original_date, event in occurrences]}
+
+    # PATCH /events/<id>/occurrences with {"date": original date, "cancelled": true} or {"date": ..., "changes": {...}}
+    def edit_occurrence(self, event_id):
+        body = self._body()
+        if not body.get('date'):
+            raise InvalidInput('date, the original date of the occurrence, is required')
+        if body.get('cancelled'):
+            return 200, self.service.cancel_occurrence(event_id, str(body['date'])).to_dict()
+        if not isinstance(body.get('changes'), dict):
+            raise InvalidInput('changes must be a JSON object, or cancelled true')
+        return 200, self.service.edit_occurrence(event_id, str(body['date']), body['changes']).to_dict()
+
+    def list_attendees(self, event_id):
+        return 200, {'attendees': [attendee.to_dict() for attendee in self.service.list_attendees(event_id)]}
+
+    def list_waitlist(self, event_id):
+        return 200, {'waitlist': [attendee.to_dict() for attendee in self.service.list_waitlist(event_id)]}
+
+    def add_attendee(self, event_id):
+        # 201 when they got a place, 202 when the event is full and they're on its waitlist
+        attendee, position = self.service.add_attendee(event_id, self._body())
+        if position is None:
+            return 201, attendee.to_dict()
+        return 202, dict(attendee.to_dict(), waitlist_position=position)
+
+    # GET /attendees?email=&phone=
+    def find_registrations(self):
+        if not (self.query.get('email') or self.query.get('phone')):
+            raise InvalidInput('email or phone is required')
+        attendees = self.service.find_registrations(self.query.get('email'), self.query.get('phone'))
+        return 200, {'attendees': [attendee.to_dict() for attendee in attendees]}
+
+    def delete_attendee(self, event_id, attendee_id):
+        attendee, promoted = self.service.delete_attendee(event_id, attendee_id)
+        return 200, {'deleted': attendee.to_dict(), 'promoted': [row.to_dict() for row in promoted]}
+
+    # GET /reports/events?type=&top=
+    def report_headcounts(self):
+        top = self.query.get('top')
+        rows = self.service.report_headcounts(self.query.get('type'), int(top) if top else None)
+        return 200, {'events': [dict(zip(HEADCOUNT_FIELDS, row)) for row in rows]}
+
+    def report_by_type(self):
+        return 200, {'types': [dict(zip(TYPE_FIELDS, row)) for row in self.service.report_by_type()]}
+
+    # GET /reports/months?type=
+    def report_by_month(self):
+        rows = self.service.report_by_month(self.query.get('type'))
+        return 200, {'months': [dict(zip(MONTH_FIELDS, row)) for row in rows]}
+
+
+def make_server(service, host='127.0.0.1', port=8000):
+    # port=0 picks a free port, server.server_address tells which one
+    handler = type('BoundRequestHandler', (RequestHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
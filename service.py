@@ -0,0 +1,311 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+import metrics
+from bulk import (ATTENDEE_INPUT_FIELDS, EVENT_INPUT_FIELDS, RejectedRow, field_text, validate_attendee,
+                  validate_event, validate_recurrence)
+from records import parse_date, parse_time
+from recurrence import OVERRIDE_FIELDS
+from reporting import Reports
+from store import delete_attendees, delete_events, promote, register_attendees
+
+# Fields that can be edited, with their column in events.csv (the same choices as Event.edit_event)
+EDITABLE_FIELDS = {'event_name': 2, 'event_date': 3, 'event_time': 4, 'event_location': 5, 'capacity': 7,
+                   'recurrence': 8}
+
+
+class NotFound(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class InvalidInput(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class Duplicate(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+# ReadWriteLock lets any number of readers in at once, or a single writer. A waiting writer holds back new readers,
+# so a steady stream of reads can't starve the writes.
+class ReadWriteLock:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+# EventService is the non-interactive version of the menu operations, safe to call from many threads at once: reads
+# run concurrently against the shared in-memory stores, and every change is handed to one writer thread, so writes
+# are applied (and saved) one at a time in the order they arrive.
+class EventService:
+
+    def __init__(self, event_store, attendee_store, waitlist_store, reports=None):
+        self.events = event_store
+        self.attendees = attendee_store
+        self.waitlist = waitlist_store
+        self.reports = reports  # created by the first report, so a service that never reports doesn't keep counters
+        self.lock = ReadWriteLock()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+
+    def _read(self, operation, *args):
+        if self.events.table.changed() or self.attendees.table.changed() or self.waitlist.table.changed():
+            self._write(self._refresh)  # another session changed the data, reload it before anyone reads it
+        with self.lock.read():
+            return operation(*args)
+
+    def _write(self, operation, *args):
+        return self.writer.submit(self._locked, operation, args).result()  # exceptions are re-raised here
+
+    def _locked(self, operation, args):
+        with self.lock.write():
+            self._refresh()
+            return operation(*args)
+
+    def _refresh(self):
+        searched = self.events.search_index.built
+        self.events.refresh()
+        self.attendees.refresh()
+        self.waitlist.refresh()
+        if searched:  # a reload drops the search index, rebuild it here rather than in a concurrent search
+            self.events.search_index.ensure_built(self.events.rows.values())
+
+    def close(self):
+        self.writer.shutdown()
+
+    # events
+    @metrics.timed('service.list_events')
+    def list_events(self, limit=20, offset=0, cursor=None, **filters):
+        return self._read(lambda: self.events.page(limit, offset, cursor, **filters))
+
+    @metrics.timed('service.search_events')
+    def search_events(self, text, limit=20):
+        # The search index is built by the first search, on the writer, and after that searches are reads like the
+        # others: only _refresh replaces the index, and it builds the new one before any reader gets to it
+        if not self.events.search_index.built:
+            self._write(self._build_search_index)
+        return self._read(self.events.search, text, limit)
+
+    def _build_search_index(self):
+        self.events.search_index.ensure_built(self.events.rows.values())
+
+    @metrics.timed('service.get_event')
+    def get_event(self, event_id):
+        return self._read(self._get_event, event_id)
+
+    def _get_event(self, event_id):
+        event = self.events.get(event_id)
+        if event is None:
+            raise NotFound(f'Event {event_id} not found')
+        return event
+
+    @metrics.timed('service.add_event')
+    def add_event(self, values):
+        # values: a dict with the EVENT_INPUT_FIELDS, validated like a bulk import. recurrence is a rule as a dict
+        # or its JSON, e.g. {"freq": "weekly", "count": 10}, see recurrence.py
+        try:
+            row = validate_event([field_text(values.get(field)) for field in EVENT_INPUT_FIELDS])
+        except RejectedRow as e:
+            raise InvalidInput(str(e))
+        return self._write(self._add_event, row)
+
+    def _add_event(self, row):
+        return self.events.add([self.events.ids.next_id()] + row)
+
+    @metrics.timed('service.edit_event')
+    def edit_event(self, event_id, changes):
+        # changes: {field: new value} for any of EDITABLE_FIELDS, an empty recurrence makes it a one-off event
+        changes = {field: field_text(value) for field, value in changes.items()}
+        for field, value in changes.items():
+            if field not in EDITABLE_FIELDS:
+                raise InvalidInput(f'You can only amend {", ".join(EDITABLE_FIELDS)}')
+            if field == 'event_date' and not parse_date(value):
+                raise InvalidInput('Invalid date. Please use DD/MM/YYYY format.')
+            if field == 'event_time' and not parse_time(value):
+                raise InvalidInput('Invalid time format. Please use HH:MM format.')
+            if field == 'capacity' and value and not (value.isdigit() and int(value) > 0):
+                raise InvalidInput('The capacity must be a whole number of at least 1, or empty for no limit.')
+        return self._write(self._edit_event, event_id, changes)
+
+    def _edit_event(self, event_id, changes):
+        event = self._get_event(event_id)
+        recurrence = changes.get('recurrence', event.recurrence)
+        if recurrence and ('recurrence' in changes or 'event_date' in changes):
+            try:
+                recurrence = validate_recurrence(recurrence, changes.get('event_date', event.event_date))
+            except RejectedRow as e:
+                raise InvalidInput(str(e))
+            if 'recurrence' in changes:
+                changes['recurrence'] = recurrence
+        for field, value in changes.items():
+            if field == 'event_location':
+                value = value.lower().replace(',', '')
+            event = self.events.update(event_id, EDITABLE_FIELDS[field], value)
+        if 'capacity' in changes:
+            promote(self.events, self.attendees, self.waitlist, [event_id])  # a higher capacity lets people in
+        return event
+
+    @metrics.timed('service.delete_event')
+    def delete_event(self, event_id):
+        # Returns (deleted event, number of attendees deleted with it)
+        return self._write(self._delete_event, event_id)
+
+    def _delete_event(self, event_id):
+        self._get_event(event_id)
+        event_rows, attendee_rows = delete_events(self.events, self.attendees, [event_id], self.waitlist)
+        return event_rows[0], len(attendee_rows)
+
+    @metrics.timed('service.list_occurrences')
+    def list_occurrences(self, event_id, date_from=None, date_to=None, limit=100):
+        # [(original date, occurrence)] of a recurring event, in date order
+        return self._read(self._list_occurrences, event_id, date_from, date_to, limit)
+
+    def _list_occurrences(self, event_id, date_from, date_to, limit):
+        if not self._get_event(event_id).recurrence:
+            raise InvalidInput(f'Event {event_id} does not repeat')
+        return list(islice(self.events.occurrences(event_id, date_from, date_to), limit))
+
+    @metrics.timed('service.edit_occurrence')
+    def edit_occurrence(self, event_id, original_date, changes):
+        # Change one occurrence of a recurring event, which is identified by its original date. changes: {field: new
+        # value} for event_name, event_date, event_time and event_location. Returns the series.
+        changes = {field: str(value).strip() for field, value in changes.items()}
+        for field, value in changes.items():
+            if field not in OVERRIDE_FIELDS:
+                raise InvalidInput(f'You can only amend {", ".join(OVERRIDE_FIELDS)} of one occurrence')
+            if field == 'event_date' and not parse_date(value):
+                raise InvalidInput('Invalid date. Please use DD/MM/YYYY format.')
+            if field == 'event_time' and not parse_time(value):
+                raise InvalidInput('Invalid time format. Please use HH:MM format.')
+            if field == 'event_location':
+                changes[field] = value.lower().replace(',', '')
+        return self._write(self._edit_occurrence, event_id, original_date, changes)
+
+    @metrics.timed('service.cancel_occurrence')
+    def cancel_occurrence(self, event_id, original_date):
+        return self._write(self._edit_occurrence, event_id, original_date, None)
+
+    def _edit_occurrence(self, event_id, original_date, changes):
+        self._get_event(event_id)
+        try:
+            event = self.events.edit_occurrence(event_id, original_date, changes)
+        except ValueError as e:
+            raise InvalidInput(str(e))
+        if event is None:
+            raise NotFound(f'Event {event_id} not found')
+        return event
+
+    # attendees
+    @metrics.timed('service.list_attendees')
+    def list_attendees(self, event_id):
+        return self._read(self._list_attendees, event_id)
+
+    def _list_attendees(self, event_id):
+        self._get_event(event_id)
+        return self.attendees.for_event(event_id)
+
+    @metrics.timed('service.list_waitlist')
+    def list_waitlist(self, event_id):
+        return self._read(self._list_waitlist, event_id)
+
+    def _list_waitlist(self, event_id):
+        self._get_event(event_id)
+        return self.waitlist.for_event(event_id)
+
+    @metrics.timed('service.add_attendee')
+    def add_attendee(self, event_id, values):
+        # values: a dict with name, surname, email and phone. Returns (attendee, None), or (attendee, position) when
+        # the event is full and they were put on its waitlist, 1 being the next to get a place.
+        values = dict(values, event_id=event_id)
+        return self._write(self._add_attendee, event_id, [str(values.get(field) or '').strip()
+                                                          for field in ATTENDEE_INPUT_FIELDS])
+
+    def _add_attendee(self, event_id, values):
+        with self.events.reading():  # holds off other sessions deleting the event
+            self._get_event(event_id)
+            try:
+                row = validate_attendee(values, self.events)
+            except RejectedRow as e:
+                raise InvalidInput(str(e))
+            row = [self.attendees.ids.next_id()] + row
+            admitted, waitlisted = register_attendees(self.events, self.attendees, self.waitlist, [row])
+            if admitted:
+                return admitted[0], None
+            if waitlisted:
+                return waitlisted[0], len(self.waitlist.by_event[event_id])
+            duplicate = self.attendees.find_duplicate(row) or self.waitlist.find_duplicate(row)
+            raise Duplicate(f'Already registered for event {event_id} as attendee {duplicate.attendee_id}')
+
+    @metrics.timed('service.find_registrations')
+    def find_registrations(self, email=None, phone=None):
+        return self._read(self.attendees.registrations, email, phone)
+
+    @metrics.timed('service.delete_attendee')
+    def delete_attendee(self, event_id, attendee_id):
+        # Removes an attendee, or someone from the waitlist. Returns (deleted row, rows promoted from the waitlist).
+        return self._write(self._delete_attendee, event_id, attendee_id)
+
+    def _delete_attendee(self, event_id, attendee_id):
+        attendee = self.attendees.route(event_id).get(attendee_id) or self.waitlist.route(event_id).get(attendee_id)
+        if attendee is None or attendee.event_id != event_id:
+            raise NotFound('Attendee not found with the given IDs.')
+        deleted, promoted = delete_attendees(self.events, self.attendees, self.waitlist, [(event_id, attendee_id)])
+        return deleted[0], promoted
+
+    # reports
+    def _report(self, operation, *args):
+        if self.reports is None:
+            self._write(self._start_reports)
+        return self._read(lambda: operation(self.reports, *args))
+
+    def _start_reports(self):
+        if self.reports is None:
+            self.reports = Reports(self.events, self.attendees)
+
+    @metrics.timed('service.report_by_type')
+    def report_by_type(self):
+        return self._report(Reports.by_type)
+
+    @metrics.timed('service.report_by_month')
+    def report_by_month(self, event_type=None):
+        return self._report(Reports.by_month, event_type)
+
+    @metrics.timed('service.report_headcounts')
+    def report_headcounts(self, event_type=None, top=None):
+        return self._report(lambda reports: list(reports.headcounts(event_type, top)))
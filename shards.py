@@ -0,0 +1,388 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from itertools import chain
+from multiprocessing import get_context
+
+import metrics
+from file_lock import FileLock
+from id_allocator import IdAllocator
+from journal import write_snapshot
+from records import AttendeeRecord
+from storage import JournaledCsvTable
+from store import AttendeeStore
+
+MANIFEST_SUFFIX = '.shards'  # attendees.csv.shards holds the number of shards attendees.csv is split into
+# Below this many bytes of shard files to read, a scan runs in this process: starting the worker processes would take
+# longer than reading the files
+POOL_MIN_BYTES = 16 * 1024 * 1024
+
+
+def shard_count(filename):
+    # The number of shards the file is split into, None when it isn't sharded
+    try:
+        with open(filename + MANIFEST_SUFFIX, 'r') as file:
+            text = file.read().strip()
+    except FileNotFoundError:
+        return None
+    if not text.isdigit() or int(text) < 1:
+        raise ValueError(f'{filename + MANIFEST_SUFFIX} should hold the number of shards, not {text!r}')
+    return int(text)
+
+
+def shard_filename(filename, index, count):
+    # attendees.csv -> attendees.3-of-8.csv. The count is part of the name, so resharding writes its files next to the
+    # old ones instead of over them, see reshard.
+    root, extension = os.path.splitext(filename)
+    return f'{root}.{index}-of-{count}{extension}'
+
+
+def shard_of(event_id, count):
+    # Event IDs are handed out in sequence, so taking them modulo the count spreads the events evenly over the shards,
+    # the same way in every process
+    return event_id % count
+
+
+# ShardedAttendeeStore splits the attendees (or the waitlist) into `count` files by event ID, attendees.0-of-N.csv
+# to attendees.<N - 1>-of-N.csv, each one an AttendeeStore of its own with its own lock, journal and indexes. All the
+# attendees of an event are in one shard, so the per-event operations (list, register, delete, the capacity check and
+# the waitlist) route to that shard and only lock, load and rewrite that file: registrations for events in different
+# shards no longer wait for each other, and a change rewrites 1/count of the data.
+# Shards are loaded on first use. The operations that need every shard (finding a person's registrations, the
+# integrity check, the headcounts behind the reports) run on each shard in parallel: the loaded ones answer from
+# memory, the others are read by a pool of worker processes, one per core, each keeping the shards it was given in
+# memory and only reloading them when their files change. Attendee IDs stay unique across shards, they come from one
+# IdAllocator (attendees.csv.id).
+# It has the same interface as AttendeeStore, so the menu, the service and the store functions work with either, but
+# an attendee is looked up, or deleted, by (event ID, attendee ID): an attendee ID alone doesn't tell which shard to
+# read, and looking for one that isn't there would load every shard.
+class ShardedAttendeeStore:
+
+    def __init__(self, filename, count=None, journaled=False, compact_threshold=1000, changelog=None, workers=None):
+        self.filename = filename
+        self.count = count or shard_count(filename)
+        self.journaled = journaled
+        self.compact_threshold = compact_threshold
+        self.changelog = changelog
+        self.workers = min(workers or os.cpu_count() or 1, self.count)
+        self.filenames = [shard_filename(filename, index, self.count) for index in range(self.count)]
+        self.shards = [None] * self.count  # the AttendeeStore of each shard, None until it's first used
+        self.loading = threading.Lock()  # the service's reader threads may route to a shard at the same time
+        self.ids = IdAllocator(filename, 0, FileLock(filename))
+        self.indexes = _ShardIndexes(self)
+        self.by_event = _RoutedByEvent(self)
+        self.table = _ShardTables(self)
+        self.pools = None  # one single-process executor per worker, shard i always goes to pools[i % workers]
+
+    def shard(self, index):
+        shard = self.shards[index]
+        if shard is not None:
+            return shard
+        with self.loading:
+            shard = self.shards[index]
+            if shard is not None:
+                return shard
+            shard = AttendeeStore(self.filenames[index], self.journaled, self.compact_threshold,
+                                  changelog=self.changelog, ids=self.ids)
+            parts = [_ShardPart(hooks, self.count, index) for hooks in self.indexes]
+            shard.indexes.extend(parts)
+            self.shards[index] = shard
+        # Reports counted this shard from its file, which may have changed since. Outside the lock: Reports may be
+        # rebuilding, and load other shards to do it.
+        for part in parts:
+            part.build(shard.rows.values())
+        return shard
+
+    def route(self, event_id):
+        # The shard holding the attendees of event_id
+        return self.shard(shard_of(event_id, self.count))
+
+    def shards_for(self, event_ids):
+        # The shards holding these events, in shard order, which is the order they're locked in
+        return [self.shard(index) for index in sorted({shard_of(event_id, self.count) for event_id in event_ids})]
+
+    def loaded(self):
+        return [shard for shard in self.shards if shard is not None]
+
+    def all(self):
+        return [self.shard(index) for index in range(self.count)]
+
+    def load(self):
+        for shard in self.loaded():
+            shard.load()
+
+    def refresh(self):
+        changed = [shard.refresh() for shard in self.loaded()]  # each shard only reloads if its own files changed
+        return any(changed)
+
+    @contextmanager
+    def reading(self):
+        with ExitStack() as locked:
+            for shard in self.all():
+                locked.enter_context(shard.reading())
+            yield
+
+    @contextmanager
+    def writing(self):
+        with ExitStack() as locked:
+            for shard in self.all():
+                locked.enter_context(shard.writing())
+            yield
+
+    def __contains__(self, attendee):
+        return self.get(*attendee) is not None
+
+    def __len__(self):
+        return sum(self._map('__len__'))
+
+    def __iter__(self):
+        return chain.from_iterable(self.all())
+
+    def get(self, event_id, attendee_id):
+        # The attendee, None if it isn't registered for event_id
+        row = self.route(event_id).get(attendee_id)
+        return row if row is not None and row.event_id == event_id else None
+
+    def for_event(self, event_id):
+        return self.route(event_id).for_event(event_id)
+
+    def registrations(self, email=None, phone=None):
+        rows = chain.from_iterable(self._map('registrations', email, phone))
+        return sorted(rows, key=lambda row: row.attendee_id)
+
+    def find_duplicate(self, row):
+        row = AttendeeRecord.from_row(row)
+        return self.route(row.event_id).find_duplicate(row)
+
+    def add(self, row, skip_duplicates=False):
+        rows = self.add_many([row], skip_duplicates)
+        return rows[0] if rows else None
+
+    @metrics.timed('store.shards.add')
+    def add_many(self, rows, skip_duplicates=False):
+        # Each shard gets its rows in one write
+        groups = {}
+        for row in rows:
+            row = AttendeeRecord.from_row(row)
+            groups.setdefault(shard_of(row.event_id, self.count), []).append(row)
+        added = []
+        for index in sorted(groups):
+            added += self.shard(index).add_many(groups[index], skip_duplicates)
+        return added
+
+    def delete(self, event_id, attendee_id):
+        rows = self.delete_many([(event_id, attendee_id)])
+        return rows[0] if rows else None
+
+    @metrics.timed('store.shards.delete')
+    def delete_many(self, attendees, persist=True):
+        # attendees are (event_id, attendee_id) pairs, like for store.delete_attendees
+        groups = {}
+        for attendee in attendees:
+            if attendee in self:
+                event_id, attendee_id = attendee
+                groups.setdefault(shard_of(event_id, self.count), []).append(attendee_id)
+        deleted = []
+        for index in sorted(groups):
+            deleted += self.shard(index).delete_many(groups[index], persist)
+        return deleted
+
+    def dangling(self, event_store):
+        event_ids = frozenset(event_store.rows)  # sent to the worker processes, a store can't be
+        return {event_id: attendee_ids for dangling in self._map('dangling', event_ids)
+                for event_id, attendee_ids in dangling.items()}
+
+    def headcounts(self):
+        return {event_id: count for counts in self._map('headcounts') for event_id, count in counts.items()}
+
+    def check(self, event_store):
+        bad_lines = []
+        dangling = {}
+        duplicates = []
+        for shard_bad_lines, shard_dangling, shard_duplicates in self._map('check', frozenset(event_store.rows)):
+            bad_lines += shard_bad_lines
+            dangling.update(shard_dangling)
+            duplicates += shard_duplicates
+        return bad_lines, dangling, duplicates
+
+    @metrics.timed('store.shards.scan')
+    def _map(self, method, *args):
+        # AttendeeStore.<method>(*args) of every shard, in shard order. The loaded shards answer here, the others in
+        # the worker processes when there's enough to read for that to pay off, and are loaded here otherwise. Each
+        # worker gets all its shards in one task, so args (the event IDs of a check) are sent to it once.
+        pending = [index for index, shard in enumerate(self.shards) if shard is None]
+        futures = {}
+        if len(pending) > 1 and sum(_file_size(self.filenames[index]) for index in pending) >= POOL_MIN_BYTES:
+            pools = self._pools()
+            batches = {}
+            for index in pending:
+                batches.setdefault(index % len(pools), []).append(index)
+            for worker, indexes in batches.items():
+                future = pools[worker].submit(_call_shards, [self.filenames[index] for index in indexes],
+                                              self.journaled, method, args)
+                futures[future] = indexes
+        in_workers = set(chain.from_iterable(futures.values()))
+        results = [getattr(self.shard(index), method)(*args) if index not in in_workers else None
+                   for index in range(self.count)]
+        for future, indexes in futures.items():
+            for index, result in zip(indexes, future.result()):
+                results[index] = result
+        return results
+
+    def _pools(self):
+        if self.pools is None:
+            # spawned rather than forked, this process may have threads running (the service, a journal compaction)
+            context = get_context('spawn')
+            self.pools = [ProcessPoolExecutor(1, mp_context=context) for _ in range(self.workers)]
+        return self.pools
+
+    def close(self):
+        if self.pools is not None:
+            for pool in self.pools:
+                pool.shutdown()
+            self.pools = None
+        for shard in self.loaded():
+            shard.close()
+
+
+class _ShardIndexes(list):
+    # ShardedAttendeeStore.indexes: an index added to it (Reports) is added to every shard, the ones loaded later too.
+    # It's told about each change through the shard that made it, and only that shard's part of it is rebuilt when a
+    # shard is (re)loaded.
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def append(self, index):
+        super().append(index)
+        for number, shard in enumerate(self.store.shards):
+            if shard is not None:
+                shard.indexes.append(_ShardPart(index, self.store.count, number))
+
+
+class _ShardPart:
+    # An index of the sharded store as one of its shards sees it: the changes are passed on, and a build of the shard
+    # is a build_part(in_part, rows) of the index, which only replaces what it had for the events of that shard
+    def __init__(self, index, count, number):
+        self.index = index
+        self.count = count
+        self.number = number
+
+    def build(self, rows):
+        self.index.build_part(self.in_part, rows)
+
+    def in_part(self, event_id):
+        return shard_of(event_id, self.count) == self.number
+
+    def add_many(self, rows):
+        self.index.add_many(rows)
+
+    def remove(self, row):
+        self.index.remove(row)
+
+
+class _RoutedByEvent:
+    # ShardedAttendeeStore.by_event: event_id -> {attendee_id: None}, looked up in the shard holding the event
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, event_id, default=None):
+        return self.store.route(event_id).by_event.get(event_id, default)
+
+    def __getitem__(self, event_id):
+        return self.store.route(event_id).by_event[event_id]
+
+    def __contains__(self, event_id):
+        return event_id in self.store.route(event_id).by_event
+
+
+class _ShardTables:
+    # ShardedAttendeeStore.table: what the callers ask a store's table, answered for the loaded shards together
+    cascades_deletes = False
+
+    def __init__(self, store):
+        self.store = store
+
+    def changed(self):
+        return any(shard.table.changed() for shard in self.store.loaded())
+
+
+def _file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except FileNotFoundError:
+        return 0
+
+
+_worker_shards = {}  # in a worker process: (filename, journaled) -> its AttendeeStore, kept between calls
+
+
+def _call_shards(filenames, journaled, method, args):
+    # Runs in a worker process. Each shard is read on the first call, and after that only reloaded if its files
+    # changed. Returns the results in the order of filenames.
+    results = []
+    for filename in filenames:
+        store = _worker_shards.get((filename, journaled))
+        if store is None:
+            store = _worker_shards[filename, journaled] = AttendeeStore(filename, journaled)
+        with store.reading():
+            results.append(getattr(store, method)(*args))
+    return results
+
+
+def reshard(filename, count):
+    # Split an attendees (or waitlist) file into `count` shards, move its rows into a different number of shards, or
+    # with count=1 merge the shards back into the one file. Any journal is folded in. Returns the number of rows.
+    # Run it while no other session is using the file.
+    old_count = shard_count(filename)
+    old_filenames = _layout(filename, old_count)
+    new_filenames = _layout(filename, count)
+    # the journaled table also reads a plain file, and replays the log of a journaled one
+    tables = [JournaledCsvTable(name, AttendeeRecord) for name in old_filenames]
+    with ExitStack() as locked:
+        rows = {}
+        for table in tables:
+            locked.enter_context(table.lock.exclusive())
+            rows.update(table.load())
+        groups = [[] for _ in new_filenames]
+        for row in rows.values():
+            groups[shard_of(row.event_id, len(new_filenames))].append(row)
+        for table in tables:
+            table.journal.close()
+        # The new files don't have the old ones' names (but with the same count), and the manifest is written last:
+        # a crash before it leaves the old files and their logs as they were, a crash after it leaves the new files
+        # complete and only some old ones to remove. With the same count each file is rewritten with its own log
+        # folded in, and replaying that log over it again changes nothing.
+        for name in set(new_filenames) - set(old_filenames):
+            for suffix in ('.log', '.log.old'):
+                _remove(name + suffix)  # left by an interrupted reshard, they'd be replayed over the new file
+        for name, group in zip(new_filenames, groups):
+            write_snapshot(name, group)
+        if count > 1:
+            write_snapshot(filename + MANIFEST_SUFFIX, [[count]])
+        else:
+            _remove(filename + MANIFEST_SUFFIX)
+        for name in old_filenames:
+            for suffix in ('.log', '.log.old'):
+                _remove(name + suffix)
+        for name in set(old_filenames) - set(new_filenames):
+            _remove(name)
+    for table in tables:
+        table.close()
+    IdAllocator(filename, lock=FileLock(filename)).observe(max(rows, default=0))
+    return len(rows)
+
+
+def _layout(filename, count):
+    # The files holding the rows of filename in `count` shards (None or 1: not sharded)
+    if count is None or count == 1:
+        return [filename]
+    return [shard_filename(filename, index, count) for index in range(count)]
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,362 @@
+import csv
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+import metrics
+from csv_reader import read_table
+from file_lock import FileLock, FileStamps, NullLock
+from id_allocator import IdAllocator
+from journal import Journal, write_snapshot
+from records import AttendeeRecord, EventRecord
+
+
+# Table is the storage interface behind EventStore and AttendeeStore. The stores keep everything in memory and only
+# call the table to load the rows once and to persist each change; rows are records (see records.py), ID first.
+# Several sessions can share the same data: the stores read under lock.shared() and change it under lock.exclusive(),
+# and reload their rows whenever changed() says another session wrote to the table since.
+class Table(ABC):
+    cascades_deletes = False  # True when deleting an event also deletes its attendees in the backend
+    lock = NullLock()
+    bad_lines = ()  # [(line number, reason)] of the lines the last load() had to skip, for the file based tables
+
+    @abstractmethod
+    def load(self):  # -> {id: row}. The stores keep using the returned dict as their state.
+        pass
+
+    @abstractmethod
+    def insert_many(self, rows):
+        pass
+
+    @abstractmethod
+    def update(self, row):
+        pass
+
+    @abstractmethod
+    def delete_many(self, record_ids):
+        pass
+
+    @abstractmethod
+    def id_allocator(self, known_max):
+        pass
+
+    def changed(self):  # True when another session changed the table since this one last loaded or wrote it
+        return False
+
+    def close(self):
+        pass
+
+
+# CsvTable is the original behavior: new rows are appended to the CSV file and edits and deletes rewrite it.
+# A session without --journal still reads the log a --journal session may have left next to the file, and folds it
+# into the file when it rewrites it, so the two kinds of session can take turns on the same files.
+class CsvTable(Table):
+
+    def __init__(self, filename, record_type, compact_threshold=1000):
+        self.filename = filename
+        self.record_type = record_type  # EventRecord or AttendeeRecord, the schema of the file
+        self.make_record = record_type.from_row
+        self.rows = {}
+        self.lock = FileLock(filename)
+        self.stamps = FileStamps(self.watched_files())
+        self.journal = Journal(filename, compact_threshold, self.lock, self.stamps)
+
+    def watched_files(self):
+        return [self.filename, self.filename + '.log', self.filename + '.log.old']
+
+    def changed(self):
+        return self.stamps.changed()
+
+    @metrics.timed('table.csv.load')
+    def load(self):
+        self.bad_lines = []
+        self.rows = read_table(self.filename, self.record_type, self.bad_lines)
+        self.journal.replay(self.rows, self.make_record)
+        self.stamps.update()
+        return self.rows
+
+    def _rewrite(self):
+        # Write the rows out as the whole file. Any log is part of the rows already, and replaying it over the new
+        # file would undo the change, so it's removed, after the file is in place (see Journal._recover).
+        write_snapshot(self.filename, self.rows.values())
+        for log_filename in (self.journal.old_log_filename, self.journal.log_filename):
+            if os.path.exists(log_filename):
+                os.remove(log_filename)
+        self.stamps.update()
+
+    @metrics.timed('table.csv.insert')
+    def insert_many(self, rows):
+        with open(self.filename, 'a', newline='') as csvfile:  # appending is enough for new rows
+            start = csvfile.tell()
+            csv.writer(csvfile).writerows(rows)
+            metrics.count('rows_written', len(rows), table=os.path.basename(self.filename))
+            metrics.count('bytes_written', csvfile.tell() - start, table=os.path.basename(self.filename))
+        self.stamps.update()
+
+    @metrics.timed('table.csv.update')
+    def update(self, row):
+        self._rewrite()
+
+    @metrics.timed('table.csv.delete')
+    def delete_many(self, record_ids):
+        self._rewrite()
+
+    def id_allocator(self, known_max):
+        return IdAllocator(self.filename, known_max, self.lock)
+
+    def close(self):
+        self.lock.close()
+
+
+# JournaledCsvTable appends every change to a log next to the CSV file instead (see journal.py).
+class JournaledCsvTable(CsvTable):
+
+    @metrics.timed('table.journal.insert')
+    def insert_many(self, rows):
+        self.journal.put_many(rows)
+        self.journal.maybe_compact(self.rows)
+        self.stamps.update()
+
+    @metrics.timed('table.journal.update')
+    def update(self, row):
+        self.journal.put(row)
+        self.journal.maybe_compact(self.rows)
+        self.stamps.update()
+
+    @metrics.timed('table.journal.delete')
+    def delete_many(self, record_ids):
+        self.journal.delete_many(record_ids)
+        self.journal.maybe_compact(self.rows)
+        self.stamps.update()
+
+    def close(self):
+        self.journal.close()
+        super().close()
+
+
+def open_csv_table(filename, record_type, journaled=False, compact_threshold=1000):
+    if journaled:
+        return JournaledCsvTable(filename, record_type, compact_threshold)
+    return CsvTable(filename, record_type)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    event_id INTEGER PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    event_name TEXT NOT NULL,
+    event_date TEXT NOT NULL,
+    event_time TEXT NOT NULL,
+    event_location TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    capacity INTEGER,
+    recurrence TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS attendees (
+    attendee_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    surname TEXT NOT NULL,
+    email TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    event_id INTEGER NOT NULL REFERENCES events (event_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS attendees_event_id ON attendees (event_id);
+CREATE TABLE IF NOT EXISTS waitlist (
+    attendee_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    surname TEXT NOT NULL,
+    email TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    event_id INTEGER NOT NULL REFERENCES events (event_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS waitlist_event_id ON waitlist (event_id);
+CREATE TABLE IF NOT EXISTS id_counters (
+    name TEXT PRIMARY KEY,
+    high_water INTEGER NOT NULL
+);
+'''
+
+# Record type of each table, its __slots__ are the columns in the same order as the CSV files
+RECORD_TYPES = {'events': EventRecord, 'attendees': AttendeeRecord, 'waitlist': AttendeeRecord}
+
+
+# SqliteDatabase owns the connection shared by the events and attendees tables. The database runs in WAL mode with
+# foreign keys on, so deleting an event also deletes its attendees. SQLite makes each statement atomic, but a check the
+# store makes in memory before it writes (the capacity of an event, a duplicate registration) isn't part of the
+# transaction, so each table also has a FileLock next to the database (events.db.attendees.lock), taken exactly like
+# the CSV files' locks: another session can't commit to the table between the check and the write.
+class SqliteDatabase:
+
+    def __init__(self, filename):
+        self.filename = filename
+        # isolation_level=None: transactions are started explicitly by transaction(). sqlite3 keeps a cache of
+        # prepared statements per connection, and the tables only use fixed SQL strings, so each one is compiled once.
+        self.connection = sqlite3.connect(filename, isolation_level=None, cached_statements=64,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')  # safe with WAL, and no fsync on every commit
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(SCHEMA)
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(events)')]
+        if 'capacity' not in columns:
+            self.connection.execute('ALTER TABLE events ADD COLUMN capacity INTEGER')  # created before capacities
+        if 'recurrence' not in columns:  # created before events could recur
+            self.connection.execute("ALTER TABLE events ADD COLUMN recurrence TEXT NOT NULL DEFAULT ''")
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute('BEGIN IMMEDIATE')  # take the write lock up front
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def table(self, name):
+        return SqliteTable(self, name)
+
+    def close(self):
+        self.connection.close()
+
+
+class SqliteTable(Table):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.cascades_deletes = name == 'events'  # the attendees and waitlist foreign keys are ON DELETE CASCADE
+        self.record_type = RECORD_TYPES[name]
+        columns = self.record_type.__slots__
+        key = columns[0]
+        self.select_sql = f'SELECT {", ".join(columns)} FROM {name} ORDER BY {key}'
+        # an upsert, because INSERT OR REPLACE would delete the old event row first and cascade to its attendees
+        self.insert_sql = (f'INSERT INTO {name} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+                           f'ON CONFLICT ({key}) DO UPDATE SET '
+                           + ', '.join(f'{column} = excluded.{column}' for column in columns[1:]))
+        self.update_sql = (f'UPDATE {name} SET {", ".join(f"{column} = ?" for column in columns[1:])} '
+                           f'WHERE {key} = ?')
+        self.delete_sql = f'DELETE FROM {name} WHERE {key} = ?'
+        self.data_version = None
+        self.lock = FileLock(f'{database.filename}.{name}')
+
+    def _data_version(self):
+        # changes whenever another connection commits, but not for this connection's own commits
+        return self.database.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def changed(self):
+        return self._data_version() != self.data_version
+
+    @metrics.timed('table.sqlite.load')
+    def load(self):
+        self.data_version = self._data_version()
+        rows = {}
+        for values in self.database.connection.execute(self.select_sql):
+            rows[values[0]] = self.record_type(*values)
+        metrics.count('rows_read', len(rows), table=self.name)
+        return rows
+
+    @metrics.timed('table.sqlite.insert')
+    def insert_many(self, rows):
+        with self.database.transaction() as connection:
+            connection.executemany(self.insert_sql, rows)
+        metrics.count('rows_written', len(rows), table=self.name)
+
+    @metrics.timed('table.sqlite.update')
+    def update(self, row):
+        with self.database.transaction() as connection:
+            values = list(row)
+            connection.execute(self.update_sql, values[1:] + values[:1])
+        metrics.count('rows_written', 1, table=self.name)
+
+    @metrics.timed('table.sqlite.delete')
+    def delete_many(self, record_ids):
+        with self.database.transaction() as connection:
+            connection.executemany(self.delete_sql, [(record_id,) for record_id in record_ids])
+        metrics.count('rows_deleted', len(record_ids), table=self.name)
+
+    def id_allocator(self, known_max):
+        return SqliteIdAllocator(self.database, self.name, known_max)
+
+    def close(self):
+        self.lock.close()
+
+
+# SqliteIdAllocator is IdAllocator for the SQLite backend, the high-water mark lives in the id_counters table.
+class SqliteIdAllocator:
+
+    def __init__(self, database, name, known_max=0):
+        self.database = database
+        self.name = name
+        self.high_water = -1  # last mark seen by this process, not written again unless an ID goes past it
+        self.observe(known_max)
+
+    def next_id(self):
+        return self.allocate(1)[0]
+
+    def allocate(self, count):
+        with self.database.transaction() as connection:
+            row = connection.execute('SELECT high_water FROM id_counters WHERE name = ?', (self.name,)).fetchone()
+            first_id = (row[0] if row else 0) + 1
+            connection.execute('INSERT OR REPLACE INTO id_counters (name, high_water) VALUES (?, ?)',
+                               (self.name, first_id + count - 1))
+        self.high_water = first_id + count - 1
+        return range(first_id, first_id + count)
+
+    def observe(self, used_id):
+        if used_id <= self.high_water:
+            return
+        self.high_water = used_id
+        with self.database.transaction() as connection:
+            connection.execute('INSERT INTO id_counters (name, high_water) VALUES (?, ?) '
+                               'ON CONFLICT (name) DO UPDATE SET high_water = max(high_water, excluded.high_water)',
+                               (self.name, used_id))
+
+
+def migrate_csv_to_sqlite(event_filename, attendee_filename, database_filename, waitlist_filename=None):
+    # One-shot copy of the CSV files into a SQLite database, in a single transaction.
+    # Returns (events copied, attendees copied, IDs of attendees skipped because their event doesn't exist).
+    # The waitlist, if there's one, is copied too and counted with the attendees. The files are read like the stores
+    # read them, with any journal replayed: the rows a --journal session deleted aren't copied.
+    events = _load_csv(event_filename, EventRecord)  # also fills in the short legacy rows
+    attendees = _load_csv(attendee_filename, AttendeeRecord)
+    waiting = _load_csv(waitlist_filename, AttendeeRecord) if waitlist_filename else {}
+    database = SqliteDatabase(database_filename)
+    events_table = database.table('events')
+    attendees_table = database.table('attendees')
+    waitlist_table = database.table('waitlist')
+    event_rows = list(events.values())
+    skipped = []
+
+    def valid(rows):
+        valid_rows = []
+        for attendee_id, row in rows.items():
+            if row.event_id in events:
+                valid_rows.append(row)
+            else:
+                skipped.append(attendee_id)  # the foreign key doesn't allow attendees of a missing event
+        return valid_rows
+
+    attendee_rows = valid(attendees)
+    waitlist_rows = valid(waiting)
+    with database.transaction() as connection:
+        connection.executemany(events_table.insert_sql, event_rows)
+        connection.executemany(attendees_table.insert_sql, attendee_rows)
+        connection.executemany(waitlist_table.insert_sql, waitlist_rows)
+    # carry the high-water marks over, so IDs that were already handed out are never reused. People on the waitlist
+    # get their attendee ID when they join it.
+    events_table.id_allocator(IdAllocator(event_filename, max(events, default=0)).high_water)
+    attendees_table.id_allocator(IdAllocator(attendee_filename, max(attendees, default=0)).high_water)
+    attendees_table.id_allocator(max(waiting, default=0))
+    database.close()
+    return len(event_rows), len(attendee_rows) + len(waitlist_rows), skipped
+
+
+def _load_csv(filename, record_type):
+    table = CsvTable(filename, record_type)
+    try:
+        with table.lock.shared():
+            return table.load()
+    finally:
+        table.close()
@@ -0,0 +1,593 @@
+from bisect import bisect_left, bisect_right, insort
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from operator import attrgetter, itemgetter
+
+import metrics
+from changelog import DELETE, INSERT, UPDATE
+from contact_index import ContactIndex
+from csv_reader import gc_paused
+from date_index import DateIndex
+from records import AttendeeRecord, EventRecord, parse_date
+from recurrence import OVERRIDE_FIELDS, SeriesIndex, occurrences, rule_of
+from search_index import SearchIndex
+from storage import open_csv_table
+
+
+# EventStore loads the events file once and keeps every row in memory as a compact EventRecord, keyed by event ID, so
+# looking an event up no longer means re-opening and scanning the whole CSV file.
+# Changes are persisted through a storage.Table: the CSV file by default (with journaled=True edits and deletes are
+# appended to events.csv.log instead, see journal.py), or any other table passed in, such as storage.SqliteTable.
+# Other sessions may be using the same file: refresh() reloads the rows when one of them changed it, and every change
+# is made under the table's exclusive lock on freshly reloaded rows, so nothing another session wrote is overwritten.
+# With a changelog (a changelog.TableLog), every change is also recorded there for downstream consumers.
+class EventStore:
+
+    def __init__(self, filename=None, journaled=False, compact_threshold=1000, table=None, changelog=None):
+        self.filename = filename
+        self.table = table or open_csv_table(filename, EventRecord, journaled, compact_threshold)
+        self.changelog = changelog
+        self.rows = {}  # event_id (int) -> EventRecord
+        self.sorted_ids = []  # all event IDs in ascending order, used as the cursor for paging
+        self.dates = DateIndex()
+        self.search_index = SearchIndex()
+        self.series = SeriesIndex()  # recurring events, which the date index leaves out
+        # secondary indexes, each one has build(rows), add_many(rows) and remove(row)
+        self.indexes = [self.dates, self.search_index, self.series]
+        self.load()
+
+    @metrics.timed('store.events.load')
+    def load(self):
+        with gc_paused():  # the rows and the indexes are millions of new objects, see csv_reader.gc_paused
+            with self.table.lock.shared():
+                self.rows = self.table.load()
+            with metrics.timer('store.events.index'):  # the rest of the load, apart from reading the table
+                self.sorted_ids = sorted(self.rows)
+                for index in self.indexes:
+                    index.build(self.rows.values())
+        self.ids = self.table.id_allocator(max(self.rows, default=0))
+
+    def refresh(self):
+        # Reload if another session changed the table since it was read, returns True if it did
+        if not self.table.changed():
+            return False
+        self.load()
+        return True
+
+    @contextmanager
+    def reading(self):
+        # Holds the shared lock, so no other session changes the table until the block ends
+        with self.table.lock.shared():
+            self.refresh()
+            yield
+
+    @contextmanager
+    def writing(self):
+        with self.table.lock.exclusive():
+            self.refresh()
+            yield
+
+    def __contains__(self, event_id):
+        return event_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows.values())
+
+    def get(self, event_id):
+        return self.rows.get(event_id)
+
+    def add(self, row):
+        return self.add_many([row])[0]
+
+    @metrics.timed('store.events.add')
+    def add_many(self, rows):
+        # Add a batch of rows with a single write, used by the bulk importer
+        rows = [EventRecord.from_row(row) for row in rows]
+        with self.writing():
+            replaced = set()  # IDs of events that were there already, recorded as updates
+            for row in rows:
+                event_id = row.event_id
+                if event_id in self.rows:
+                    self._unindex(self.rows[event_id])
+                    replaced.add(event_id)
+                elif not self.sorted_ids or event_id > self.sorted_ids[-1]:
+                    self.sorted_ids.append(event_id)  # new IDs are always the highest so far
+                else:
+                    insort(self.sorted_ids, event_id)
+                self.rows[event_id] = row
+            for index in self.indexes:
+                index.add_many(rows)
+            if rows:
+                self.ids.observe(max(row.event_id for row in rows))
+            self.table.insert_many(rows)
+            self._log(INSERT, [row for row in rows if row.event_id not in replaced])
+            self._log(UPDATE, [row for row in rows if row.event_id in replaced])
+        return rows
+
+    @metrics.timed('store.events.update')
+    def update(self, event_id, attr_index, new_value):
+        # Returns the new row, or None if another session deleted the event in the meantime
+        with self.writing():
+            old_row = self.rows.get(event_id)
+            if old_row is None:
+                return None
+            row = old_row.with_value(attr_index, new_value)
+            self.rows[event_id] = row
+            self._unindex(old_row)
+            for index in self.indexes:
+                index.add_many([row])
+            self.table.update(row)
+            self._log(UPDATE, [row])
+        return row
+
+    def delete(self, event_id):
+        rows = self.delete_many([event_id])
+        return rows[0] if rows else None
+
+    @metrics.timed('store.events.delete')
+    def delete_many(self, event_ids):
+        # Remove several events with a single rewrite (or log write, or transaction). Returns the removed rows, IDs
+        # that aren't there (any more) are skipped.
+        rows = []
+        with self.writing():
+            for event_id in event_ids:
+                row = self.rows.pop(event_id, None)
+                if row is None:
+                    continue
+                del self.sorted_ids[bisect_left(self.sorted_ids, event_id)]
+                self._unindex(row)
+                rows.append(row)
+            if rows:
+                self.table.delete_many([row.event_id for row in rows])
+                self._log(DELETE, rows)
+        return rows
+
+    def _log(self, op, rows):
+        # called under the exclusive lock, after the table saved the change, see changelog.py
+        if self.changelog is not None and rows:
+            self.changelog.record(op, rows)
+
+    def _unindex(self, row):
+        for index in self.indexes:
+            index.remove(row)
+
+    def iter_events(self, event_type=None, date_from=None, date_to=None, location=None, after=None):
+        # Lazily yield EventRecords in ID order, only as many as the caller consumes.
+        # date_from/date_to are datetime.date values (inclusive), location matches any part of the location, and
+        # after is a cursor: the ID of the last event already seen.
+        if date_from or date_to:
+            event_ids = self.dates.between(date_from, date_to)  # only the k events in the date range
+            event_ids += [event_id for event_id in self.series.overlapping(date_from, date_to)
+                          if next(occurrences(self.rows[event_id], date_from, date_to), None)]
+            event_ids.sort()
+        else:
+            event_ids = self.sorted_ids
+        position = bisect_right(event_ids, after) if after is not None else 0
+        event_type = event_type.lower() if event_type else None
+        location = location.lower() if location else None
+        while position < len(event_ids):
+            event = self.rows.get(event_ids[position])
+            position += 1
+            if event is None:
+                continue  # deleted while the caller was still iterating
+            if event_type and event.event_type.lower() != event_type:
+                continue
+            if location and location not in event.event_location.lower():
+                continue
+            yield event
+
+    def iter_between(self, date_from=None, date_to=None):
+        # Lazily yield EventRecords from date_from to date_to (inclusive) in date and time order: the one-off events
+        # from the date index, merged with the occurrences of the recurring events that overlap the range, each
+        # series expanded only as far as the caller reads
+        one_off = (self.rows[event_id] for event_id in self.dates.between(date_from, date_to))
+        return merge(one_off, *self._occurrences(date_from, date_to), key=_date_order)
+
+    def _occurrences(self, date_from, date_to):
+        return [(row for _, row in occurrences(self.rows[event_id], date_from, date_to))
+                for event_id in self.series.overlapping(date_from, date_to)]
+
+    def events_between(self, date_from=None, date_to=None):
+        # EventRecords from date_from to date_to (inclusive) in date and time order, occurrences included
+        return list(self.iter_between(date_from, date_to))
+
+    def upcoming(self, count=10, now=None):
+        now = now or datetime.now()
+        one_off = [self.rows[event_id] for event_id in self.dates.upcoming(count, now)]
+        later = (row for row in merge(*self._occurrences(now.date(), None), key=_date_order)
+                 if row.date > now.date() or row.event_time >= now.strftime('%H:%M'))
+        return list(islice(merge(one_off, later, key=_date_order), count))
+
+    def counts_by_day(self, date_from=None, date_to=None):
+        # {date: number of events and occurrences} for the days in the range that have any, in date order
+        counts = self.dates.counts_by_day(date_from, date_to)
+        for rows in self._occurrences(date_from, date_to):
+            for row in rows:
+                counts[row.date] = counts.get(row.date, 0) + 1
+        return dict(sorted(counts.items()))
+
+    def occurrences(self, event_id, date_from=None, date_to=None):
+        # (original date, EventRecord) of each occurrence of a recurring event in the range, see recurrence.py
+        return occurrences(self.rows[event_id], date_from, date_to)
+
+    def edit_occurrence(self, event_id, original_date, changes=None):
+        # Change one occurrence of a recurring event ({field: value} of OVERRIDE_FIELDS), or cancel it with
+        # changes=None. The series stays one row: the change is saved in its recurrence column, like an edit.
+        # Returns the updated series row, None if another session deleted it; raises ValueError if the event doesn't
+        # recur on original_date or a change isn't valid.
+        with self.writing():
+            event = self.rows.get(event_id)
+            if event is None:
+                return None
+            rule = rule_of(event)
+            day = parse_date(original_date)
+            if rule is None or event.date is None or day is None or not rule.is_occurrence(event.date, day):
+                raise ValueError(f'event {event_id} has no occurrence on {original_date}')
+            if changes is None:
+                rule = rule.with_cancelled(original_date)
+            else:  # values the same as the series' own aren't kept
+                changes = {field: value for field, value in changes.items()
+                           if field not in OVERRIDE_FIELDS or value != (original_date if field == 'event_date'
+                                                                        else event[OVERRIDE_FIELDS[field]])}
+                rule = rule.with_override(original_date, changes)
+            return self.update(event_id, 8, rule.to_text())
+
+    @metrics.timed('store.events.search')
+    def search(self, text, limit=20):
+        # [(EventRecord, score)] of the events whose name, owner and location match every word of text, best first
+        return [(self.rows[event_id], score) for event_id, score in self.search_index.search(text, self.rows, limit)]
+
+    @metrics.timed('store.events.page')
+    def page(self, limit=20, offset=0, cursor=None, **filters):
+        # One page of iter_events. Returns (events, next_cursor), next_cursor is None on the last page.
+        # Passing the returned cursor back is cheaper than a growing offset, it doesn't re-walk the earlier pages.
+        events = list(islice(self.iter_events(after=cursor, **filters), offset, offset + limit + 1))
+        if len(events) > limit:
+            events = events[:limit]
+            return events, events[-1].event_id
+        return events, None
+
+    def close(self):
+        self.table.close()
+
+
+# AttendeeStore does the same for the attendees file, and also keeps a secondary index from each event ID to the IDs
+# of its attendees, so listing the attendees of one event only touches those k rows, and an index of the normalized
+# emails and phones (see contact_index.py) to find a person's registrations and duplicate registrations.
+# A second AttendeeStore holds the waitlist (see register_attendees).
+# A very large attendees file can also be split into shards by event ID, each one an AttendeeStore of its own, see
+# shards.ShardedAttendeeStore. route() and shards_for() are how the functions below find the store holding an event's
+# attendees; an unsharded store holds them all.
+class AttendeeStore:
+
+    def __init__(self, filename=None, journaled=False, compact_threshold=1000, table=None, changelog=None, ids=None):
+        self.filename = filename
+        self.table = table or open_csv_table(filename, AttendeeRecord, journaled, compact_threshold)
+        self.changelog = changelog
+        self.shared_ids = ids  # an IdAllocator shared with other stores (the other shards), instead of the table's
+        self.rows = {}  # attendee_id (int) -> AttendeeRecord
+        self.by_event = {}  # event_id (int) -> {attendee_id: None}, a dict is used as an insertion-ordered set
+        self.contacts = ContactIndex()
+        self.indexes = [self.contacts]  # build(rows), add_many(rows) and remove(row), like EventStore.indexes
+        self.load()
+
+    @metrics.timed('store.attendees.load')
+    def load(self):
+        with gc_paused():
+            with self.table.lock.shared():
+                self.rows = self.table.load()  # rows without a numeric event ID were already skipped by AttendeeRecord
+            with metrics.timer('store.attendees.index'):
+                self.by_event = {}
+                for attendee_id, row in self.rows.items():
+                    self.by_event.setdefault(row.event_id, {})[attendee_id] = None
+                for index in self.indexes:
+                    index.build(self.rows.values())
+        if self.shared_ids is None:
+            self.ids = self.table.id_allocator(max(self.rows, default=0))
+        else:
+            self.ids = self.shared_ids
+            self.ids.observe(max(self.rows, default=0))
+
+    def refresh(self):
+        if not self.table.changed():
+            return False
+        self.load()
+        return True
+
+    def route(self, event_id):
+        return self
+
+    def shards_for(self, event_ids):
+        return [self]
+
+    @contextmanager
+    def reading(self):
+        with self.table.lock.shared():
+            self.refresh()
+            yield
+
+    @contextmanager
+    def writing(self):
+        with self.table.lock.exclusive():
+            self.refresh()
+            yield
+
+    def _index(self, row):
+        self.rows[row.attendee_id] = row
+        self.by_event.setdefault(row.event_id, {})[row.attendee_id] = None
+        for index in self.indexes:
+            index.add_many([row])
+
+    def __contains__(self, attendee_id):
+        return attendee_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows.values())
+
+    def get(self, attendee_id):
+        return self.rows.get(attendee_id)
+
+    def for_event(self, event_id):
+        return [self.rows[attendee_id] for attendee_id in self.by_event.get(event_id, ())]
+
+    def registrations(self, email=None, phone=None):
+        # The attendee rows of a person, found by email or phone: one per event they're registered for
+        return [self.rows[attendee_id] for attendee_id, _ in self.contacts.registrations(email, phone)]
+
+    def find_duplicate(self, row):
+        # The attendee already registered for the same event with the same email or phone, or None
+        attendee_id = self.contacts.find_duplicate(AttendeeRecord.from_row(row))
+        return self.rows[attendee_id] if attendee_id is not None else None
+
+    def add(self, row, skip_duplicates=False):
+        # Returns the added row, or None if it was a duplicate and skip_duplicates is on
+        rows = self.add_many([row], skip_duplicates)
+        return rows[0] if rows else None
+
+    @metrics.timed('store.attendees.add')
+    def add_many(self, rows, skip_duplicates=False):
+        # With skip_duplicates, rows that register a person (same email or phone) for an event they're already
+        # registered for are left out, whether the earlier registration is in the store or earlier in rows. That's
+        # checked under the write lock, in the same pass that adds the rows. Returns the rows that were added.
+        rows = [AttendeeRecord.from_row(row) for row in rows]
+        with self.writing():
+            if skip_duplicates:
+                added = []
+                for row in rows:
+                    if self.contacts.find_duplicate(row) is None:
+                        self._index(row)
+                        added.append(row)
+                rows = added
+            else:
+                for row in rows:
+                    self._index(row)
+            if rows:
+                self.ids.observe(max(row.attendee_id for row in rows))
+            self.table.insert_many(rows)
+            self._log(INSERT, rows)
+        return rows
+
+    def delete(self, attendee_id):
+        rows = self.delete_many([attendee_id])
+        return rows[0] if rows else None
+
+    @metrics.timed('store.attendees.delete')
+    def delete_many(self, attendee_ids, persist=True):
+        # persist=False only forgets the rows in memory, for when the backend already deleted them (a cascade).
+        # IDs that aren't there (any more) are skipped.
+        rows = []
+        with self.writing():
+            for attendee_id in attendee_ids:
+                row = self.rows.pop(attendee_id, None)
+                if row is None:
+                    continue
+                attendees = self.by_event[row.event_id]
+                del attendees[attendee_id]
+                if not attendees:
+                    del self.by_event[row.event_id]
+                for index in self.indexes:
+                    index.remove(row)
+                rows.append(row)
+            if rows and persist:
+                self.table.delete_many([row.attendee_id for row in rows])
+            self._log(DELETE, rows)  # also the rows a cascade deleted
+        return rows
+
+    def _log(self, op, rows):
+        if self.changelog is not None and rows:
+            self.changelog.record(op, rows)
+
+    def dangling(self, event_store):
+        # {event_id: [attendee IDs]} for attendees of events that don't exist. One pass over the event -> attendees
+        # index, so it's linear in the number of events that have attendees, not events x attendees.
+        # event_store can be any container of event IDs.
+        return {event_id: list(attendee_ids) for event_id, attendee_ids in self.by_event.items()
+                if event_id not in event_store}
+
+    def headcounts(self):
+        # {event_id: number of attendees}, for the events that have any
+        return {event_id: len(attendee_ids) for event_id, attendee_ids in self.by_event.items()}
+
+    def check(self, event_store):
+        # The integrity check of the file: (lines that couldn't be read as [(filename, line number, reason)],
+        # dangling(event_store), the registrations that repeat an earlier one for the same event as
+        # [(row, ID of the earlier one)])
+        bad_lines = [(self.filename, line_number, reason) for line_number, reason in self.table.bad_lines]
+        duplicates = [(self.rows[attendee_id], original_id)
+                      for attendee_id, original_id in self.contacts.duplicates().items()]
+        return bad_lines, self.dangling(event_store), duplicates
+
+    def close(self):
+        self.table.close()
+
+
+@metrics.timed('delete_events')
+def delete_events(event_store, attendee_store, event_ids, waitlist=None):
+    # Delete events together with their attendees, found through the event -> attendees index, and the people waiting
+    # for them on the waitlist (an AttendeeStore, see register_attendees). Each file is rewritten once however many
+    # events go; with SQLite the foreign key cascade removes the attendees in the same transaction.
+    # The files stay locked for the whole operation (always events first, then attendees, then the waitlist, the
+    # shards of each in order), and adding an attendee holds the events file's shared lock while it checks the event,
+    # so no attendee can be added to one of these events in between. Only the shards holding these events are locked
+    # and rewritten. Returns (deleted event rows, deleted attendee and waitlist rows).
+    with event_store.writing(), ExitStack() as locked:
+        event_ids = [event_id for event_id in dict.fromkeys(event_ids) if event_id in event_store]
+        stores = [attendee_store, waitlist] if waitlist else [attendee_store]
+        for store in stores:
+            for shard in store.shards_for(event_ids):
+                locked.enter_context(shard.writing())
+        attendee_ids = [_attendees_of(store, event_ids) for store in stores]
+        attendee_rows = []
+        if event_store.table.cascades_deletes:
+            event_rows = event_store.delete_many(event_ids)
+            for ids in attendee_ids:
+                for shard, shard_ids in ids.items():
+                    attendee_rows += shard.delete_many(shard_ids, persist=False)
+        else:  # attendees first, so a crash in between can't leave attendees of a deleted event behind
+            for ids in attendee_ids:
+                for shard, shard_ids in ids.items():
+                    attendee_rows += shard.delete_many(shard_ids)
+            event_rows = event_store.delete_many(event_ids)
+    return event_rows, attendee_rows
+
+
+def _attendees_of(store, event_ids):
+    # {shard: IDs of the attendees of event_ids it holds}, the store itself is the only shard when it isn't sharded
+    attendee_ids = {}
+    for event_id in event_ids:
+        shard = store.route(event_id)
+        attendee_ids.setdefault(shard, []).extend(shard.by_event.get(event_id, ()))
+    return attendee_ids
+
+
+def _by_shard(attendee_store, waitlist, items, event_id=attrgetter('event_id')):
+    # Group rows (or anything event_id gets the event ID of, event IDs themselves with event_id=None) by the attendee
+    # and waitlist shards holding their events: {(attendee shard, waitlist shard): [items]}, one group when the
+    # stores aren't sharded
+    groups = {}
+    for item in items:
+        key = event_id(item) if event_id else item
+        groups.setdefault((attendee_store.route(key), waitlist.route(key)), []).append(item)
+    return groups
+
+
+# Capacity and waitlist. An event with a capacity admits attendees while it has fewer than that many, which is one
+# lookup in the event -> attendees index, so admission costs the same however many attendees there are. Once it's
+# full, new registrations go to the waitlist: a second AttendeeStore (waitlist.csv), in the order people joined.
+# People on the waitlist already have their attendee ID, and keep it when they're promoted. Whenever an attendee is
+# deleted (or the capacity raised) the first people waiting are moved over to the attendees.
+# Every check and change happens under the attendees' and the waitlist's exclusive locks, on freshly reloaded rows, so
+# concurrent registrations from any number of sessions never take the event over its capacity. With sharded stores
+# those are the locks of the one attendee shard and waitlist shard holding the event, so registrations for events in
+# other shards go ahead at the same time.
+
+@metrics.timed('register_attendees')
+def register_attendees(event_store, attendee_store, waitlist, rows):
+    # Admit each row, or put it on the waitlist when its event is full or people are already waiting. Rows that
+    # register a person (same email or phone) already registered for or waiting for the event, in the stores or
+    # earlier in rows, are left out. Returns (admitted rows, waitlisted rows).
+    rows = [AttendeeRecord.from_row(row) for row in rows]
+    admitted = []
+    waitlisted = []
+    with event_store.reading():
+        batch = ContactIndex()
+        room = {}  # event_id -> places left, None for no limit
+        for (shard, waiting), shard_rows in _by_shard(attendee_store, waitlist, rows).items():
+            with shard.writing(), waiting.writing():
+                shard_admitted = []
+                shard_waitlisted = []
+                for row in shard_rows:
+                    if (shard.contacts.find_duplicate(row) is not None
+                            or waiting.contacts.find_duplicate(row) is not None
+                            or batch.find_duplicate(row) is not None):
+                        continue
+                    batch.add_many([row])
+                    event_id = row.event_id
+                    if event_id not in room:
+                        event = event_store.get(event_id)
+                        if event is None or event.capacity is None:
+                            room[event_id] = None  # the callers check that the event exists
+                        elif waiting.by_event.get(event_id):
+                            room[event_id] = 0  # nobody jumps the queue
+                        else:
+                            room[event_id] = event.capacity - len(shard.by_event.get(event_id, ()))
+                    if room[event_id] is None:
+                        shard_admitted.append(row)
+                    elif room[event_id] > 0:
+                        room[event_id] -= 1
+                        shard_admitted.append(row)
+                    else:
+                        shard_waitlisted.append(row)
+                if shard_admitted:  # even an empty write opens the file (or a SQLite write transaction)
+                    shard.add_many(shard_admitted)
+                if shard_waitlisted:
+                    waiting.add_many(shard_waitlisted)
+            admitted += shard_admitted
+            waitlisted += shard_waitlisted
+    return admitted, waitlisted
+
+
+@metrics.timed('delete_attendees')
+def delete_attendees(event_store, attendee_store, waitlist, attendees):
+    # Delete attendees, or people from the waitlist, and promote the first people waiting into the places freed.
+    # attendees are (event_id, attendee_id) pairs, each one is only looked for in the shard holding its event; IDs
+    # that aren't there, or are registered for another event, are skipped. Returns (deleted rows, promoted rows).
+    deleted = []
+    promoted = []
+    with event_store.reading():
+        for (shard, waiting), pairs in _by_shard(attendee_store, waitlist, dict.fromkeys(attendees),
+                                                 itemgetter(0)).items():
+            with shard.writing(), waiting.writing():
+                ids = []
+                for event_id, attendee_id in pairs:
+                    row = shard.get(attendee_id) or waiting.get(attendee_id)
+                    if row is not None and row.event_id == event_id:
+                        ids.append(attendee_id)
+                shard_deleted = shard.delete_many(ids) + waiting.delete_many(ids)
+                promoted += _promote(event_store, shard, waiting, dict.fromkeys(row.event_id for row in shard_deleted))
+            deleted += shard_deleted
+    return deleted, promoted
+
+
+@metrics.timed('promote')
+def promote(event_store, attendee_store, waitlist, event_ids):
+    # Fill the free places of events from their waitlists, e.g. after raising a capacity. Returns the promoted rows.
+    promoted = []
+    with event_store.reading():
+        for (shard, waiting), shard_event_ids in _by_shard(attendee_store, waitlist, event_ids, None).items():
+            with shard.writing(), waiting.writing():
+                promoted += _promote(event_store, shard, waiting, shard_event_ids)
+    return promoted
+
+
+def _promote(event_store, attendee_store, waitlist, event_ids):
+    # called with the attendee and waitlist shard holding event_ids locked
+    promoted = []
+    for event_id in event_ids:
+        event = event_store.get(event_id)
+        waiting = waitlist.by_event.get(event_id)
+        if event is None or not waiting:
+            continue
+        if event.capacity is None:
+            room = len(waiting)
+        else:
+            room = event.capacity - len(attendee_store.by_event.get(event_id, ()))
+        if room > 0:
+            rows = [waitlist.rows[attendee_id] for attendee_id in islice(waiting, room)]
+            # added before they leave the waitlist, so a crash in between leaves them in both rather than in neither
+            attendee_store.add_many(rows)
+            waitlist.delete_many([row.attendee_id for row in rows])
+            promoted += rows
+    return promoted
+
+
+def _date_order(event):
+    return event.date, event.event_time, event.event_id
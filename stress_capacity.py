@@ -0,0 +1,126 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+
+from shards import ShardedAttendeeStore
+from storage import SqliteDatabase
+from store import AttendeeStore, EventStore, delete_attendees, register_attendees
+
+# Multiprocess stress test for the capacity and the waitlist: several sessions register people for the same few small
+# events at the same time and cancel some of them, and the files are checked afterwards:
+#   - no event has more attendees than its capacity
+#   - nobody is waiting for an event that still has free places
+#   - everyone a session registered and didn't cancel is either an attendee or on the waitlist, never both
+# With --shards the attendees and the waitlist are sharded stores (see shards.py), with --sqlite every session has its
+# own connection to one SQLite database.
+
+
+def open_stores(directory, journaled, compact_threshold=50, shards=None, sqlite=False):
+    if sqlite:
+        database = SqliteDatabase(os.path.join(directory, 'events.db'))
+        return (EventStore(table=database.table('events')), AttendeeStore(table=database.table('attendees')),
+                AttendeeStore(table=database.table('waitlist')), database)
+
+    def attendees(name):
+        if shards:
+            return ShardedAttendeeStore(os.path.join(directory, name), shards, journaled, compact_threshold)
+        return AttendeeStore(os.path.join(directory, name), journaled, compact_threshold)
+
+    return (EventStore(os.path.join(directory, 'events.csv'), journaled, compact_threshold),
+            attendees('attendees.csv'), attendees('waitlist.csv'), None)
+
+
+def close_stores(event_store, attendee_store, waitlist, database):
+    for store in (event_store, attendee_store, waitlist):
+        store.close()
+    if database is not None:
+        database.close()
+
+
+def session(directory, number, operations, events, journaled, compact_threshold, shards, sqlite, seed):
+    random.seed(seed + number)
+    event_store, attendee_store, waitlist, database = open_stores(directory, journaled, compact_threshold, shards,
+                                                                  sqlite)
+    registered = []
+    cancelled = []
+    for operation in range(operations):
+        if random.random() < 0.7 or not registered:
+            attendee_id = attendee_store.ids.next_id()
+            event_id = random.randint(1, events)
+            register_attendees(event_store, attendee_store, waitlist,
+                               [[attendee_id, f'session{number}', f'op{operation}',
+                                 f's{number}.op{operation}@example.com', f'07{number:03d}{operation:06d}', event_id]])
+            registered.append((event_id, attendee_id))
+        else:
+            event_id, attendee_id = registered.pop(random.randrange(len(registered)))
+            delete_attendees(event_store, attendee_store, waitlist, [(event_id, attendee_id)])
+            cancelled.append(attendee_id)
+    registered = [attendee_id for _, attendee_id in registered]
+    close_stores(event_store, attendee_store, waitlist, database)
+    return registered, cancelled
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that concurrent registrations never overbook an event')
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=200, help='operations per process')
+    parser.add_argument('--events', type=int, default=5)
+    parser.add_argument('--capacity', type=int, default=20)
+    parser.add_argument('--journal', action='store_true', help='use the journaled CSV tables')
+    parser.add_argument('--compact-threshold', type=int, default=50)
+    parser.add_argument('--shards', type=int, help='split the attendees and the waitlist into this many shards')
+    parser.add_argument('--sqlite', action='store_true', help='use a SQLite database instead of the CSV files')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        event_store, attendee_store, waitlist, database = open_stores(directory, args.journal, shards=args.shards,
+                                                                      sqlite=args.sqlite)
+        event_store.add_many([[event_id, 'business', f'event {event_id}', '01/01/2030', '10:00', 'hall', 'owner',
+                               args.capacity] for event_id in event_store.ids.allocate(args.events)])
+        close_stores(event_store, attendee_store, waitlist, database)
+
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(session, [(directory, number, args.operations, args.events, args.journal,
+                                              args.compact_threshold, args.shards, args.sqlite, args.seed)
+                                             for number in range(args.processes)])
+
+        event_store, attendee_store, waitlist, database = open_stores(directory, args.journal, shards=args.shards,
+                                                                      sqlite=args.sqlite)
+        problems = []
+        expected = set()
+        for registered, _ in results:
+            expected.update(registered)
+        attending = {row.attendee_id for row in attendee_store}
+        waiting = {row.attendee_id for row in waitlist}
+        for event in event_store:
+            headcount = len(attendee_store.by_event.get(event.event_id, ()))
+            queue = waitlist.by_event.get(event.event_id, ())
+            if headcount > event.capacity:
+                problems.append(f'event {event.event_id} has {headcount} attendees, its capacity is {event.capacity}')
+            if queue and headcount < event.capacity:
+                problems.append(f'{len(queue)} people wait for event {event.event_id}, which has '
+                                f'{event.capacity - headcount} free places')
+        if attending & waiting:
+            problems.append(f'{len(attending & waiting)} people are both attendees and on the waitlist')
+        if expected - attending - waiting:
+            problems.append(f'{len(expected - attending - waiting)} registrations were lost')
+        if (attending | waiting) - expected:
+            problems.append(f'{len((attending | waiting) - expected)} cancelled registrations are back')
+        close_stores(event_store, attendee_store, waitlist, database)
+
+    print(f'{args.processes} processes x {args.operations} operations on {args.events} events of capacity '
+          f'{args.capacity} ({"SQLite" if args.sqlite else "journaled CSV" if args.journal else "plain CSV"}'
+          f'{f", {args.shards} shards" if args.shards else ""}): {len(attending)} attendees, '
+          f'{len(waiting)} waiting')
+    for problem in problems:
+        print('  ' + problem)
+    print('FAILED' if problems else 'OK, no event overbooked and no registration lost')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
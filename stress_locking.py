@@ -0,0 +1,118 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+
+from file_lock import NullLock
+from store import AttendeeStore, EventStore
+
+# Multiprocess stress test for the file locking: several sessions add, edit and delete rows in the same CSV files at
+# the same time, the way several operators running EC_EventManagement_Final2.py would, and the files are checked for
+# lost updates afterwards:
+#   - every attendee a session added and didn't delete is in the file, every one it deleted is gone
+#   - no ID was handed out twice
+#   - each session's event has the name that session wrote last
+# --unlocked switches the locks and the change detection off, to show the same run losing updates without them.
+
+
+def open_stores(directory, journaled, unlocked, compact_threshold=50):
+    # a low compaction threshold, so the sessions also compact each other's logs
+    stores = (EventStore(os.path.join(directory, 'events.csv'), journaled, compact_threshold),
+              AttendeeStore(os.path.join(directory, 'attendees.csv'), journaled, compact_threshold))
+    if unlocked:
+        for store in stores:
+            store.table.lock = store.ids.lock = NullLock()
+            store.table.changed = lambda: False
+            if journaled:
+                store.table.journal.file_lock = NullLock()
+    return stores
+
+
+def session(directory, number, operations, journaled, unlocked, compact_threshold, seed):
+    random.seed(seed + number)
+    event_store, attendee_store = open_stores(directory, journaled, unlocked, compact_threshold)
+    event_id = number + 1  # the event this session renames
+    added = []
+    deleted = []
+    name = None
+    errors = 0
+    for operation in range(operations):
+        choice = random.random()
+        try:
+            if choice < 0.6 or not added:
+                attendee_id = attendee_store.ids.next_id()
+                attendee_store.add([attendee_id, f'session{number}', f'op{operation}', 'x@example.com', '0700',
+                                    random.randint(1, len(event_store))])
+                added.append(attendee_id)
+            elif choice < 0.85:
+                attendee_id = added.pop(random.randrange(len(added)))
+                attendee_store.delete(attendee_id)
+                deleted.append(attendee_id)
+            else:
+                name = f'session {number} edit {operation}'
+                event_store.update(event_id, 2, name)
+        except (OSError, KeyError):  # only without the locks: the sessions trip over each other's temporary files
+            errors += 1
+    event_store.close()
+    attendee_store.close()
+    return added, deleted, (event_id, name), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that concurrent sessions never lose each other\'s updates')
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=300, help='operations per process')
+    parser.add_argument('--journal', action='store_true', help='use the journaled CSV tables')
+    parser.add_argument('--unlocked', action='store_true', help='switch the locking off, to see the race')
+    parser.add_argument('--compact-threshold', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        event_store, attendee_store = open_stores(directory, args.journal, False)
+        event_store.add_many([[event_id, 'business', f'event {event_id}', '01/01/2030', '10:00', 'hall', 'owner']
+                              for event_id in event_store.ids.allocate(args.processes)])
+        event_store.close()
+        attendee_store.close()
+
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(session, [(directory, number, args.operations, args.journal, args.unlocked,
+                                              args.compact_threshold, args.seed) for number in range(args.processes)])
+
+        event_store, attendee_store = open_stores(directory, args.journal, False)
+        expected = set()
+        handed_out = []
+        problems = []
+        failed = sum(errors for _, _, _, errors in results)
+        if failed:
+            problems.append(f'{failed} operations failed')
+        for added, deleted, (event_id, name), _ in results:
+            expected.update(added)
+            handed_out.extend(added + deleted)
+            if name is not None and event_store.get(event_id).event_name != name:
+                problems.append(f'event {event_id} is named {event_store.get(event_id).event_name!r}, '
+                                f'the last edit was {name!r}')
+        duplicates = len(handed_out) - len(set(handed_out))
+        if duplicates:
+            problems.append(f'{duplicates} attendee IDs were handed out more than once')
+        stored = set(attendee_store.rows)
+        if stored - expected:
+            problems.append(f'{len(stored - expected)} deleted attendees are back in the file')
+        if expected - stored:
+            problems.append(f'{len(expected - stored)} added attendees were lost')
+        event_store.close()
+        attendee_store.close()
+
+    print(f'{args.processes} processes x {args.operations} operations '
+          f'({"journaled" if args.journal else "plain"} CSV, {"unlocked" if args.unlocked else "locked"}): '
+          f'{len(expected)} attendees expected, {len(stored)} in the file')
+    for problem in problems:
+        print('  ' + problem)
+    print('FAILED, updates were lost' if problems else 'OK, no lost updates')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())